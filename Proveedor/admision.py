@@ -0,0 +1,193 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+
+
+class CuboTokens:
+    """Token bucket: `capacidad` de ráfaga que se recarga a `tasa` tokens por segundo"""
+
+    def __init__(self, capacidad: float, tasa: float):
+        self.capacidad = capacidad
+        self.tasa = tasa
+        self.tokens = capacidad
+        self.actualizado = time.monotonic()
+
+    def consumir(self, coste: float = 1.0) -> float:
+        """Consume `coste` tokens; devuelve 0 si se admite o los segundos a esperar si no"""
+        ahora = time.monotonic()
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.actualizado) * self.tasa)
+        self.actualizado = ahora
+        if self.tokens >= coste:
+            self.tokens -= coste
+            return 0.0
+        return (coste - self.tokens) / self.tasa
+
+
+class LimitadorClientes:
+    """Un token bucket por cliente, con un número máximo de clientes recordados (LRU)"""
+
+    def __init__(self, capacidad: float, tasa: float, max_clientes: int = 10000):
+        self.capacidad = capacidad
+        self.tasa = tasa
+        self.max_clientes = max_clientes
+        self._cubos: "OrderedDict[str, CuboTokens]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consumir(self, cliente: str, coste: float = 1.0) -> float:
+        with self._lock:
+            cubo = self._cubos.get(cliente)
+            if cubo is None:
+                cubo = self._cubos[cliente] = CuboTokens(self.capacidad, self.tasa)
+                if len(self._cubos) > self.max_clientes:
+                    self._cubos.popitem(last=False)
+            else:
+                self._cubos.move_to_end(cliente)
+            return cubo.consumir(coste)
+
+
+@dataclass
+class GrupoRutas:
+    nombre: str
+    rutas: List[Tuple[str, str]]           # (método, ruta exacta o prefijo terminado en "/")
+    coste: float = 1.0                     # tokens que consume cada petición
+    max_concurrencia: Optional[int] = None
+    prioritario: bool = False              # no cuenta para el límite global de concurrencia
+    en_curso: int = 0
+    admitidas: int = 0
+    rechazadas_429: int = 0
+    rechazadas_503: int = 0
+
+    def coincide(self, metodo: str, ruta: str) -> bool:
+        for metodo_grupo, patron in self.rutas:
+            if metodo_grupo != metodo:
+                continue
+            if ruta == patron or (patron.endswith("/") and ruta.startswith(patron)):
+                return True
+        return False
+
+
+class ControlAdmision:
+    """Estado y reglas del control de admisión (lo aplica AdmisionMiddleware).
+
+    - Rate limiting por cliente con token bucket: por X-API-Key si es una de
+      `claves_api`, si no por IP (una clave o client_id sin validar se podría
+      cambiar en cada petición). Las rutas caras consumen más tokens. Si no hay tokens: 429 + Retry-After.
+    - Límite de concurrencia por grupo de rutas y uno global para todo lo que no
+      es prioritario, de modo que /confirm y /cancel siempre encuentran worker
+      libre. Si se supera: 503 + Retry-After.
+    """
+
+    def __init__(
+        self,
+        grupos: List[GrupoRutas],
+        tasa: float = 20.0,
+        rafaga: float = 40.0,
+        max_concurrencia: int = 32,
+        exentas: Tuple[str, ...] = ("/",),
+        claves_api: Iterable[str] = ()
+    ):
+        self.grupos = grupos
+        self.general = GrupoRutas("general", [])
+        self.limitador = LimitadorClientes(rafaga, tasa)
+        self.max_concurrencia = max_concurrencia
+        self.exentas = exentas
+        self.claves_api = frozenset(claves_api)
+        self.en_curso = 0
+        self._lock = threading.Lock()
+
+    def _grupo(self, metodo: str, ruta: str) -> GrupoRutas:
+        for grupo in self.grupos:
+            if grupo.coincide(metodo, ruta):
+                return grupo
+        return self.general
+
+    def _cliente(self, scope) -> str:
+        api_key = Headers(scope=scope).get("x-api-key")
+        if api_key and api_key in self.claves_api:
+            return f"key:{api_key}"
+        cliente = scope.get("client")
+        return f"ip:{cliente[0] if cliente else 'desconocido'}"
+
+    def admitir(self, scope) -> Tuple[Optional[GrupoRutas], Optional[JSONResponse]]:
+        """Devuelve el grupo admitido, o la respuesta 429/503 con la que rechazar la petición"""
+        grupo = self._grupo(scope["method"], scope["path"])
+
+        # Las rutas prioritarias tienen su propio cubo: el tráfico de lectura no agota el de reservas
+        cliente = self._cliente(scope) + (":prioritario" if grupo.prioritario else "")
+        espera = self.limitador.consumir(cliente, grupo.coste)
+        if espera:
+            with self._lock:
+                grupo.rechazadas_429 += 1
+            return None, JSONResponse(
+                {"detail": "Demasiadas peticiones, inténtelo más tarde"},
+                status_code=429,
+                headers={"Retry-After": str(math.ceil(espera))}
+            )
+
+        with self._lock:
+            lleno_grupo = grupo.max_concurrencia is not None and grupo.en_curso >= grupo.max_concurrencia
+            lleno_global = not grupo.prioritario and self.en_curso >= self.max_concurrencia
+            if lleno_grupo or lleno_global:
+                grupo.rechazadas_503 += 1
+                return None, JSONResponse(
+                    {"detail": "Servicio saturado, inténtelo más tarde"},
+                    status_code=503,
+                    headers={"Retry-After": "1"}
+                )
+            grupo.en_curso += 1
+            grupo.admitidas += 1
+            if not grupo.prioritario:
+                self.en_curso += 1
+        return grupo, None
+
+    def liberar(self, grupo: GrupoRutas):
+        with self._lock:
+            grupo.en_curso -= 1
+            if not grupo.prioritario:
+                self.en_curso -= 1
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            return {
+                "en_curso": self.en_curso,
+                "max_concurrencia": self.max_concurrencia,
+                "grupos": {
+                    grupo.nombre: {
+                        "en_curso": grupo.en_curso,
+                        "max_concurrencia": grupo.max_concurrencia,
+                        "admitidas": grupo.admitidas,
+                        "rechazadas_429": grupo.rechazadas_429,
+                        "rechazadas_503": grupo.rechazadas_503,
+                    }
+                    for grupo in [*self.grupos, self.general]
+                },
+            }
+
+
+class AdmisionMiddleware:
+    """Middleware ASGI que aplica un ControlAdmision antes de llegar a los endpoints"""
+
+    def __init__(self, app, control: ControlAdmision):
+        self.app = app
+        self.control = control
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.control.exentas:
+            await self.app(scope, receive, send)
+            return
+
+        grupo, rechazo = self.control.admitir(scope)
+        if rechazo is not None:
+            await rechazo(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.control.liberar(grupo)
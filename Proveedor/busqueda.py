@@ -0,0 +1,113 @@
+import logging
+import re
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+# Índice FTS5 de alojamientos: rowid = listing. Los servicios (nombre + descripción) se
+# concatenan en una sola columna. prefix='2 3' precalcula los prefijos cortos del autocompletado.
+TABLA_FTS = "alojamientos_fts"
+
+SQL_CREAR_INDICE = f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {TABLA_FTS} USING fts5(
+        nombre, direccion, ciudad, servicios,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+"""
+
+SQL_DOCUMENTOS = """
+    SELECT a.listing, a.nombre, a.direccion, a.ciudad, (
+        SELECT group_concat(coalesce(s.name, '') || ' ' || coalesce(s.description, ''), ' ')
+        FROM listing_services s
+        WHERE s.listing_id = a.listing
+    )
+    FROM alojamientos a
+"""
+
+# Pesos bm25 por columna (nombre, direccion, ciudad, servicios)
+PESOS = (10.0, 2.0, 5.0, 1.0)
+
+_disponible: Optional[bool] = None
+
+
+def crear_indice(conn):
+    """Crea el índice si hace falta y lo llena la primera vez. Sin FTS5 en SQLite la búsqueda queda desactivada"""
+    global _disponible
+    try:
+        conn.exec_driver_sql(SQL_CREAR_INDICE)
+    except OperationalError as e:
+        logging.warning(f"Búsqueda de texto desactivada, SQLite sin FTS5: {str(e)}")
+        _disponible = False
+        return
+    _disponible = True
+    if conn.exec_driver_sql(f"SELECT 1 FROM {TABLA_FTS} LIMIT 1").first() is None:
+        conn.exec_driver_sql(f"INSERT INTO {TABLA_FTS} (rowid, nombre, direccion, ciudad, servicios) {SQL_DOCUMENTOS}")
+
+
+def disponible(db) -> bool:
+    global _disponible
+    if _disponible is None:
+        _disponible = db.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :nombre"), {"nombre": TABLA_FTS}
+        ).first() is not None
+    return _disponible
+
+
+def indexar_listings(db, listing_ids: Iterable[int]):
+    """Reindexa estos alojamientos (datos + servicios) dentro de la transacción de la escritura"""
+    listing_ids = sorted(set(listing_ids))
+    if not listing_ids or not disponible(db):
+        return
+    db.flush()
+    parametros = {f"l{i}": listing_id for i, listing_id in enumerate(listing_ids)}
+    lista = ", ".join(f":{nombre}" for nombre in parametros)
+    db.execute(text(f"DELETE FROM {TABLA_FTS} WHERE rowid IN ({lista})"), parametros)
+    db.execute(
+        text(f"INSERT INTO {TABLA_FTS} (rowid, nombre, direccion, ciudad, servicios) {SQL_DOCUMENTOS} WHERE a.listing IN ({lista})"),
+        parametros
+    )
+
+
+def reconstruir(db):
+    if not disponible(db):
+        return
+    db.execute(text(f"DELETE FROM {TABLA_FTS}"))
+    db.execute(text(f"INSERT INTO {TABLA_FTS} (rowid, nombre, direccion, ciudad, servicios) {SQL_DOCUMENTOS}"))
+
+
+def consulta_fts(texto: str) -> Optional[str]:
+    """Convierte lo que escribe el usuario en una consulta FTS5 segura.
+
+    Cada palabra va entre comillas (sin operadores ni sintaxis FTS del usuario) y
+    todas deben aparecer; la última admite prefijo para el autocompletado.
+    """
+    palabras = re.findall(r"\w+", texto)
+    if not palabras:
+        return None
+    terminos = [f'"{palabra}"' for palabra in palabras]
+    terminos[-1] += "*"
+    return " ".join(terminos)
+
+
+def buscar(db, texto: str, limite: int = 20, solo_disponibles: bool = False) -> List[Tuple[int, float, str]]:
+    """(listing, puntuación, fragmento resaltado) ordenados por relevancia bm25"""
+    consulta = consulta_fts(texto)
+    if consulta is None:
+        return []
+    filtro = "AND a.disponible = 1" if solo_disponibles else ""
+    filas = db.execute(
+        text(f"""
+            SELECT f.rowid, bm25({TABLA_FTS}, {", ".join(str(p) for p in PESOS)}) AS rango,
+                   snippet({TABLA_FTS}, -1, '<b>', '</b>', '…', 8)
+            FROM {TABLA_FTS} f
+            JOIN alojamientos a ON a.listing = f.rowid
+            WHERE {TABLA_FTS} MATCH :consulta {filtro}
+            ORDER BY rango
+            LIMIT :limite
+        """),
+        {"consulta": consulta, "limite": limite}
+    ).all()
+    # bm25 es negativo (más negativo = más relevante); se devuelve positivo
+    return [(listing, -rango, fragmento) for listing, rango, fragmento in filas]
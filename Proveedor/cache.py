@@ -0,0 +1,214 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+
+class CacheLocal:
+    """Caché LRU en memoria del proceso, con caducidad opcional por entrada.
+
+    Cada worker tiene la suya; el BusInvalidacion se encarga de vaciar las
+    entradas afectadas cuando otro worker escribe.
+    """
+
+    def __init__(self, nombre: str, max_entradas: int = 1024, ttl: Optional[float] = None):
+        self.nombre = nombre
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._datos: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.invalidaciones = 0
+
+    def obtener(self, clave, default=None):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None or (entrada[1] is not None and entrada[1] < time.monotonic()):
+                if entrada is not None:
+                    del self._datos[clave]
+                self.fallos += 1
+                return default
+            self._datos.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[0]
+
+    def guardar(self, clave, valor, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        caduca = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._datos[clave] = (valor, caduca)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def invalidar(self, clave=None):
+        """Elimina una clave, o toda la caché si no se indica ninguna"""
+        with self._lock:
+            self.invalidaciones += 1
+            if clave is None:
+                self._datos.clear()
+            else:
+                self._datos.pop(clave, None)
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            return {
+                "entradas": len(self._datos),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "invalidaciones": self.invalidaciones,
+            }
+
+
+class BusInvalidacion:
+    """Bus de invalidación entre workers respaldado por un fichero SQLite.
+
+    Cada escritura publica (canal, clave) en una tabla append-only; los demás
+    workers la leen periódicamente desde su último id visto y avisan a los
+    suscriptores locales de ese canal. Una clave None invalida el canal entero.
+    """
+
+    def __init__(self, ruta: str, intervalo: float = 0.5, retencion: float = 3600.0):
+        self.ruta = ruta
+        self.intervalo = intervalo
+        self.retencion = retencion
+        self.origen = f"{os.getpid()}-{id(self)}"
+        self._suscriptores: Dict[str, List[Callable[[Any], None]]] = {}
+        self._conexion: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._ultimo_id = 0
+        self._tarea: Optional[asyncio.Task] = None
+
+    def _conectar(self) -> sqlite3.Connection:
+        if self._conexion is None:
+            conexion = sqlite3.connect(self.ruta, check_same_thread=False, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA busy_timeout=5000")
+            conexion.execute("""
+                CREATE TABLE IF NOT EXISTS invalidaciones (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    canal TEXT NOT NULL,
+                    clave TEXT,
+                    origen TEXT NOT NULL,
+                    creado REAL NOT NULL
+                )
+            """)
+            conexion.execute("""
+                CREATE TABLE IF NOT EXISTS tareas (
+                    nombre TEXT PRIMARY KEY,
+                    origen TEXT NOT NULL,
+                    hasta REAL NOT NULL
+                )
+            """)
+            # Al arrancar las cachés están vacías: solo interesa lo que llegue a partir de ahora
+            self._ultimo_id = conexion.execute("SELECT COALESCE(MAX(id), 0) FROM invalidaciones").fetchone()[0]
+            self._conexion = conexion
+        return self._conexion
+
+    def suscribir(self, canal: str, callback: Callable[[Any], None]):
+        self._suscriptores.setdefault(canal, []).append(callback)
+
+    def _notificar(self, canal: str, clave):
+        for callback in self._suscriptores.get(canal, []):
+            try:
+                callback(clave)
+            except Exception as e:
+                logging.error(f"Error al invalidar canal {canal}: {str(e)}")
+
+    def publicar(self, canal: str, claves: Optional[Iterable[Any]] = None):
+        """Invalida las claves en este worker y las difunde al resto"""
+        claves = [None] if claves is None else list(claves)
+        for clave in claves:
+            self._notificar(canal, clave)
+
+        ahora = time.time()
+        filas = [(canal, None if clave is None else json.dumps(clave), self.origen, ahora) for clave in claves]
+        with self._lock:
+            self._conectar().executemany(
+                "INSERT INTO invalidaciones (canal, clave, origen, creado) VALUES (?, ?, ?, ?)",
+                filas
+            )
+
+    def sincronizar(self) -> int:
+        """Aplica las invalidaciones publicadas por otros workers desde la última lectura"""
+        with self._lock:
+            filas = self._conectar().execute(
+                "SELECT id, canal, clave, origen FROM invalidaciones WHERE id > ? ORDER BY id",
+                (self._ultimo_id,)
+            ).fetchall()
+            if filas:
+                self._ultimo_id = filas[-1][0]
+
+        aplicadas = 0
+        for _, canal, clave, origen in filas:
+            if origen == self.origen:
+                continue
+            self._notificar(canal, None if clave is None else json.loads(clave))
+            aplicadas += 1
+        return aplicadas
+
+    def reclamar_tarea(self, nombre: str, duracion: float) -> bool:
+        """Turno exclusivo entre workers para tareas programadas.
+
+        Devuelve True si este worker tiene (o renueva) el turno durante `duracion`
+        segundos; si el worker que lo tenía muere, el turno caduca y otro lo toma.
+        """
+        ahora = time.time()
+        with self._lock:
+            cursor = self._conectar().execute(
+                """
+                INSERT INTO tareas (nombre, origen, hasta) VALUES (?, ?, ?)
+                ON CONFLICT(nombre) DO UPDATE SET origen = excluded.origen, hasta = excluded.hasta
+                WHERE tareas.hasta < ? OR tareas.origen = ?
+                """,
+                (nombre, self.origen, ahora + duracion, ahora, self.origen)
+            )
+            return cursor.rowcount == 1
+
+    def liberar_tarea(self, nombre: str):
+        """Suelta el turno si lo tiene este worker (para turnos que duran lo que dura una ejecución)"""
+        with self._lock:
+            self._conectar().execute("DELETE FROM tareas WHERE nombre = ? AND origen = ?", (nombre, self.origen))
+
+    def purgar(self):
+        with self._lock:
+            self._conectar().execute(
+                "DELETE FROM invalidaciones WHERE creado < ?",
+                (time.time() - self.retencion,)
+            )
+
+    async def _bucle(self):
+        ultima_purga = time.monotonic()
+        while True:
+            try:
+                await asyncio.to_thread(self.sincronizar)
+                if time.monotonic() - ultima_purga > self.retencion:
+                    await asyncio.to_thread(self.purgar)
+                    ultima_purga = time.monotonic()
+            except Exception as e:
+                logging.error(f"Error en el bus de invalidación: {str(e)}")
+            await asyncio.sleep(self.intervalo)
+
+    def iniciar(self):
+        self._conectar()
+        if self._tarea is None:
+            self._tarea = asyncio.get_running_loop().create_task(self._bucle())
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+        with self._lock:
+            if self._conexion is not None:
+                self._conexion.close()
+                self._conexion = None
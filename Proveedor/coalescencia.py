@@ -0,0 +1,83 @@
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from cache import CacheLocal
+
+_SIN_VALOR = object()
+
+
+class SingleFlight:
+    """Coalescencia de peticiones idénticas concurrentes ("single-flight").
+
+    La primera petición con una clave calcula el resultado; las que llegan
+    mientras tanto esperan ese mismo Future en lugar de repetir el cálculo.
+    El resultado se guarda además unos segundos (`ttl`) para las repeticiones
+    casi simultáneas. Las claves llevan la generación del alojamiento, así que
+    invalidar un alojamiento deja inalcanzables sus resultados anteriores.
+    """
+
+    def __init__(self, nombre: str, ttl: float = 2.0, max_entradas: int = 10000):
+        self.resultados = CacheLocal(nombre, max_entradas=max_entradas, ttl=ttl)
+        self._en_curso: Dict[Hashable, Future] = {}
+        self._generaciones: Dict[Any, int] = {}
+        self._lock = threading.Lock()
+        self.calculos = 0
+        self.coalescidas = 0
+
+    def invalidar(self, listing_id=None):
+        with self._lock:
+            if listing_id is None:
+                # Invalidación global: se cambian todas las generaciones a la vez
+                self._generaciones["*"] = self._generaciones.get("*", 0) + 1
+            else:
+                self._generaciones[listing_id] = self._generaciones.get(listing_id, 0) + 1
+
+    def _clave(self, listing_id, parametros: Tuple) -> Hashable:
+        # Solo se lee: los ids que llegan en las peticiones no crean entradas (solo invalidar las crea)
+        return (listing_id, self._generaciones.get("*", 0), self._generaciones.get(listing_id, 0), parametros)
+
+    def ejecutar(self, listing_id, parametros: Tuple, funcion: Callable[[], Any]):
+        with self._lock:
+            clave = self._clave(listing_id, parametros)
+
+        resultado = self.resultados.obtener(clave, _SIN_VALOR)
+        if resultado is not _SIN_VALOR:
+            return resultado
+
+        with self._lock:
+            futuro = self._en_curso.get(clave)
+            lider = futuro is None
+            if lider:
+                futuro = Future()
+                self._en_curso[clave] = futuro
+                self.calculos += 1
+            else:
+                self.coalescidas += 1
+
+        if not lider:
+            # Propaga el resultado o la excepción (p. ej. HTTPException) del líder
+            return futuro.result()
+
+        try:
+            resultado = funcion()
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        else:
+            self.resultados.guardar(clave, resultado)
+            futuro.set_result(resultado)
+            return resultado
+        finally:
+            with self._lock:
+                del self._en_curso[clave]
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            en_curso = len(self._en_curso)
+        return {
+            "calculos": self.calculos,
+            "coalescidas": self.coalescidas,
+            "en_curso": en_curso,
+            "cache": self.resultados.estadisticas(),
+        }
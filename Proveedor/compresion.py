@@ -0,0 +1,114 @@
+import gzip
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+# zstd es opcional: si la librería no está instalada solo se negocia gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Tipos que ya van comprimidos y no ganan nada al volver a comprimirse
+TIPOS_NO_COMPRIMIBLES = (
+    "image/",
+    "application/vnd.apache.parquet",
+    "application/zstd",
+    "application/gzip",
+)
+
+
+def elegir_codificacion(accept_encoding: str) -> Optional[str]:
+    """Devuelve la mejor codificación soportada según la cabecera Accept-Encoding"""
+    aceptadas = {}
+    for parte in accept_encoding.split(","):
+        trozos = [t.strip() for t in parte.split(";")]
+        nombre = trozos[0].lower()
+        if not nombre:
+            continue
+        calidad = 1.0
+        for parametro in trozos[1:]:
+            if parametro.startswith("q="):
+                try:
+                    calidad = float(parametro[2:])
+                except ValueError:
+                    calidad = 0.0
+        aceptadas[nombre] = calidad
+
+    candidatas = []
+    if zstandard is not None:
+        candidatas.append("zstd")
+    candidatas.append("gzip")
+
+    mejor, mejor_calidad = None, 0.0
+    for codificacion in candidatas:
+        calidad = aceptadas.get(codificacion, aceptadas.get("*", 0.0))
+        if calidad > mejor_calidad:
+            mejor, mejor_calidad = codificacion, calidad
+    return mejor
+
+
+def comprimir(cuerpo: bytes, codificacion: str, nivel_gzip: int = 6, nivel_zstd: int = 3) -> bytes:
+    if codificacion == "zstd":
+        return zstandard.ZstdCompressor(level=nivel_zstd).compress(cuerpo)
+    return gzip.compress(cuerpo, compresslevel=nivel_gzip)
+
+
+class CompresionMiddleware:
+    """Middleware ASGI que comprime las respuestas con zstd o gzip según Accept-Encoding.
+
+    Las respuestas de esta API no son streaming, así que se acumula el cuerpo
+    completo y se comprime de una vez por encima de ``minimum_size`` bytes.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, nivel_gzip: int = 6, nivel_zstd: int = 3):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.nivel_gzip = nivel_gzip
+        self.nivel_zstd = nivel_zstd
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        codificacion = elegir_codificacion(Headers(scope=scope).get("accept-encoding", ""))
+        if codificacion is None:
+            await self.app(scope, receive, send)
+            return
+
+        inicio = None
+        pasar = False
+        partes = []
+
+        async def enviar(message):
+            nonlocal inicio, pasar
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                tipo = headers.get("content-type", "")
+                if "content-encoding" in headers or tipo.startswith(TIPOS_NO_COMPRIMIBLES):
+                    pasar = True
+                    await send(message)
+                else:
+                    inicio = message
+                return
+
+            if pasar or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            partes.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            cuerpo = b"".join(partes)
+            headers = MutableHeaders(raw=inicio["headers"])
+            if len(cuerpo) >= self.minimum_size:
+                cuerpo = comprimir(cuerpo, codificacion, self.nivel_gzip, self.nivel_zstd)
+                headers["Content-Encoding"] = codificacion
+                headers.add_vary_header("Accept-Encoding")
+            headers["Content-Length"] = str(len(cuerpo))
+            await send(inicio)
+            await send({"type": "http.response.body", "body": cuerpo})
+
+        await self.app(scope, receive, enviar)
@@ -0,0 +1,197 @@
+import itertools
+import os
+import threading
+from typing import Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker, Session
+
+import busqueda
+from models import Base, ImageUrl, SQL_DIA, SQL_VISTA_RESERVAS, hash_url
+
+# 📌 Configuración de SQLite
+# El engine se crea la primera vez que se usa, no al importar: los scripts, los tests y
+# cada worker solo pagan la conexión (y el esquema, ver preparar_esquema) cuando la necesitan.
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./proveedor.db")
+
+_engine: Optional[Engine] = None
+_lock_engine = threading.Lock()
+
+# WAL + busy_timeout para que varios workers puedan leer y escribir a la vez sobre el mismo fichero.
+# auto_vacuum va antes: solo tiene efecto en un fichero nuevo (las bases de datos que ya existen
+# se convierten con el VACUUM del mantenimiento, ver mantenimiento.py)
+def _configurar_sqlite(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+def get_engine() -> Engine:
+    global _engine
+    if _engine is None:
+        with _lock_engine:
+            if _engine is None:
+                engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+                event.listen(engine, "connect", _configurar_sqlite)
+                _engine = engine
+    return _engine
+
+
+class _FabricaSesiones:
+    """Como sessionmaker, pero ligado al engine perezoso: SessionLocal() crea el engine si aún no existe"""
+
+    def __init__(self, crear_engine):
+        self._crear_engine = crear_engine
+        self._fabrica = None
+
+    def __call__(self, **kwargs) -> Session:
+        if self._fabrica is None:
+            self._fabrica = sessionmaker(autocommit=False, autoflush=False, bind=self._crear_engine())
+        return self._fabrica(**kwargs)
+
+
+SessionLocal = _FabricaSesiones(get_engine)
+
+# 📌 Réplicas de lectura (solo lectura, round-robin; también se crean al primer uso)
+REPLICA_DATABASE_URLS = [url.strip() for url in os.getenv("REPLICA_DATABASE_URLS", "").split(",") if url.strip()]
+
+_ciclo_replicas = None
+_lock_replicas = threading.Lock()
+
+def sesion_replica() -> Session:
+    global _ciclo_replicas
+    with _lock_replicas:
+        if _ciclo_replicas is None:
+            _ciclo_replicas = itertools.cycle([
+                _FabricaSesiones(lambda url=url: create_engine(url, connect_args={"check_same_thread": False}))
+                for url in REPLICA_DATABASE_URLS
+            ])
+        fabrica = next(_ciclo_replicas)
+    return fabrica()
+
+# 📌 Migraciones ligeras: create_all no añade columnas nuevas a tablas que ya existen
+def _ddl_dia(columna: str) -> str:
+    return f"INTEGER GENERATED ALWAYS AS ({SQL_DIA.format(columna)}) VIRTUAL"
+
+COLUMNAS_NUEVAS = {
+    "alojamientos": {
+        "version": "INTEGER DEFAULT 0",
+    },
+    "images": {
+        "url_id": "INTEGER REFERENCES image_urls(id)",
+    },
+    "seasonal_prices": {
+        "priority": "INTEGER DEFAULT 0",
+        "weekend_modifier": "FLOAT DEFAULT 1.0",
+        "min_stay": "INTEGER DEFAULT 1",
+        "extra_occupant_price": "FLOAT DEFAULT 0.0",
+        "dia_inicio": _ddl_dia("start_date"),
+        "dia_fin": _ddl_dia("end_date"),
+    },
+    "reservas": {
+        "dia_entrada": _ddl_dia("fecha_entrada"),
+        "dia_salida": _ddl_dia("fecha_salida"),
+    },
+}
+
+# Índices sustituidos por otros (p. ej. sobre los números de día en lugar de las fechas en texto)
+INDICES_OBSOLETOS = ("ix_reservas_listing_salida", "ix_seasonal_prices_listing_fin")
+
+# 📌 Versión de los alojamientos mantenida por la propia base de datos
+# alojamientos.version valida el LOS precalculado, los tokens de cotización y las tarifas en caché.
+# Solo la suben estos triggers, escriba quien escriba (endpoints o scripts de carga como
+# scriptInsertarPrecios.py y generarAlojamientos.py): una vez por fila de precios, descuentos o
+# reservas que cambia, y en los cambios de ocupantes/disponibilidad. Mover una reserva terminada a
+# reservas_historicas (archivar_reservas, que la copia antes de borrarla) no cambia la disponibilidad
+# y no la sube.
+_SQL_SUBIR_VERSION = "UPDATE alojamientos SET version = COALESCE(version, 0) + 1 WHERE listing = {}.{};"
+
+def _triggers_version(tabla: str, columna: str, condicion_borrado: str = "") -> list:
+    return [
+        (f"tr_version_{tabla}_insert", f"AFTER INSERT ON {tabla} BEGIN {_SQL_SUBIR_VERSION.format('NEW', columna)} END"),
+        (f"tr_version_{tabla}_delete", f"AFTER DELETE ON {tabla} {condicion_borrado} BEGIN {_SQL_SUBIR_VERSION.format('OLD', columna)} END"),
+        (
+            f"tr_version_{tabla}_update",
+            f"AFTER UPDATE ON {tabla} "
+            f"BEGIN {_SQL_SUBIR_VERSION.format('OLD', columna)} {_SQL_SUBIR_VERSION.format('NEW', columna)} END"
+        ),
+    ]
+
+# (nombre, definición)
+TRIGGERS_VERSION = [
+    *_triggers_version("seasonal_prices", "listing"),
+    *_triggers_version("listing_los_discounts", "listing_id"),
+    *_triggers_version(
+        "reservas", "listing_id",
+        "WHEN NOT EXISTS (SELECT 1 FROM reservas_historicas h WHERE h.localizador = OLD.localizador)"
+    ),
+    (
+        "tr_version_alojamientos_update",
+        "AFTER UPDATE OF occupants, disponible ON alojamientos WHEN NEW.version IS OLD.version "
+        f"BEGIN {_SQL_SUBIR_VERSION.format('NEW', 'listing')} END"
+    ),
+]
+
+def _migrar_imagenes(conn):
+    """Pasa las URLs que aún están en images.link a image_urls (una fila por URL distinta)"""
+    if "link" not in {fila[1] for fila in conn.exec_driver_sql("PRAGMA table_info(images)")}:
+        return
+    links = [fila[0] for fila in conn.exec_driver_sql(
+        "SELECT DISTINCT link FROM images WHERE url_id IS NULL AND link IS NOT NULL"
+    )]
+    if not links:
+        return
+    hashes = {link: hash_url(link) for link in links}
+    conn.execute(
+        sqlite_insert(ImageUrl).on_conflict_do_nothing(index_elements=["hash"]),
+        [{"hash": hash_link, "url": link} for link, hash_link in hashes.items()]
+    )
+    # image_urls.url no tiene índice: se busca cada id por hash y el UPDATE cruza con una tabla
+    # temporal indexada por link, en lugar de una subconsulta que recorre image_urls por fila
+    ids = {}
+    hashes_lista = list(hashes.values())
+    for i in range(0, len(hashes_lista), 500):
+        lote = hashes_lista[i:i + 500]
+        ids.update(conn.exec_driver_sql(
+            f"SELECT hash, id FROM image_urls WHERE hash IN ({', '.join('?' * len(lote))})", tuple(lote)
+        ).all())
+    conn.exec_driver_sql("CREATE TEMP TABLE migracion_imagenes (link TEXT PRIMARY KEY, url_id INTEGER NOT NULL)")
+    conn.exec_driver_sql(
+        "INSERT INTO migracion_imagenes (link, url_id) VALUES (?, ?)",
+        [(link, ids[hash_link]) for link, hash_link in hashes.items()]
+    )
+    conn.exec_driver_sql(
+        "UPDATE images SET url_id = (SELECT url_id FROM migracion_imagenes m WHERE m.link = images.link), link = NULL "
+        "WHERE url_id IS NULL AND link IS NOT NULL"
+    )
+    conn.exec_driver_sql("DROP TABLE migracion_imagenes")
+
+def preparar_esquema():
+    """Crea las tablas que falten y aplica las migraciones ligeras (al arrancar la app o desde los scripts)"""
+    Base.metadata.create_all(bind=get_engine())
+    with get_engine().begin() as conn:
+        for tabla, columnas in COLUMNAS_NUEVAS.items():
+            # table_xinfo también lista las columnas generadas
+            existentes = {fila[1] for fila in conn.exec_driver_sql(f"PRAGMA table_xinfo({tabla})")}
+            for columna, ddl in columnas.items():
+                if columna not in existentes:
+                    conn.exec_driver_sql(f"ALTER TABLE {tabla} ADD COLUMN {columna} {ddl}")
+        _migrar_imagenes(conn)
+        # Índices declarados en los modelos que una base de datos antigua todavía no tiene
+        for indice in INDICES_OBSOLETOS:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {indice}")
+        for tabla in Base.metadata.tables.values():
+            for indice in tabla.indexes:
+                indice.create(bind=conn, checkfirst=True)
+        conn.exec_driver_sql(
+            "CREATE VIEW IF NOT EXISTS reservas_todas AS "
+            + str(SQL_VISTA_RESERVAS.compile(conn, compile_kwargs={"literal_binds": True}))
+        )
+        # Se recrean siempre para que una base de datos existente tenga la definición actual
+        for nombre, definicion in TRIGGERS_VERSION:
+            conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {nombre}")
+            conn.exec_driver_sql(f"CREATE TRIGGER {nombre} {definicion}")
+        busqueda.crear_indice(conn)
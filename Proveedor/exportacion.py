@@ -0,0 +1,73 @@
+import datetime
+from typing import Iterable, List, Optional, Tuple
+
+# pyarrow es opcional: sin él solo se sirven las respuestas JSON
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+TIPO_ARROW = "application/vnd.apache.arrow.stream"
+TIPO_PARQUET = "application/vnd.apache.parquet"
+
+FORMATOS = {
+    "arrow": TIPO_ARROW,
+    "parquet": TIPO_PARQUET,
+}
+
+
+def negociar_formato(formato: Optional[str], accept: str) -> str:
+    """Elige 'json', 'arrow' o 'parquet' a partir del parámetro ?formato= o de la cabecera Accept"""
+    if formato:
+        return formato.lower()
+    for nombre, tipo in FORMATOS.items():
+        if tipo in accept:
+            return nombre
+    return "json"
+
+
+def soporta_binario() -> bool:
+    return pa is not None
+
+
+def serializar_tabla(tabla, formato: str) -> bytes:
+    """Escribe la tabla en un stream Arrow IPC o Parquet y devuelve los bytes"""
+    sink = pa.BufferOutputStream()
+    if formato == "parquet":
+        pq.write_table(tabla, sink, compression="zstd")
+    else:
+        with pa.ipc.new_stream(sink, tabla.schema) as writer:
+            writer.write_table(tabla)
+    return sink.getvalue().to_pybytes()
+
+
+def tabla_los(filas: Iterable[Tuple[datetime.date, int, List[Optional[float]]]], max_noches: int = 17):
+    """Matriz LOS en columnas: fecha, ocupantes y la lista fija de precios de 1..max_noches noches (null si no se puede reservar)"""
+    fechas, ocupantes, precios = [], [], []
+    for fecha, num_ocupantes, precios_fila in filas:
+        fechas.append(fecha)
+        ocupantes.append(num_ocupantes)
+        precios.extend(precios_fila)
+
+    return pa.table({
+        "fecha": pa.array(fechas, type=pa.date32()),
+        "ocupantes": pa.array(ocupantes, type=pa.int16()),
+        "precios": pa.FixedSizeListArray.from_arrays(pa.array(precios, type=pa.float64()), max_noches),
+    })
+
+
+def tabla_alojamientos(alojamientos: List[dict]):
+    """Volcado de alojamientos en columnas a partir de sus diccionarios de respuesta"""
+    esquema = pa.schema([
+        ("listing", pa.int32()),
+        ("nombre", pa.string()),
+        ("direccion", pa.string()),
+        ("ciudad", pa.string()),
+        ("pais", pa.string()),
+        ("imagen_id", pa.int32()),
+        ("disponible", pa.bool_()),
+        ("occupants", pa.int16()),
+    ])
+    return pa.table({campo.name: [a.get(campo.name) for a in alojamientos] for campo in esquema}, schema=esquema)
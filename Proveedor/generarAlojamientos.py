@@ -1,17 +1,14 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import Session
 from faker import Faker
 import random
-from main import SessionLocal, Alojamiento, Image, ListingCommission, ListingService
+from database import SessionLocal, preparar_esquema
+from models import Alojamiento, Image, ListingCommission, ListingService, ids_urls
+import busqueda
+import resumenes
 
 # Inicializar Faker
 fake = Faker("es_ES")
 
-# Establecer conexión a la base de datos y crear SessionLocal
-DATABASE_URL = "sqlite:///./proveedor.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
 # Función para generar Alojamiento
 def generar_alojamiento(db: Session, cantidad: int):
     # Obtener el último 'listing' registrado
@@ -38,9 +35,10 @@ def generar_imagenes(db: Session, cantidad: int):
     alojamientos = db.query(Alojamiento).all()
     for _ in range(cantidad):
         alojamiento = random.choice(alojamientos)
+        link = fake.image_url()
         imagen = Image(
             listing_id=alojamiento.listing,
-            link=fake.image_url()
+            url_id=ids_urls(db, [link])[link]
         )
         db.add(imagen)
     db.commit()
@@ -76,10 +74,14 @@ def generar_datos(db: Session, cantidad: int):
     #generar_imagenes(db, cantidad)
     generar_comisiones(db, cantidad)
     generar_servicios(db, cantidad)
+    resumenes.reconstruir(db)
+    busqueda.reconstruir(db)
+    db.commit()
     #print(f"{cantidad} registros generados exitosamente.")
 
 # Llamada a la función para generar datos
 if __name__ == "__main__":
+    preparar_esquema()
     db = SessionLocal()  # Iniciar una sesión de base de datos
     generar_datos(db, 500)  # Generar 500 registros por cada tabla
     db.close()  # Cerrar la sesión de base de datos
@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+
+CABECERA = "idempotency-key"
+MAX_LONGITUD_CLAVE = 255
+
+# Cabeceras de la respuesta original que se repiten al devolverla desde el almacén
+CABECERAS_GUARDADAS = ("content-type", "location", "set-cookie")
+
+# Además de las 2xx solo se guardan los errores de validación, que se repetirían igual; el resto
+# (409 "vuelva a cotizar", 429, 5xx...) libera la clave para que el reintento se ejecute de nuevo
+ESTADOS_ERROR_GUARDADOS = (400, 404, 422)
+
+
+def _se_guarda(estado: int) -> bool:
+    return 200 <= estado < 300 or estado in ESTADOS_ERROR_GUARDADOS
+
+
+class AlmacenIdempotencia:
+    """Respuestas ya enviadas por (ruta, Idempotency-Key), compartidas por todos los workers.
+
+    Un fichero SQLite con una fila por clave: la huella de la petición (método, ruta
+    y cuerpo) y, cuando termina, el estado, cabeceras y cuerpo de la respuesta. La
+    fila se crea antes de ejecutar la petición ("en curso") para que dos reintentos
+    simultáneos no escriban dos veces. Caducan a los `ttl` segundos y nunca hay más
+    de `max_entradas` (se descartan las más antiguas).
+    """
+
+    def __init__(self, ruta: str, ttl: float = 24 * 3600, max_entradas: int = 100000, en_curso_max: float = 60.0):
+        self.ruta = ruta
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.en_curso_max = en_curso_max
+        self._conexion: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._insertadas = 0
+        self.reservadas = 0
+        self.repetidas = 0
+        self.conflictos = 0
+
+    def _conectar(self) -> sqlite3.Connection:
+        if self._conexion is None:
+            conexion = sqlite3.connect(self.ruta, check_same_thread=False, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA busy_timeout=5000")
+            conexion.execute("""
+                CREATE TABLE IF NOT EXISTS respuestas (
+                    clave TEXT PRIMARY KEY,
+                    huella TEXT NOT NULL,
+                    estado INTEGER,
+                    cabeceras TEXT,
+                    cuerpo BLOB,
+                    creado REAL NOT NULL,
+                    expira REAL NOT NULL
+                )
+            """)
+            conexion.execute("CREATE INDEX IF NOT EXISTS ix_respuestas_creado ON respuestas (creado)")
+            self._conexion = conexion
+        return self._conexion
+
+    def reservar(self, clave: str, huella: str) -> Tuple[str, Optional[tuple]]:
+        """('nueva', None) si esta petición debe ejecutarse; si no ('repetida', (estado, cabeceras, cuerpo)),
+        ('en_curso', None) u ('otra_peticion', None) si la clave se usó con otro cuerpo"""
+        ahora = time.time()
+        with self._lock:
+            conexion = self._conectar()
+            # Las filas caducadas, y las "en curso" de un worker que murió, no bloquean la clave
+            conexion.execute(
+                "DELETE FROM respuestas WHERE clave = ? AND (expira < ? OR (estado IS NULL AND creado < ?))",
+                (clave, ahora, ahora - self.en_curso_max)
+            )
+            cursor = conexion.execute(
+                "INSERT OR IGNORE INTO respuestas (clave, huella, creado, expira) VALUES (?, ?, ?, ?)",
+                (clave, huella, ahora, ahora + self.ttl)
+            )
+            if cursor.rowcount == 1:
+                self.reservadas += 1
+                self._insertadas += 1
+                if self._insertadas % 1000 == 0:
+                    self._purgar(conexion, ahora)
+                return "nueva", None
+            fila = conexion.execute(
+                "SELECT huella, estado, cabeceras, cuerpo FROM respuestas WHERE clave = ?", (clave,)
+            ).fetchone()
+
+        if fila is None:
+            return self.reservar(clave, huella)
+        guardada, estado, cabeceras, cuerpo = fila
+        if guardada != huella:
+            self.conflictos += 1
+            return "otra_peticion", None
+        if estado is None:
+            self.conflictos += 1
+            return "en_curso", None
+        self.repetidas += 1
+        return "repetida", (estado, json.loads(cabeceras), cuerpo)
+
+    def guardar(self, clave: str, estado: int, cabeceras: Iterable[Tuple[str, str]], cuerpo: bytes):
+        with self._lock:
+            self._conectar().execute(
+                "UPDATE respuestas SET estado = ?, cabeceras = ?, cuerpo = ? WHERE clave = ?",
+                (estado, json.dumps(list(cabeceras)), cuerpo, clave)
+            )
+
+    def liberar(self, clave: str):
+        """La petición falló sin respuesta definitiva: un reintento podrá ejecutarse de nuevo"""
+        with self._lock:
+            self._conectar().execute("DELETE FROM respuestas WHERE clave = ? AND estado IS NULL", (clave,))
+
+    def _purgar(self, conexion: sqlite3.Connection, ahora: float):
+        conexion.execute("DELETE FROM respuestas WHERE expira < ?", (ahora,))
+        conexion.execute(
+            """
+            DELETE FROM respuestas WHERE clave IN (
+                SELECT clave FROM respuestas ORDER BY creado DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entradas,)
+        )
+
+    def purgar(self):
+        with self._lock:
+            self._purgar(self._conectar(), time.time())
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            entradas = self._conectar().execute("SELECT COUNT(*) FROM respuestas").fetchone()[0]
+        return {
+            "entradas": entradas,
+            "max_entradas": self.max_entradas,
+            "ttl": self.ttl,
+            "ejecutadas": self.reservadas,
+            "repetidas": self.repetidas,
+            "conflictos": self.conflictos,
+        }
+
+
+class IdempotenciaMiddleware:
+    """Middleware ASGI: las peticiones con Idempotency-Key a `rutas` se ejecutan una sola vez.
+
+    Un reintento con la misma clave y el mismo cuerpo recibe la respuesta guardada
+    (con la cabecera Idempotency-Replayed); con otro cuerpo, 422; si la primera
+    aún se está ejecutando, 409. Solo se guardan las respuestas 2xx y los errores de
+    validación (400, 404, 422); con cualquier otra el reintento vuelve a ejecutarse.
+    Las claves son de cada cliente (X-API-Key o, sin ella, IP): dos clientes no chocan
+    con la misma.
+    """
+
+    def __init__(self, app, almacen: AlmacenIdempotencia, rutas: Iterable[Tuple[str, str]]):
+        self.app = app
+        self.almacen = almacen
+        self.rutas = set(rutas)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in self.rutas:
+            await self.app(scope, receive, send)
+            return
+        clave = Headers(scope=scope).get(CABECERA)
+        if clave is None:
+            await self.app(scope, receive, send)
+            return
+        if not clave or len(clave) > MAX_LONGITUD_CLAVE:
+            await JSONResponse({"detail": "Idempotency-Key no válida"}, status_code=400)(scope, receive, send)
+            return
+
+        # Se lee el cuerpo entero para la huella y luego se le vuelve a entregar a la app
+        partes = []
+        while True:
+            mensaje = await receive()
+            if mensaje["type"] != "http.request":
+                break
+            partes.append(mensaje.get("body", b""))
+            if not mensaje.get("more_body", False):
+                break
+        cuerpo_peticion = b"".join(partes)
+        huella = hashlib.sha256(f"{scope['method']} {scope['path']}\n".encode() + cuerpo_peticion).hexdigest()
+        clave_ruta = f"{self._cliente(scope)} {scope['method']} {scope['path']} {clave}"
+
+        resultado, guardada = await asyncio.to_thread(self.almacen.reservar, clave_ruta, huella)
+        if resultado == "repetida":
+            estado, cabeceras, cuerpo = guardada
+            await send({
+                "type": "http.response.start",
+                "status": estado,
+                "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in cabeceras]
+                + [(b"idempotency-replayed", b"true"), (b"content-length", str(len(cuerpo)).encode())],
+            })
+            await send({"type": "http.response.body", "body": cuerpo})
+            return
+        if resultado == "en_curso":
+            await JSONResponse(
+                {"detail": "Hay una petición con esta Idempotency-Key en curso"}, status_code=409, headers={"Retry-After": "1"}
+            )(scope, receive, send)
+            return
+        if resultado == "otra_peticion":
+            await JSONResponse(
+                {"detail": "La Idempotency-Key ya se usó con otra petición"}, status_code=422
+            )(scope, receive, send)
+            return
+
+        entregado = False
+
+        async def recibir():
+            nonlocal entregado
+            if not entregado:
+                entregado = True
+                return {"type": "http.request", "body": cuerpo_peticion, "more_body": False}
+            return await receive()
+
+        inicio = None
+        respuesta = []
+        terminada = False
+
+        async def enviar(mensaje):
+            nonlocal inicio, terminada
+            if mensaje["type"] == "http.response.start":
+                inicio = mensaje
+            elif mensaje["type"] == "http.response.body":
+                respuesta.append(mensaje.get("body", b""))
+                if not mensaje.get("more_body", False):
+                    # Se guarda al terminar la respuesta, sin esperar a las BackgroundTasks (p. ej.
+                    # los webhooks): un reintento a partir de aquí ya recibe la respuesta guardada
+                    terminada = True
+                    await self._guardar(clave_ruta, inicio, b"".join(respuesta))
+            await send(mensaje)
+
+        try:
+            await self.app(scope, recibir, enviar)
+        except Exception:
+            if not terminada:
+                await asyncio.to_thread(self.almacen.liberar, clave_ruta)
+            raise
+        if not terminada:
+            await asyncio.to_thread(self.almacen.liberar, clave_ruta)
+
+    @staticmethod
+    def _cliente(scope) -> str:
+        api_key = Headers(scope=scope).get("x-api-key")
+        if api_key:
+            return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:32]
+        cliente = scope.get("client")
+        return f"ip:{cliente[0] if cliente else 'desconocido'}"
+
+    async def _guardar(self, clave_ruta: str, inicio: Optional[dict], cuerpo: bytes):
+        try:
+            if inicio is None or not _se_guarda(inicio["status"]):
+                await asyncio.to_thread(self.almacen.liberar, clave_ruta)
+                return
+            cabeceras = [
+                (k.decode("latin-1"), v.decode("latin-1"))
+                for k, v in inicio.get("headers", [])
+                if k.decode("latin-1").lower() in CABECERAS_GUARDADAS
+            ]
+            await asyncio.to_thread(self.almacen.guardar, clave_ruta, inicio["status"], cabeceras, cuerpo)
+        except Exception as e:
+            logging.error(f"No se ha podido guardar la respuesta idempotente: {str(e)}")
@@ -0,0 +1,347 @@
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional, Tuple
+
+import httpx
+
+# Pillow es opcional: sin él se sirve siempre la imagen original
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+ANCHOS_MINIATURA = (160, 320, 640, 1280)
+
+# Formatos que se conservan al redimensionar; el resto se guarda como JPEG
+FORMATOS_MINIATURA = {
+    "JPEG": ("jpg", "image/jpeg"),
+    "PNG": ("png", "image/png"),
+    "WEBP": ("webp", "image/webp"),
+}
+
+
+# Solo se descargan URLs http(s) a hosts públicos, comprobando cada redirección
+ESQUEMAS_PERMITIDOS = ("http", "https")
+MAX_REDIRECCIONES = 5
+# Hosts que se aceptan aunque no sean públicos (un servidor de imágenes interno, uno local en pruebas...),
+# separados por comas; cuentan tanto para el nombre de la URL como para sus IP literales
+HOSTS_PERMITIDOS = frozenset(
+    host.strip().lower().rstrip(".") for host in os.getenv("IMAGENES_HOSTS_PERMITIDOS", "").split(",") if host.strip()
+)
+
+
+class ErrorImagen(Exception):
+    """La imagen remota no se ha podido descargar o no es una imagen válida"""
+
+
+def _ip_publica(ip: str) -> bool:
+    direccion = ipaddress.ip_address(ip.split("%")[0])
+    if getattr(direccion, "ipv4_mapped", None):
+        direccion = direccion.ipv4_mapped
+    return direccion.is_global and not direccion.is_multicast
+
+
+def _normalizar_host(host: str) -> str:
+    return host.lower().rstrip(".")
+
+
+def comprobar_url(url, hosts_permitidos: frozenset = HOSTS_PERMITIDOS) -> httpx.URL:
+    """La URL como httpx.URL si es http(s) con un host que puede ser público (sin resolver DNS) o
+    está en `hosts_permitidos`; si no, ErrorImagen"""
+    try:
+        destino = httpx.URL(url)
+    except (httpx.InvalidURL, TypeError) as e:
+        raise ErrorImagen(f"URL de imagen no válida: {str(e)}")
+    if destino.scheme not in ESQUEMAS_PERMITIDOS:
+        raise ErrorImagen("Solo se admiten URLs de imagen http y https")
+    host = _normalizar_host(destino.host)
+    if host and host in hosts_permitidos:
+        return destino
+    if not host or host == "localhost" or host.endswith(".localhost"):
+        raise ErrorImagen("La URL de la imagen no apunta a un host público")
+    try:
+        publica = _ip_publica(host)
+    except ValueError:
+        return destino
+    if not publica:
+        raise ErrorImagen("La URL de la imagen no apunta a un host público")
+    return destino
+
+
+def resolver_publica(destino: httpx.URL, hosts_permitidos: frozenset = HOSTS_PERMITIDOS) -> str:
+    """IP a la que conectarse para `destino`; ErrorImagen si alguna de sus direcciones no es pública
+    (salvo que el host o esa IP estén en `hosts_permitidos`)"""
+    puerto = destino.port or (443 if destino.scheme == "https" else 80)
+    try:
+        direcciones = socket.getaddrinfo(destino.host, puerto, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ErrorImagen(f"No se ha podido resolver el host de la imagen: {str(e)}")
+    ips = [direccion[4][0].split("%")[0] for direccion in direcciones]
+    if not ips:
+        raise ErrorImagen("La URL de la imagen no apunta a un host público")
+    if _normalizar_host(destino.host) in hosts_permitidos:
+        return ips[0]
+    if not all(ip in hosts_permitidos or _ip_publica(ip) for ip in ips):
+        raise ErrorImagen("La URL de la imagen no apunta a un host público")
+    return ips[0]
+
+
+def soporta_miniaturas() -> bool:
+    return PILImage is not None
+
+
+class CacheImagenes:
+    """Caché en disco de imágenes remotas, direccionada por contenido.
+
+    Cada imagen se descarga una sola vez y se guarda como <sha256 del contenido>;
+    las miniaturas se generan bajo demanda junto al original. Un índice SQLite en
+    el mismo directorio (compartido por todos los workers) guarda qué URL
+    corresponde a cada contenido y cuándo se usó cada fichero por última vez,
+    para desalojar los menos usados cuando se supera `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        directorio: str,
+        max_bytes: int = 512 * 1024 * 1024,
+        max_descarga: int = 10 * 1024 * 1024,
+        anchos: Tuple[int, ...] = ANCHOS_MINIATURA,
+        cliente: Optional[httpx.Client] = None,
+        hosts_permitidos: Optional[Iterable[str]] = None
+    ):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self.max_descarga = max_descarga
+        self.anchos = anchos
+        self._cliente = cliente
+        # Por defecto IMAGENES_HOSTS_PERMITIDOS; ver comprobar_url
+        self.hosts_permitidos = HOSTS_PERMITIDOS if hosts_permitidos is None else frozenset(
+            _normalizar_host(host) for host in hosts_permitidos
+        )
+        self._conexion: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.descargas = 0
+        self.aciertos_miniatura = 0
+        self.miniaturas_generadas = 0
+        self.desalojados = 0
+
+    @property
+    def cliente(self) -> httpx.Client:
+        # Se crea al primer uso: construir el cliente (contexto TLS) no debe ralentizar el arranque
+        if self._cliente is None:
+            self._cliente = httpx.Client(timeout=10.0, follow_redirects=False)
+        return self._cliente
+
+    def _conectar(self) -> sqlite3.Connection:
+        if self._conexion is None:
+            os.makedirs(self.directorio, exist_ok=True)
+            conexion = sqlite3.connect(
+                os.path.join(self.directorio, "indice.db"),
+                check_same_thread=False,
+                isolation_level=None
+            )
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA busy_timeout=5000")
+            conexion.execute("""
+                CREATE TABLE IF NOT EXISTS urls (
+                    hash TEXT PRIMARY KEY,
+                    contenido TEXT NOT NULL,
+                    tipo TEXT NOT NULL
+                )
+            """)
+            conexion.execute("""
+                CREATE TABLE IF NOT EXISTS ficheros (
+                    nombre TEXT PRIMARY KEY,
+                    bytes INTEGER NOT NULL,
+                    accedido REAL NOT NULL
+                )
+            """)
+            conexion.execute("CREATE INDEX IF NOT EXISTS ix_ficheros_accedido ON ficheros (accedido)")
+            # Total de bytes en disco mantenido por triggers, para no sumar `ficheros` en cada petición
+            conexion.execute("BEGIN IMMEDIATE")
+            conexion.execute("CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)")
+            conexion.execute("INSERT OR IGNORE INTO total (id, bytes) SELECT 0, COALESCE(SUM(bytes), 0) FROM ficheros")
+            conexion.execute("""
+                CREATE TRIGGER IF NOT EXISTS tr_ficheros_insert AFTER INSERT ON ficheros
+                BEGIN UPDATE total SET bytes = bytes + NEW.bytes WHERE id = 0; END
+            """)
+            conexion.execute("""
+                CREATE TRIGGER IF NOT EXISTS tr_ficheros_delete AFTER DELETE ON ficheros
+                BEGIN UPDATE total SET bytes = bytes - OLD.bytes WHERE id = 0; END
+            """)
+            conexion.execute("""
+                CREATE TRIGGER IF NOT EXISTS tr_ficheros_update AFTER UPDATE OF bytes ON ficheros
+                BEGIN UPDATE total SET bytes = bytes + NEW.bytes - OLD.bytes WHERE id = 0; END
+            """)
+            conexion.execute("COMMIT")
+            self._conexion = conexion
+        return self._conexion
+
+    def _ruta(self, nombre: str) -> str:
+        return os.path.join(self.directorio, nombre[:2], nombre)
+
+    def _escribir(self, nombre: str, datos: bytes):
+        ruta = self._ruta(nombre)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, "wb") as f:
+            f.write(datos)
+        os.replace(temporal, ruta)
+        with self._lock:
+            self._conectar().execute(
+                # Upsert y no INSERT OR REPLACE: el borrado implícito de REPLACE no dispara los triggers del total
+                "INSERT INTO ficheros (nombre, bytes, accedido) VALUES (?, ?, ?) "
+                "ON CONFLICT(nombre) DO UPDATE SET bytes = excluded.bytes, accedido = excluded.accedido",
+                (nombre, len(datos), time.time())
+            )
+
+    def _usar(self, nombre: str):
+        with self._lock:
+            self._conectar().execute("UPDATE ficheros SET accedido = ? WHERE nombre = ?", (time.time(), nombre))
+
+    def _descargar(self, url: str) -> Tuple[bytes, str]:
+        """Descarga la imagen conectándose a la IP ya comprobada (sin volver a resolver el DNS, para que
+        no se pueda cambiar entre la comprobación y la conexión) y comprobando cada redirección"""
+        destino = comprobar_url(url, self.hosts_permitidos)
+        for _ in range(MAX_REDIRECCIONES + 1):
+            ip = resolver_publica(destino, self.hosts_permitidos)
+            extensiones = {"sni_hostname": destino.host} if destino.scheme == "https" else {}
+            try:
+                with self.cliente.stream(
+                    "GET",
+                    destino.copy_with(host=ip),
+                    headers={"Host": destino.netloc.decode("ascii")},
+                    extensions=extensiones,
+                    follow_redirects=False
+                ) as respuesta:
+                    if respuesta.is_redirect:
+                        destino = comprobar_url(destino.join(respuesta.headers.get("location", "")), self.hosts_permitidos)
+                        continue
+                    return self._leer(respuesta)
+            except httpx.HTTPError as e:
+                raise ErrorImagen(f"Error al descargar la imagen: {str(e)}")
+        raise ErrorImagen("La imagen remota redirige demasiadas veces")
+
+    def _leer(self, respuesta: httpx.Response) -> Tuple[bytes, str]:
+        if respuesta.status_code != 200:
+            raise ErrorImagen(f"La imagen remota respondió {respuesta.status_code}")
+        tipo = respuesta.headers.get("content-type", "").split(";")[0].strip()
+        if not tipo.startswith("image/"):
+            raise ErrorImagen(f"El recurso remoto no es una imagen ({tipo or 'sin tipo'})")
+        datos = bytearray()
+        for trozo in respuesta.iter_bytes():
+            datos += trozo
+            if len(datos) > self.max_descarga:
+                raise ErrorImagen("La imagen remota supera el tamaño máximo")
+        return bytes(datos), tipo
+
+    def _original(self, url: str) -> Tuple[str, str]:
+        """(nombre del fichero, content-type) del original, descargándolo si no está en disco"""
+        clave = hashlib.sha256(url.encode()).hexdigest()
+        with self._lock:
+            fila = self._conectar().execute("SELECT contenido, tipo FROM urls WHERE hash = ?", (clave,)).fetchone()
+        if fila and os.path.exists(self._ruta(fila[0])):
+            self.aciertos += 1
+            self._usar(fila[0])
+            return fila
+
+        datos, tipo = self._descargar(url)
+        self.descargas += 1
+        contenido = hashlib.sha256(datos).hexdigest()
+        if not os.path.exists(self._ruta(contenido)):
+            self._escribir(contenido, datos)
+        else:
+            self._usar(contenido)
+        with self._lock:
+            self._conectar().execute(
+                "INSERT OR REPLACE INTO urls (hash, contenido, tipo) VALUES (?, ?, ?)",
+                (clave, contenido, tipo)
+            )
+        return contenido, tipo
+
+    def _miniatura(self, contenido: str, tipo: str, ancho: int) -> Tuple[str, str]:
+        for extension, tipo_miniatura in FORMATOS_MINIATURA.values():
+            nombre = f"{contenido}_{ancho}.{extension}"
+            if os.path.exists(self._ruta(nombre)):
+                self.aciertos_miniatura += 1
+                self._usar(nombre)
+                return nombre, tipo_miniatura
+
+        try:
+            with PILImage.open(self._ruta(contenido)) as imagen:
+                if imagen.width <= ancho:
+                    # No se amplía: la propia imagen original hace de miniatura
+                    return contenido, tipo
+                extension, tipo_miniatura = FORMATOS_MINIATURA.get(imagen.format, FORMATOS_MINIATURA["JPEG"])
+                formato = imagen.format if imagen.format in FORMATOS_MINIATURA else "JPEG"
+                imagen.thumbnail((ancho, imagen.height))
+                if formato == "JPEG" and imagen.mode not in ("RGB", "L"):
+                    imagen = imagen.convert("RGB")
+                salida = io.BytesIO()
+                imagen.save(salida, format=formato, quality=85, optimize=True)
+        except (OSError, ValueError) as e:
+            raise ErrorImagen(f"No se ha podido redimensionar la imagen: {str(e)}")
+
+        nombre = f"{contenido}_{ancho}.{extension}"
+        self._escribir(nombre, salida.getvalue())
+        self.miniaturas_generadas += 1
+        return nombre, tipo_miniatura
+
+    def obtener(self, url: str, ancho: Optional[int] = None) -> Tuple[str, str, str]:
+        """Devuelve (ruta en disco, content-type, etag) del original o de la miniatura de `ancho` píxeles"""
+        contenido, tipo = self._original(url)
+        nombre = contenido
+        if ancho is not None and soporta_miniaturas():
+            nombre, tipo = self._miniatura(contenido, tipo, ancho)
+        self._aplicar_cuota()
+        return self._ruta(nombre), tipo, nombre
+
+    def _aplicar_cuota(self):
+        """Desaloja los ficheros usados hace más tiempo hasta quedar por debajo del 90% de la cuota"""
+        with self._lock:
+            conexion = self._conectar()
+            total = conexion.execute("SELECT bytes FROM total WHERE id = 0").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            objetivo = self.max_bytes * 0.9
+            desalojar = []
+            for nombre, bytes_fichero in conexion.execute("SELECT nombre, bytes FROM ficheros ORDER BY accedido"):
+                if total <= objetivo:
+                    break
+                desalojar.append(nombre)
+                total -= bytes_fichero
+            conexion.executemany("DELETE FROM ficheros WHERE nombre = ?", [(nombre,) for nombre in desalojar])
+        for nombre in desalojar:
+            try:
+                os.remove(self._ruta(nombre))
+            except FileNotFoundError:
+                pass
+        self.desalojados += len(desalojar)
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            conexion = self._conectar()
+            ficheros = conexion.execute("SELECT COUNT(*) FROM ficheros").fetchone()[0]
+            total = conexion.execute("SELECT bytes FROM total WHERE id = 0").fetchone()[0]
+        peticiones = self.aciertos + self.descargas
+        peticiones_miniatura = self.aciertos_miniatura + self.miniaturas_generadas
+        return {
+            "ficheros": ficheros,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "aciertos": self.aciertos,
+            "descargas": self.descargas,
+            "ratio_aciertos": round(self.aciertos / peticiones, 4) if peticiones else None,
+            "aciertos_miniatura": self.aciertos_miniatura,
+            "miniaturas_generadas": self.miniaturas_generadas,
+            "ratio_aciertos_miniatura": round(self.aciertos_miniatura / peticiones_miniatura, 4) if peticiones_miniatura else None,
+            "desalojados": self.desalojados,
+            "miniaturas": soporta_miniaturas(),
+        }
@@ -1,7 +1,12 @@
-import requests
-import json
+import asyncio
 import random
-from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+BASE_URL = "http://127.0.0.1:8000"
+TAMANO_LOTE = 5000         # Asignaciones por petición a /images/bulk
+TAMANO_PAGINA_IDS = 20000  # Ids por página de /listings/ids (múltiplo de TAMANO_LOTE)
+PETICIONES_EN_PARALELO = 4
 
 # Lista de imágenes disponibles
 images = [
@@ -16,31 +21,60 @@ images = [
     "https://www.mammaproof.org/barcelona/wp-content/uploads/sites/11/2023/05/cal-carulla-portada-min-1180x885-1180x885-1-1180x885.jpg"
 ]
 
-# Función para insertar imagen
-def insert_image(listing_id):
-    image_link = random.choice(images)
-    payload = {
-        "listing_id": listing_id,
-        "link": image_link
-    }
-    url_images = "http://127.0.0.1:8000/images"
-    headers = {'Content-Type': 'application/json'}
-    try:
-        post_response = requests.post(url_images, headers=headers, data=json.dumps(payload))
-        if post_response.status_code == 200:
-            print(f"✅ Imagen insertada correctamente en listing {listing_id}")
-        else:
-            print(f"❌ Error al insertar imagen en listing {listing_id}: {post_response.text}")
-    except Exception as e:
-        print(f"❌ Excepción en listing {listing_id}: {str(e)}")
-
-# Obtener los listings
-url_listings = "http://127.0.0.1:8000/listings"
-response = requests.get(url_listings)
-
-if response.status_code == 200:
-    listings = response.json()
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        executor.map(lambda l: insert_image(l.get("listing")), listings)
-else:
-    print(f"❌ Error al obtener listings: {response.status_code} - {response.text}")
+
+# Genera los lotes de asignaciones [listing_id, índice de la URL] a medida que se recorren los ids
+def lotes_asignaciones(listing_ids):
+    lote = []
+    for listing_id in listing_ids:
+        lote.append([listing_id, random.randrange(len(images))])
+        if len(lote) == TAMANO_LOTE:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+# Función para insertar un lote de imágenes
+async def insertar_lote(client, semaforo, lote):
+    async with semaforo:
+        try:
+            response = await client.post("/images/bulk", json={"urls": images, "asignaciones": lote})
+            if response.status_code == 200:
+                print(f"✅ {len(lote)} imágenes insertadas (listings {lote[0][0]}..{lote[-1][0]})")
+            else:
+                print(f"❌ Error al insertar lote de {len(lote)} imágenes: {response.text}")
+        except Exception as e:
+            print(f"❌ Excepción en lote de {len(lote)} imágenes: {str(e)}")
+
+
+# Recorre /listings/ids por páginas (paginación por clave) en lugar de cargar todos los ids de una vez
+async def paginas_ids(client):
+    despues_de = None
+    while True:
+        params = {"limit": TAMANO_PAGINA_IDS}
+        if despues_de is not None:
+            params["despues_de"] = despues_de
+        response = await client.get("/listings/ids", params=params)
+        if response.status_code != 200:
+            print(f"❌ Error al obtener listings: {response.status_code} - {response.text}")
+            return
+        listing_ids = response.json()
+        if listing_ids:
+            yield listing_ids
+        if len(listing_ids) < TAMANO_PAGINA_IDS:
+            return
+        despues_de = listing_ids[-1]
+
+
+async def main():
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=60) as client:
+        semaforo = asyncio.Semaphore(PETICIONES_EN_PARALELO)
+        # Los lotes de cada página se envían antes de pedir la siguiente
+        async for listing_ids in paginas_ids(client):
+            await asyncio.gather(*(
+                insertar_lote(client, semaforo, lote) for lote in lotes_asignaciones(listing_ids)
+            ))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,369 @@
+import bisect
+import datetime
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import tarifas
+from models import Alojamiento, ListingLosDiscount, Reserva, seasonalPrices
+
+# 📌 Instantánea binaria del catálogo para el camino de lectura
+#
+# Un worker la construye periódicamente y la escribe de forma atómica; cada worker la
+# abre con mmap, así que las páginas se comparten entre procesos y la memoria no se
+# multiplica por el número de workers. Todo son arrays de ancho fijo:
+#
+#   cabecera | ids (q) | fichas (FICHA) | por alojamiento y día de la ventana:
+#   precios (d) | estancia mínima (H) | sumas prefijas de precio, recargo y noches
+#   sin precio (d, d, i) | sumas prefijas de noches ocupadas (i) | descuentos | textos
+#
+# Los alojamientos están ordenados por id (búsqueda binaria) y todos comparten la
+# misma ventana de días [dia_inicio, dia_inicio + dias), de modo que el alojamiento k
+# ocupa siempre la misma posición en cada sección.
+
+MAGIA = b"PRVSNAP1"
+CABECERA = struct.Struct("<8sdiIIIQ")  # magia, generado, dia_inicio, dias, alojamientos, descuentos, bytes de textos
+# version, imagen_id, occupants, disponible, tiene precios, noche anterior a dia_inicio reservada,
+# (inicio, longitud) de nombre, direccion, ciudad y pais en los textos, (inicio, cantidad) de sus descuentos
+FICHA = struct.Struct("<qqibBBx" + "II" * 4 + "II")
+NULO = -1
+SIN_TEXTO = 0xFFFFFFFF
+CAMPOS_TEXTO = ("nombre", "direccion", "ciudad", "pais")
+
+
+def _alinear(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def _secciones(alojamientos: int, dias: int, descuentos: int = 0, bytes_textos: int = 0) -> Dict[str, Tuple[int, str, int]]:
+    """(desplazamiento, tipo del array, elementos) de cada sección"""
+    tamanos = [
+        ("ids", "q", alojamientos),
+        ("fichas", "B", alojamientos * FICHA.size),
+        ("precios", "d", alojamientos * dias),
+        ("estancia_minima", "H", alojamientos * dias),
+        ("acumulado", "d", alojamientos * (dias + 1)),
+        ("acumulado_recargos", "d", alojamientos * (dias + 1)),
+        ("acumulado_sin_precio", "i", alojamientos * (dias + 1)),
+        ("ocupadas", "i", alojamientos * (dias + 1)),
+        ("descuentos_noches", "i", descuentos),
+        ("descuentos_porcentaje", "d", descuentos),
+        ("textos", "B", bytes_textos),
+    ]
+    secciones = {}
+    desplazamiento = _alinear(CABECERA.size)
+    for nombre, tipo, elementos in tamanos:
+        secciones[nombre] = (desplazamiento, tipo, elementos)
+        desplazamiento = _alinear(desplazamiento + elementos * array(tipo).itemsize)
+    return secciones
+
+
+def _ventana(tarifa: Optional[tarifas.TarifaCompilada], dia_inicio: int, dias: int):
+    """Precios, estancia mínima y sumas prefijas de la tarifa recortada a la ventana.
+
+    Las sumas de precio y recargo se copian de la tarifa completa (fuera de su rango se
+    repite el extremo) en lugar de recalcularse desde el inicio de la ventana: así las
+    restas dan exactamente los mismos floats y los precios redondeados no cambian.
+    """
+    precios = array("d", [math.nan]) * dias
+    estancia_minima = array("H", [1]) * dias
+    acumulado = array("d", [0.0]) * (dias + 1)
+    acumulado_recargos = array("d", [0.0]) * (dias + 1)
+    if tarifa is not None:
+        desplazamiento = dia_inicio - tarifa.inicio
+        for d in range(max(-desplazamiento, 0), min(tarifa.dias - desplazamiento, dias)):
+            precios[d] = tarifa.precios[d + desplazamiento]
+            estancia_minima[d] = tarifa.estancia_minima[d + desplazamiento]
+        for d in range(dias + 1):
+            i = min(max(d + desplazamiento, 0), tarifa.dias)
+            acumulado[d] = tarifa._acumulado[i]
+            acumulado_recargos[d] = tarifa._acumulado_recargos[i]
+    acumulado_sin_precio = array("i", [0]) * (dias + 1)
+    for d, precio in enumerate(precios):
+        acumulado_sin_precio[d + 1] = acumulado_sin_precio[d] + math.isnan(precio)
+    return precios, estancia_minima, acumulado, acumulado_recargos, acumulado_sin_precio
+
+
+def construir(db: Session, ruta: str, dias: int = 400, lote: int = 500) -> dict:
+    """Escribe la instantánea de todo el catálogo desde hoy y la publica con un rename atómico"""
+    generado = time.time()
+    dia_inicio = tarifas.a_dia(datetime.date.today())
+    dia_fin = dia_inicio + dias
+    listing_ids = [fila[0] for fila in db.query(Alojamiento.listing).order_by(Alojamiento.listing)]
+    secciones = _secciones(len(listing_ids), dias)
+
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    textos = bytearray()
+    descuentos_noches, descuentos_porcentaje = array("i"), array("d")
+    with open(temporal, "wb") as f:
+        def escribir(seccion: str, k: int, datos: array):
+            desplazamiento, tipo, _ = secciones[seccion]
+            f.seek(desplazamiento + k * len(datos) * datos.itemsize)
+            f.write(datos.tobytes())
+
+        escribir("ids", 0, array("q", listing_ids))
+        for inicio_lote in range(0, len(listing_ids), lote):
+            ids_lote = listing_ids[inicio_lote:inicio_lote + lote]
+            temporadas, descuentos, reservas = defaultdict(list), defaultdict(list), defaultdict(list)
+            for temporada in db.query(seasonalPrices).filter(seasonalPrices.listing.in_(ids_lote)):
+                temporadas[temporada.listing].append(temporada)
+            for descuento in db.query(ListingLosDiscount).filter(ListingLosDiscount.listing_id.in_(ids_lote)):
+                descuentos[descuento.listing_id].append(descuento)
+            for listing_id, entrada, salida in db.query(Reserva.listing_id, Reserva.dia_entrada, Reserva.dia_salida).filter(
+                Reserva.listing_id.in_(ids_lote), Reserva.dia_salida >= dia_inicio, Reserva.dia_entrada < dia_fin
+            ):
+                reservas[listing_id].append((entrada, salida))
+
+            fichas = bytearray()
+            alojamientos = {a.listing: a for a in db.query(Alojamiento).filter(Alojamiento.listing.in_(ids_lote))}
+            for k, listing_id in enumerate(ids_lote, start=inicio_lote):
+                alojamiento = alojamientos[listing_id]
+                tarifa = tarifas.compilar_tarifa(temporadas[listing_id], descuentos[listing_id])
+                precios, estancia_minima, acumulado, acumulado_recargos, acumulado_sin_precio = _ventana(tarifa, dia_inicio, dias)
+                escribir("precios", k, precios)
+                escribir("estancia_minima", k, estancia_minima)
+                escribir("acumulado", k, acumulado)
+                escribir("acumulado_recargos", k, acumulado_recargos)
+                escribir("acumulado_sin_precio", k, acumulado_sin_precio)
+                ocupadas = tarifas.acumulado_ocupacion(reservas[listing_id], dia_inicio, dias)
+                escribir("ocupadas", k, array("i", (int(v) for v in ocupadas)))
+
+                campos_texto = []
+                for campo in CAMPOS_TEXTO:
+                    valor = getattr(alojamiento, campo)
+                    if valor is None:
+                        campos_texto += [0, SIN_TEXTO]
+                    else:
+                        codificado = valor.encode("utf-8")
+                        campos_texto += [len(textos), len(codificado)]
+                        textos += codificado
+                primer_descuento = len(descuentos_noches)
+                for descuento in descuentos[listing_id]:
+                    descuentos_noches.append(descuento.min_nights)
+                    descuentos_porcentaje.append(descuento.discount)
+                fichas += FICHA.pack(
+                    alojamiento.version or 0,
+                    NULO if alojamiento.imagen_id is None else alojamiento.imagen_id,
+                    NULO if alojamiento.occupants is None else alojamiento.occupants,
+                    NULO if alojamiento.disponible is None else int(bool(alojamiento.disponible)),
+                    int(tarifa is not None),
+                    int(any(salida == dia_inicio for _, salida in reservas[listing_id])),
+                    *campos_texto,
+                    primer_descuento, len(descuentos[listing_id])
+                )
+            f.seek(secciones["fichas"][0] + inicio_lote * FICHA.size)
+            f.write(fichas)
+
+        # Las secciones de tamaño variable van al final, cuando ya se conoce su tamaño
+        secciones = _secciones(len(listing_ids), dias, len(descuentos_noches), len(textos))
+        for seccion, datos in (
+            ("descuentos_noches", descuentos_noches),
+            ("descuentos_porcentaje", descuentos_porcentaje),
+            ("textos", textos),
+        ):
+            f.seek(secciones[seccion][0])
+            f.write(datos)
+        fin = max(desplazamiento + elementos * array(tipo).itemsize for desplazamiento, tipo, elementos in secciones.values())
+        f.truncate(_alinear(fin))
+        f.seek(0)
+        f.write(CABECERA.pack(MAGIA, generado, dia_inicio, dias, len(listing_ids), len(descuentos_noches), len(textos)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
+    return {"alojamientos": len(listing_ids), "dias": dias, "bytes": os.path.getsize(ruta)}
+
+
+class Instantanea:
+    """Vista de solo lectura sobre un fichero de instantánea mapeado en memoria"""
+
+    def __init__(self, ruta: str):
+        with open(ruta, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        vista = memoryview(self._mmap)
+        magia, self.generado, self.dia_inicio, self.dias, alojamientos, descuentos, bytes_textos = CABECERA.unpack_from(vista)
+        if magia != MAGIA:
+            raise ValueError(f"{ruta} no es una instantánea del catálogo")
+        self._vistas = {}
+        for nombre, (desplazamiento, tipo, elementos) in _secciones(alojamientos, self.dias, descuentos, bytes_textos).items():
+            trozo = vista[desplazamiento:desplazamiento + elementos * array(tipo).itemsize]
+            self._vistas[nombre] = trozo if tipo == "B" else trozo.cast(tipo)
+        self.alojamientos = alojamientos
+
+    def _posicion(self, listing_id: int) -> Optional[int]:
+        ids = self._vistas["ids"]
+        k = bisect.bisect_left(ids, listing_id)
+        return k if k < len(ids) and ids[k] == listing_id else None
+
+    def _ficha(self, k: int) -> tuple:
+        return FICHA.unpack_from(self._vistas["fichas"], k * FICHA.size)
+
+    def _fila(self, seccion: str, k: int, ancho: int) -> memoryview:
+        return self._vistas[seccion][k * ancho:(k + 1) * ancho]
+
+    def contiene(self, listing_id: int) -> bool:
+        return self._posicion(listing_id) is not None
+
+    def cubre(self, desde, hasta) -> bool:
+        """True si los días [desde, hasta) están dentro de la ventana de la instantánea"""
+        return self.dia_inicio <= tarifas.a_dia(desde) and tarifas.a_dia(hasta) <= self.dia_inicio + self.dias
+
+    def alojamiento(self, listing_id: int) -> Optional[dict]:
+        k = self._posicion(listing_id)
+        if k is None:
+            return None
+        version, imagen_id, occupants, disponible, _, _, *resto = self._ficha(k)
+        textos = self._vistas["textos"]
+        datos = {"listing": listing_id, "version": version}
+        for i, campo in enumerate(CAMPOS_TEXTO):
+            inicio, longitud = resto[2 * i], resto[2 * i + 1]
+            datos[campo] = None if longitud == SIN_TEXTO else bytes(textos[inicio:inicio + longitud]).decode("utf-8")
+        datos["imagen_id"] = None if imagen_id == NULO else imagen_id
+        datos["occupants"] = None if occupants == NULO else occupants
+        datos["disponible"] = None if disponible == NULO else bool(disponible)
+        return datos
+
+    def tarifa(self, listing_id: int) -> Optional[tarifas.TarifaCompilada]:
+        """Tarifa recortada a la ventana, sobre las páginas compartidas; None si no tiene temporadas"""
+        k = self._posicion(listing_id)
+        if k is None:
+            return None
+        ficha = self._ficha(k)
+        if not ficha[4]:
+            return None
+        primer_descuento, descuentos = ficha[-2], ficha[-1]
+        noches = self._vistas["descuentos_noches"]
+        porcentajes = self._vistas["descuentos_porcentaje"]
+        return tarifas.TarifaCompilada.precompilada(
+            self.dia_inicio,
+            self._fila("precios", k, self.dias),
+            self._fila("estancia_minima", k, self.dias),
+            [(noches[i], porcentajes[i]) for i in range(primer_descuento, primer_descuento + descuentos)],
+            self._fila("acumulado", k, self.dias + 1),
+            self._fila("acumulado_recargos", k, self.dias + 1),
+            self._fila("acumulado_sin_precio", k, self.dias + 1)
+        )
+
+    def ocupada(self, listing_id: int, desde, hasta) -> bool:
+        """True si alguna noche de [desde, hasta) está reservada (las fechas deben estar cubiertas)"""
+        k = self._posicion(listing_id)
+        ocupadas = self._fila("ocupadas", k, self.dias + 1)
+        i = tarifas.a_dia(desde) - self.dia_inicio
+        j = tarifas.a_dia(hasta) - self.dia_inicio
+        return ocupadas[j] - ocupadas[i] > 0
+
+    def vispera_ocupada(self, listing_id: int, desde) -> bool:
+        """True si la noche anterior a `desde` está reservada (`desde` es un día de salida)"""
+        k = self._posicion(listing_id)
+        i = tarifas.a_dia(desde) - self.dia_inicio
+        if i == 0:
+            return bool(self._ficha(k)[5])
+        ocupadas = self._fila("ocupadas", k, self.dias + 1)
+        return ocupadas[i] - ocupadas[i - 1] > 0
+
+    def ocupacion(self, listing_id: int, desde, dias: int) -> memoryview:
+        """Sumas prefijas de noches ocupadas alineadas con `desde`, como tarifas.acumulado_ocupacion"""
+        k = self._posicion(listing_id)
+        i = tarifas.a_dia(desde) - self.dia_inicio
+        return self._fila("ocupadas", k, self.dias + 1)[i:i + dias + 1]
+
+    def cerrar(self):
+        """Solo para quien sabe que nadie más la usa (p. ej. scripts); el lector no la llama"""
+        self._vistas.clear()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Aún hay vistas en uso en alguna petición: el mmap se libera cuando terminen
+            pass
+
+
+class LectorInstantanea:
+    """Instantánea vigente de este worker más las escrituras posteriores a ella.
+
+    Se suscribe al bus de invalidación: un alojamiento invalidado después de
+    generarse la instantánea deja de leerse de ella (se va a SQLite) hasta que
+    se abra una instantánea más reciente. Una invalidación global la descarta entera.
+    """
+
+    def __init__(self, ruta: str, comprobar_cada: float = 1.0):
+        self.ruta = ruta
+        self.comprobar_cada = comprobar_cada
+        self._actual: Optional[Instantanea] = None
+        self._firma = None
+        self._comprobada = 0.0
+        self._sucios: Dict[int, float] = {}
+        self._sucio_global = 0.0
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def invalidar(self, clave=None):
+        ahora = time.time()
+        if clave is None:
+            self._sucio_global = ahora
+        else:
+            self._sucios[clave] = ahora
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        if ahora - self._comprobada < self.comprobar_cada:
+            return
+        with self._lock:
+            if ahora - self._comprobada < self.comprobar_cada:
+                return
+            self._comprobada = ahora
+            try:
+                estado = os.stat(self.ruta)
+            except FileNotFoundError:
+                return
+            firma = (estado.st_ino, estado.st_mtime_ns, estado.st_size)
+            if firma == self._firma:
+                return
+            try:
+                nueva = Instantanea(self.ruta)
+            except (OSError, ValueError, struct.error):
+                return
+            # La anterior no se cierra: otras peticiones pueden tenerla aún (de obtener()). El mmap
+            # se libera solo cuando se suelta la última referencia a ella y a sus vistas.
+            self._actual, self._firma = nueva, firma
+            # Lo invalidado antes de generarse la nueva instantánea ya está incluido en ella
+            for listing_id, cuando in list(self._sucios.items()):
+                if cuando < nueva.generado:
+                    self._sucios.pop(listing_id, None)
+
+    def obtener(self, listing_id: int) -> Optional[Instantanea]:
+        """La instantánea si puede responder por este alojamiento; None para leer de SQLite"""
+        self._recargar()
+        actual = self._actual
+        if (
+            actual is None
+            or self._sucio_global >= actual.generado
+            or listing_id in self._sucios
+            or not actual.contiene(listing_id)
+        ):
+            self.fallos += 1
+            return None
+        self.aciertos += 1
+        return actual
+
+    def estadisticas(self) -> dict:
+        actual = self._actual
+        peticiones = self.aciertos + self.fallos
+        return {
+            "cargada": actual is not None,
+            "generada": datetime.datetime.fromtimestamp(actual.generado).isoformat() if actual else None,
+            "alojamientos": actual.alojamientos if actual else 0,
+            "desde": tarifas.de_dia(actual.dia_inicio) if actual else None,
+            "dias": actual.dias if actual else 0,
+            "sucios": len(self._sucios),
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "ratio_aciertos": round(self.aciertos / peticiones, 4) if peticiones else None,
+        }
@@ -0,0 +1,63 @@
+import datetime
+import re
+from typing import Iterable, List, Tuple
+
+# Formato compacto de los records LOS (opcional, ?compacto=true / "compacto": true).
+#
+# Normal:    "2026-07-01,1,1:100.0,2:200.0"  (una fila por fecha y número de ocupantes)
+# Compacto:  "2026-07-01/2026-07-05,1-4,1:100.0,2:200.0"
+#
+# Las fechas consecutivas con el mismo rango de ocupantes y los mismos precios van en un
+# solo record "desde/hasta" (ambos incluidos) y los ocupantes con el mismo precio en un
+# rango "a-b". Si el tramo es de un solo día o de un solo ocupante se escribe sin "/" o "-".
+# Los records de cancelación llevan delante "listing_" y usan "_" como separador.
+
+
+def agrupar(filas: Iterable[Tuple[datetime.date, int, int, str]]) -> List[Tuple[datetime.date, datetime.date, int, int, str]]:
+    """Une en tramos (desde, hasta, ocupantes desde, ocupantes hasta, precios) las filas
+    (fecha, ocupantes desde, ocupantes hasta, precios ya formateados), que vienen ordenadas por fecha"""
+    tramos = []
+    abiertos = {}
+    for fecha, desde, hasta, precios in filas:
+        clave = (desde, hasta, precios)
+        k = abiertos.get(clave)
+        if k is not None and tramos[k][1] + datetime.timedelta(days=1) == fecha:
+            tramos[k][1] = fecha
+        else:
+            abiertos[clave] = len(tramos)
+            tramos.append([fecha, fecha, desde, hasta, precios])
+    return [tuple(tramo) for tramo in tramos]
+
+
+def _rango(desde, hasta, separador: str) -> str:
+    return f"{desde}" if desde == hasta else f"{desde}{separador}{hasta}"
+
+
+def codificar(filas: Iterable[Tuple[datetime.date, int, int, str]], separador: str = ",", prefijo: str = "") -> List[str]:
+    return [
+        f"{prefijo}{_rango(inicio.isoformat(), fin.isoformat(), '/')}{separador}{_rango(desde, hasta, '-')}{separador}{precios}"
+        for inicio, fin, desde, hasta, precios in agrupar(filas)
+    ]
+
+
+def expandir(records: Iterable[str], separador: str = ",") -> List[str]:
+    """Vuelve a los records de siempre (una fila por fecha y ocupantes, en ese orden)"""
+    patron = re.compile(
+        rf"^(.*?)(\d{{4}}-\d{{2}}-\d{{2}})(?:/(\d{{4}}-\d{{2}}-\d{{2}}))?{re.escape(separador)}(\d+)(?:-(\d+))?{re.escape(separador)}(.*)$"
+    )
+    filas = []
+    for record in records:
+        coincidencia = patron.match(record)
+        if coincidencia is None:
+            raise ValueError(f"Record LOS compacto no válido: {record!r}")
+        prefijo, inicio, fin, desde, hasta, precios = coincidencia.groups()
+        inicio = datetime.date.fromisoformat(inicio)
+        fin = datetime.date.fromisoformat(fin) if fin else inicio
+        desde = int(desde)
+        hasta = int(hasta) if hasta else desde
+        for d in range((fin - inicio).days + 1):
+            fecha = inicio + datetime.timedelta(days=d)
+            for ocupantes in range(desde, hasta + 1):
+                filas.append((fecha, ocupantes, f"{prefijo}{fecha.isoformat()}{separador}{ocupantes}{separador}{precios}"))
+    filas.sort(key=lambda fila: (fila[0], fila[1]))
+    return [record for _, _, record in filas]
@@ -1,93 +1,49 @@
+import asyncio
+import base64
+import gzip
 import hashlib
 import hmac
 import http
 import json
 import logging
+import os
+import time
+from contextlib import asynccontextmanager
 from random import randint
 import random
-from typing import List, Optional
-from fastapi import BackgroundTasks, FastAPI, Depends, HTTPException
+import secrets
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+from fastapi import APIRouter, BackgroundTasks, FastAPI, Depends, HTTPException, Request, Response
+from fastapi.responses import FileResponse
 import httpx
-from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, Float, DateTime, Sequence
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, Session
+from pydantic import BaseModel, ConfigDict, Field
+from sqlalchemy import delete, func, insert, select, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
 import datetime
 from dateutil.relativedelta import relativedelta
-
-# 📌 Configuración de SQLite
-DATABASE_URL = "sqlite:///./proveedor.db"  
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-listing_seq = Sequence('listing_seq', start=9000, increment=1)
-
-# 📌 Modelos de Base de Datos
-class Alojamiento(Base):
-    __tablename__ = "alojamientos"
-    listing = Column(Integer, listing_seq, primary_key=True, index=True)  
-    nombre = Column(String, index=True)
-    direccion = Column(String)
-    ciudad = Column(String)
-    pais = Column(String)
-    imagen_id = Column(Integer, ForeignKey("images.id"), nullable=True)
-    disponible = Column(Boolean, default=True)
-    occupants = Column(Integer, default=1)
-    seasonal_prices = relationship("seasonalPrices", backref="alojamiento")
-
-class PoliticaCancelacion(Base):
-    __tablename__ = "politicas_cancelacion"
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    dias_antes_cancelacion = Column(Integer, nullable=False)  # Por ejemplo: 7, 3, 1
-    porcentaje_penalizacion = Column(Float, nullable=False)   # Porcentaje: 0.25, 0.5, 1.0    
-
-class seasonalPrices(Base):
-    __tablename__ = "seasonal_prices"
-    id = Column(Integer, primary_key=True, autoincrement=True) 
-    listing = Column(Integer, ForeignKey("alojamientos.listing"))
-    price = Column(Float)
-    start_date = Column(DateTime)    
-    end_date = Column(DateTime)
-
-class Image(Base):
-    __tablename__ = "images"
-    id = Column(Integer, primary_key=True, autoincrement=True) 
-    listing_id = Column(Integer, ForeignKey("alojamientos.listing"))
-    link = Column(String)
-
-class ListingCommission(Base):
-    __tablename__ = "listing_commission"
-    id = Column(Integer, primary_key=True, autoincrement=True) 
-    listing_id = Column(Integer, ForeignKey("alojamientos.listing"))
-    commission = Column(Float)
-
-class ListingService(Base):
-    __tablename__ = "listing_services"
-    id = Column(Integer, primary_key=True, autoincrement=True)  
-    listing_id = Column(Integer, ForeignKey("alojamientos.listing"))
-    name = Column(String)
-    description = Column(String)
-
-class Cliente(Base):
-    __tablename__ = "clientes"
-    id = Column(Integer, primary_key=True, autoincrement=True)  
-    nombre = Column(String, index=True)
-    email = Column(String, unique=True, index=True)
-
-class Reserva(Base):
-    __tablename__ = "reservas"
-    id = Column(Integer, primary_key=True, autoincrement=True) 
-    listing_id = Column(Integer, ForeignKey("alojamientos.listing"))
-    fecha_reserva = Column(DateTime, default=datetime.datetime.now)
-    fecha_entrada = Column(DateTime)
-    fecha_salida = Column(DateTime)
-    localizador = Column(Integer, unique=True, index=True)  # Localizador único para la reserva
-    nombre_cliente = Column(String)
-    email_cliente = Column(String)
-    precio_reserva = Column(Float)
-
-Base.metadata.create_all(bind=engine)
+from admision import AdmisionMiddleware, ControlAdmision, GrupoRutas
+from cache import BusInvalidacion, CacheLocal
+from coalescencia import SingleFlight
+from compresion import CompresionMiddleware
+from idempotencia import AlmacenIdempotencia, IdempotenciaMiddleware
+from database import REPLICA_DATABASE_URLS, SessionLocal, get_engine, preparar_esquema, sesion_replica
+import busqueda
+import exportacion
+import resumenes
+from imagenes import CacheImagenes, ErrorImagen, comprobar_url
+import instantanea
+import los_compacto
+import mantenimiento
+from instantanea import Instantanea, LectorInstantanea
+import tarifas
+import token_cotizacion
+from models import (
+    Base, Alojamiento, PoliticaCancelacion, seasonalPrices, ListingLosDiscount, ImageUrl, Image,
+    ListingCommission, ListingService, Cliente, Reserva, ReservaHistorica, ClientWebhook,
+    LosPrecalculado, EjecucionPrecalculoLos, EjecucionMantenimiento, COLUMNAS_RESERVA, vista_reservas, ids_urls
+)
 
 # 📌 Dependencia de Base de Datos
 def get_db():
@@ -97,8 +53,202 @@ def get_db():
     finally:
         db.close()
 
-# 📌 Instancia de FastAPI
-app = FastAPI()
+# 📌 Cachés por worker y bus de invalidación entre workers
+# Con varios workers (gunicorn/uvicorn --workers) cada proceso tiene sus propias cachés;
+# las escrituras publican en el bus y el resto de workers las vacían en <= INVALIDACION_INTERVALO s.
+cache_alojamientos = CacheLocal("alojamientos", max_entradas=10000)
+cache_imagenes = CacheLocal("imagen_principal", max_entradas=10000)
+cache_politicas = CacheLocal("politicas", ttl=300)
+
+bus = BusInvalidacion(
+    os.getenv("INVALIDACION_DB", "./invalidaciones.db"),
+    intervalo=float(os.getenv("INVALIDACION_INTERVALO", "0.5"))
+)
+bus.suscribir("listing", cache_alojamientos.invalidar)
+bus.suscribir("listing", cache_imagenes.invalidar)
+bus.suscribir("politicas", cache_politicas.invalidar)
+
+cache_tarifas = CacheLocal("tarifas", max_entradas=5000)
+bus.suscribir("listing", cache_tarifas.invalidar)
+
+# Las escrituras masivas publican una sola invalidación: por alojamiento si son pocos, global si son muchos
+INVALIDACION_MAX_CLAVES = int(os.getenv("INVALIDACION_MAX_CLAVES", "500"))
+
+def _publicar_listings(listing_ids):
+    listing_ids = sorted(set(listing_ids))
+    if len(listing_ids) > INVALIDACION_MAX_CLAVES:
+        bus.publicar("listing")
+    elif listing_ids:
+        bus.publicar("listing", listing_ids)
+
+# 📌 Instantánea mmap del catálogo: /listings/{id}, /quote y el LOS leen de ella sin tocar SQLite.
+# Un worker la reconstruye cada INSTANTANEA_INTERVALO segundos; lo escrito después se lee de SQLite.
+INSTANTANEA = os.getenv("INSTANTANEA", "1") == "1"
+INSTANTANEA_RUTA = os.getenv("INSTANTANEA_RUTA", "./catalogo.snap")
+INSTANTANEA_DIAS = int(os.getenv("INSTANTANEA_DIAS", "400"))
+INSTANTANEA_INTERVALO = float(os.getenv("INSTANTANEA_INTERVALO", "300"))
+
+lector_instantanea = LectorInstantanea(INSTANTANEA_RUTA)
+bus.suscribir("listing", lector_instantanea.invalidar)
+
+def _instantanea(listing_id: int) -> Optional[Instantanea]:
+    return lector_instantanea.obtener(listing_id) if INSTANTANEA else None
+
+def construir_instantanea() -> dict:
+    db = SessionLocal()
+    try:
+        return instantanea.construir(db, INSTANTANEA_RUTA, INSTANTANEA_DIAS)
+    finally:
+        db.close()
+
+# 📌 Idempotency-Key: los reintentos de reservas y registros de webhooks reciben la respuesta
+# guardada en lugar de repetir la escritura (almacén SQLite compartido por los workers)
+almacen_idempotencia = AlmacenIdempotencia(
+    os.getenv("IDEMPOTENCIA_DB", "./idempotencia.db"),
+    ttl=float(os.getenv("IDEMPOTENCIA_TTL", str(24 * 3600))),
+    max_entradas=int(os.getenv("IDEMPOTENCIA_MAX_ENTRADAS", "100000"))
+)
+RUTAS_IDEMPOTENTES = [("POST", "/confirm"), ("POST", "/webhooks/register")]
+
+# 📌 Tokens de cotización
+# Con varios workers QUOTE_TOKEN_SECRET tiene que ser el mismo en todos; si no se define,
+# cada proceso usa uno aleatorio y los tokens de otros workers simplemente se recalculan.
+QUOTE_TOKEN_SECRET = os.getenv("QUOTE_TOKEN_SECRET", "").encode() or secrets.token_bytes(32)
+QUOTE_TOKEN_TTL = float(os.getenv("QUOTE_TOKEN_TTL", "900"))
+
+# Peticiones idénticas concurrentes de /quote, /check-availability y LOS se calculan una sola vez
+coalescedor = SingleFlight("resultados_cotizacion", ttl=float(os.getenv("COALESCENCIA_TTL", "2")))
+bus.suscribir("listing", coalescedor.invalidar)
+
+CACHES = [cache_alojamientos, cache_imagenes, cache_politicas, cache_tarifas]
+
+# 📌 Proxy de imágenes
+# /quote y /check-availability devuelven /imagenes/{id} en lugar de la URL remota: la imagen se
+# descarga una vez, se guarda en disco (IMAGENES_DIR, cuota IMAGENES_MAX_MB) y se sirve desde aquí.
+# Solo se descargan hosts públicos; IMAGENES_HOSTS_PERMITIDOS añade otros (p. ej. 127.0.0.1 en pruebas).
+# IMAGEN_PROXY_BASE permite anteponer el host público; IMAGEN_PROXY=0 vuelve a las URLs remotas.
+IMAGEN_PROXY = os.getenv("IMAGEN_PROXY", "1") == "1"
+IMAGEN_PROXY_BASE = os.getenv("IMAGEN_PROXY_BASE", "").rstrip("/")
+cache_disco_imagenes = CacheImagenes(
+    os.getenv("IMAGENES_DIR", "./imagenes_cache"),
+    max_bytes=int(os.getenv("IMAGENES_MAX_MB", "512")) * 1024 * 1024
+)
+# Varias peticiones simultáneas de la misma imagen sin cachear provocan una sola descarga
+coalescedor_imagenes = SingleFlight("descargas_imagenes")
+
+# 📌 Réplicas de lectura
+# REPLICA_DATABASE_URLS="sqlite:///./replica1.db,sqlite:///./replica2.db" reparte las lecturas
+# entre réplicas en round-robin; las escrituras siempre van al primario (engine).
+# Tras una escritura se lee del primario durante REPLICA_RETARDO_MAX segundos:
+#   - para el cliente que escribió (cookie leer_primario_hasta)
+#   - para el alojamiento afectado, en todos los workers (vía bus de invalidación)
+REPLICA_RETARDO_MAX = float(os.getenv("REPLICA_RETARDO_MAX", "5"))
+COOKIE_LEER_PRIMARIO = "leer_primario_hasta"
+
+_listings_primario_hasta = {}
+
+def _marcar_listing_primario(listing_id):
+    hasta = time.time() + REPLICA_RETARDO_MAX
+    _listings_primario_hasta[listing_id if listing_id is not None else "*"] = hasta
+
+bus.suscribir("listing", _marcar_listing_primario)
+
+def _debe_leer_primario(request: Request) -> bool:
+    ahora = time.time()
+    try:
+        if float(request.cookies.get(COOKIE_LEER_PRIMARIO, 0)) > ahora:
+            return True
+    except ValueError:
+        pass
+    if _listings_primario_hasta.get("*", 0) > ahora:
+        return True
+    listing_id = (
+        request.path_params.get("listing_id")
+        or request.path_params.get("hotCodigo")
+        or request.query_params.get("listing_id")
+    )
+    try:
+        return listing_id is not None and _listings_primario_hasta.get(int(listing_id), 0) > ahora
+    except ValueError:
+        return False
+
+def get_db_lectura(request: Request):
+    """Sesión para endpoints de solo lectura: réplica salvo que haga falta leer lo recién escrito"""
+    if not REPLICA_DATABASE_URLS or _debe_leer_primario(request):
+        db = SessionLocal()
+    else:
+        db = sesion_replica()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def _marcar_escritura(response: Response):
+    """Read-your-writes: el cliente que escribe lee del primario durante la ventana de retardo"""
+    if REPLICA_DATABASE_URLS:
+        response.set_cookie(
+            COOKIE_LEER_PRIMARIO,
+            str(time.time() + REPLICA_RETARDO_MAX),
+            max_age=int(REPLICA_RETARDO_MAX) + 1,
+            httponly=True
+        )
+
+# 📌 Tareas programadas
+# Se lanzan en todos los workers, pero cada ejecución la hace solo el que tiene el turno en el bus.
+ARCHIVO_INTERVALO = float(os.getenv("ARCHIVO_INTERVALO", str(6 * 3600)))
+
+async def _tarea_periodica(nombre: str, intervalo: float, funcion):
+    while True:
+        try:
+            if await asyncio.to_thread(bus.reclamar_tarea, nombre, intervalo):
+                await asyncio.to_thread(funcion)
+        except Exception as e:
+            logging.error(f"Error en la tarea programada {nombre}: {str(e)}")
+        await asyncio.sleep(intervalo)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    preparar_esquema()
+    bus.iniciar()
+    # Primera puesta en marcha con datos ya cargados: un solo worker construye los resúmenes de facetas
+    if bus.reclamar_tarea("resumenes_iniciales", 300):
+        await asyncio.to_thread(_inicializar_resumenes)
+    tareas_programadas = [
+        asyncio.create_task(_tarea_periodica("archivo_reservas", ARCHIVO_INTERVALO, lambda: archivar_reservas())),
+    ]
+    if LOS_PRECALCULO:
+        tareas_programadas.append(
+            asyncio.create_task(_tarea_periodica("precalculo_los", LOS_PRECALCULO_INTERVALO, precalcular_los))
+        )
+    if INSTANTANEA:
+        tareas_programadas.append(
+            asyncio.create_task(_tarea_periodica("instantanea", INSTANTANEA_INTERVALO, construir_instantanea))
+        )
+    if MANTENIMIENTO:
+        tareas_programadas.append(
+            asyncio.create_task(_tarea_periodica("mantenimiento", MANTENIMIENTO_INTERVALO, mantener_base_datos))
+        )
+    yield
+    for tarea in tareas_programadas:
+        tarea.cancel()
+    await asyncio.gather(*tareas_programadas, return_exceptions=True)
+    await bus.detener()
+    await _cerrar_cliente_webhooks()
+
+# 📌 Rutas: se registran en un router y create_app() las monta en la aplicación
+router = APIRouter()
+
+# 📌 Autenticación de /admin: cabecera X-Admin-Token igual a ADMIN_TOKEN (sin ADMIN_TOKEN, /admin queda desactivado)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+def _comprobar_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Administración desactivada: defina ADMIN_TOKEN")
+    token = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Token de administración no válido")
+
+router_admin = APIRouter(dependencies=[Depends(_comprobar_admin)])
 
 # 📌 Modelos Pydantic para validación de los datos
 
@@ -114,14 +264,45 @@ class AlojamientoCreate(BaseModel):
 
 class SeasonalPricesCreate(BaseModel):
     listing: int
-    price: float
+    price: float = Field(..., ge=0)
     start_date: datetime.datetime    
     end_date: datetime.datetime
+    priority: int = Field(0, ge=0)
+    weekend_modifier: float = Field(1.0, ge=0)
+    min_stay: int = Field(1, ge=1, le=365)  # Se guarda en array("H") en la tarifa compilada
+    extra_occupant_price: float = Field(0.0, ge=0)
+
+class AjustePrecios(BaseModel):
+    # Temporadas afectadas: las que pisan [desde, hasta] de los alojamientos que cumplen el filtro
+    desde: datetime.datetime
+    hasta: datetime.datetime
+    ciudad: Optional[str] = None
+    pais: Optional[str] = None
+    listing_ids: Optional[List[int]] = None
+    # Exactamente uno: porcentaje (+7 = +7%), importe a sumar o precio fijo
+    porcentaje: Optional[float] = Field(None, ge=-100)
+    importe: Optional[float] = None  # Si resta más que el precio, queda en 0
+    precio: Optional[float] = Field(None, ge=0)
+
+class PreciosBulkRequest(BaseModel):
+    ajuste: Optional[AjustePrecios] = None
+    # Fija el precio de estos rangos: actualiza la temporada con el mismo (listing, start_date, end_date) o la crea
+    precios: List[SeasonalPricesCreate] = Field(default_factory=list, max_length=10000)
+
+class ListingLosDiscountCreate(BaseModel):
+    listing_id: int
+    min_nights: int
+    discount: float
 
 class ImageCreate(BaseModel):
     listing_id: int
     link: str
 
+class ImageBulkCreate(BaseModel):
+    # Formato compacto: cada URL viaja una vez y las asignaciones son pares [listing_id, índice en urls]
+    urls: List[str] = Field(..., max_length=1000)
+    asignaciones: List[Tuple[int, int]] = Field(..., max_length=10000)
+
 class ListingCommissionCreate(BaseModel):
     listing_id: int
     commission: float
@@ -142,48 +323,326 @@ class ReservaCreate(BaseModel):
     nombre_cliente: str 
     email_cliente: str
     precio_reserva: float
+    num_personas: int = 1
+    quote_token: Optional[str] = None  # Devuelto por /quote: evita recalcular el precio
+
+# 📌 Modelos Pydantic de respuesta
+# Se validan desde los objetos ORM (from_attributes) y FastAPI los serializa
+# directamente a bytes JSON con pydantic-core, sin pasar por jsonable_encoder.
+
+class AlojamientoResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    listing: int
+    nombre: Optional[str] = None
+    direccion: Optional[str] = None
+    ciudad: Optional[str] = None
+    pais: Optional[str] = None
+    imagen_id: Optional[int] = None
+    disponible: Optional[bool] = None
+    occupants: Optional[int] = None
+
+class SeasonalPricesResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    listing: int
+    price: float
+    start_date: datetime.datetime
+    end_date: datetime.datetime
+    priority: Optional[int] = 0
+    weekend_modifier: Optional[float] = 1.0
+    min_stay: Optional[int] = 1
+    extra_occupant_price: Optional[float] = 0.0
+
+class ListingLosDiscountResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    listing_id: int
+    min_nights: int
+    discount: float
+
+class ImageResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    listing_id: int
+    link: str
+
+class ListingCommissionResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    listing_id: int
+    commission: float
+
+class ListingServiceResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    listing_id: int
+    name: Optional[str] = None
+    description: Optional[str] = None
+
+class ClienteResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    nombre: str
+    email: str
+
+class ReservaResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    listing_id: int
+    fecha_reserva: Optional[datetime.datetime] = None
+    fecha_entrada: datetime.datetime
+    fecha_salida: datetime.datetime
+    localizador: int
+    nombre_cliente: Optional[str] = None
+    email_cliente: Optional[str] = None
+    precio_reserva: Optional[float] = None
+
+class MensajeResponse(BaseModel):
+    mensaje: str
+
+class HistorialReservasResponse(BaseModel):
+    reservas: List[ReservaResponse]
+    siguiente_cursor: Optional[str] = None
+
+class TraceSearchResponse(BaseModel):
+    reserva: ReservaResponse
+    alojamiento: Optional[AlojamientoResponse] = None
+
+class PoliticaCancelacionResponse(BaseModel):
+    dias_antes: int
+    penalizacion: float
+
+class DisponibilidadResponse(BaseModel):
+    alojamiento: AlojamientoResponse
+    precio_total: float
+    precio_por_dia: float
+    ocupantes: int
+    imagen: Optional[str] = None
+    politicas_cancelacion: List[PoliticaCancelacionResponse]
+
+class CotizacionResponse(BaseModel):
+    alojamiento: AlojamientoResponse
+    precio_total: float
+    precio_por_dia: float
+    num_personas: int
+    quote_token: Optional[str] = None
+    imagen: Optional[str] = None
+    politicas_cancelacion: List[PoliticaCancelacionResponse]
+
+class FacetaCiudadResponse(BaseModel):
+    ciudad: Optional[str] = None
+    pais: Optional[str] = None
+    alojamientos: int
+    disponibles: int
+    precio_min: Optional[float] = None
+    precio_max: Optional[float] = None
+
+class FacetaOcupacionResponse(BaseModel):
+    banda: str
+    alojamientos: int
+    disponibles: int
+    precio_min: Optional[float] = None
+    precio_max: Optional[float] = None
+
+class FacetaGrupoResponse(FacetaCiudadResponse):
+    banda: str
+
+class FacetasResponse(BaseModel):
+    desde: datetime.date
+    hasta: datetime.date
+    alojamientos: int
+    disponibles: int
+    precio_min: Optional[float] = None
+    precio_max: Optional[float] = None
+    ciudades: List[FacetaCiudadResponse]
+    ocupacion: List[FacetaOcupacionResponse]
+    grupos: List[FacetaGrupoResponse]
+
+class BusquedaResultadoResponse(BaseModel):
+    alojamiento: AlojamientoResponse
+    puntuacion: float
+    fragmento: Optional[str] = None
+
+class LOSData(BaseModel):
+    records: List[str]
+
+class LOSResponse(BaseModel):
+    data: LOSData
+
+# 📌 Lecturas cacheadas
+
+def _politicas_cancelacion(db: Session) -> List[dict]:
+    politicas = cache_politicas.obtener("todas")
+    if politicas is None:
+        politicas = [
+            {
+                "dias_antes": p.dias_antes_cancelacion,
+                "penalizacion": p.porcentaje_penalizacion
+            } for p in db.query(PoliticaCancelacion).order_by(PoliticaCancelacion.dias_antes_cancelacion.desc()).all()
+        ]
+        cache_politicas.guardar("todas", politicas)
+    return politicas
+
+def _imagen_principal(db: Session, listing_id: int) -> Optional[str]:
+    # Se cachea también la ausencia de imagen ("") para no repetir la consulta
+    link = cache_imagenes.obtener(listing_id)
+    if link is None:
+        imagen = db.query(ImageUrl.id, ImageUrl.url).join(Image, Image.url_id == ImageUrl.id).filter(
+            Image.listing_id == listing_id
+        ).order_by(Image.id).first()
+        if imagen is None:
+            link = ""
+        elif IMAGEN_PROXY:
+            link = f"{IMAGEN_PROXY_BASE}/imagenes/{imagen.id}"
+        else:
+            link = imagen.url
+        cache_imagenes.guardar(listing_id, link)
+    return link or None
+
+def _tarifa_listing(db: Session, listing_id: int, version: Optional[int] = None) -> Optional[tarifas.TarifaCompilada]:
+    """Tarifa compilada del alojamiento (temporadas + descuentos por duración), cacheada por worker.
+
+    Si se pasa la versión leída del alojamiento en esta misma sesión y no coincide
+    con la de la caché (otro worker escribió y el bus aún no ha llegado), se recompila.
+    """
+    entrada = cache_tarifas.obtener(listing_id)
+    if entrada is None or (version is not None and entrada[0] != version):
+        temporadas = db.query(seasonalPrices).filter(seasonalPrices.listing == listing_id).all()
+        descuentos = db.query(ListingLosDiscount).filter(ListingLosDiscount.listing_id == listing_id).all()
+        entrada = (version, tarifas.compilar_tarifa(temporadas, descuentos))
+        cache_tarifas.guardar(listing_id, entrada)
+    return entrada[1]
+
+def _precio_estancia(
+    db: Session,
+    listing_id: int,
+    fecha_entrada: datetime.datetime,
+    fecha_salida: datetime.datetime,
+    ocupantes: int,
+    mensaje_sin_precio: str = "No hay precios disponibles para estas fechas",
+    version: Optional[int] = None,
+    instantanea: Optional[Instantanea] = None
+):
+    """Devuelve (precio total, noches) o lanza el HTTPException correspondiente"""
+    dias_totales = (fecha_salida - fecha_entrada).days
+    if dias_totales <= 0:
+        raise HTTPException(status_code=400, detail="La fecha de salida debe ser posterior a la de entrada")
+
+    tarifa = instantanea.tarifa(listing_id) if instantanea is not None else _tarifa_listing(db, listing_id, version)
+    if tarifa is None:
+        raise HTTPException(status_code=404, detail=mensaje_sin_precio)
+
+    estancia_minima = tarifa.estancia_minima_en(fecha_entrada)
+    if dias_totales < estancia_minima:
+        raise HTTPException(status_code=400, detail=f"La estancia mínima para esta fecha es de {estancia_minima} noches")
+
+    total_precio = tarifa.precio_estancia(fecha_entrada, dias_totales, ocupantes)
+    if total_precio is None:
+        raise HTTPException(status_code=404, detail=mensaje_sin_precio)
+    return total_precio, dias_totales
 
 # 📌 ENDPOINTS
 
 # Página principal healthcheck
-@app.get("/")
+@router.get("/")
 def read_root():
     return {"status": "OK"}
 
 # Endpoint para crear un alojamiento
-@app.post("/listings")
+@router.post("/listings")
 def crear_alojamiento(alojamiento: AlojamientoCreate, db: Session = Depends(get_db)):
     nuevo_alojamiento = Alojamiento(**alojamiento.dict())
     try:
         db.add(nuevo_alojamiento)
+        db.flush()
+        resumenes.actualizar_listings(db, [nuevo_alojamiento.listing])
+        busqueda.indexar_listings(db, [nuevo_alojamiento.listing])
         db.commit()
         db.refresh(nuevo_alojamiento)
-        return {"mensaje": "Alojamiento creado exitosamente", "alojamiento": nuevo_alojamiento}
+        return {"mensaje": "Alojamiento creado exitosamente", "alojamiento": AlojamientoResponse.model_validate(nuevo_alojamiento)}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
         
 
+def _comprobar_urls_imagen(urls: List[str]):
+    # El proxy /imagenes/{url_id} descargará estas URLs: solo http(s) a hosts públicos o permitidos
+    # (IMAGENES_HOSTS_PERMITIDOS); la IP se vuelve a comprobar al descargar
+    for url in urls:
+        try:
+            comprobar_url(url, cache_disco_imagenes.hosts_permitidos)
+        except ErrorImagen as e:
+            raise HTTPException(status_code=400, detail=f"{str(e)}: {url}")
+
 # Endpoint para crear una imagen
-@app.post("/images")
+@router.post("/images")
 def crear_imagen(imagen: ImageCreate, db: Session = Depends(get_db)):
-    nueva_imagen = Image(
-        listing_id=imagen.listing_id,
-        link=imagen.link
-    )
-    
+    _comprobar_urls_imagen([imagen.link])
     try:
+        nueva_imagen = Image(
+            listing_id=imagen.listing_id,
+            url_id=ids_urls(db, [imagen.link])[imagen.link]
+        )
         db.add(nueva_imagen)
         db.commit()
         db.refresh(nueva_imagen)
-        return {"mensaje": "Imagen creada exitosamente", "imagen": nueva_imagen}
+        bus.publicar("listing", [nueva_imagen.listing_id])
+        return {"mensaje": "Imagen creada exitosamente", "imagen": ImageResponse.model_validate(nueva_imagen)}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al crear la imagen: {str(e)}")
 
+# Endpoint para asignar imágenes a muchos alojamientos de una vez
+@router.post("/images/bulk")
+def crear_imagenes_bulk(datos: ImageBulkCreate, db: Session = Depends(get_db)):
+    if any(not 0 <= indice < len(datos.urls) for _, indice in datos.asignaciones):
+        raise HTTPException(status_code=400, detail="Índice de URL fuera de rango")
+    _comprobar_urls_imagen(datos.urls)
+    try:
+        ids = ids_urls(db, datos.urls)
+        filas = [{"listing_id": listing_id, "url_id": ids[datos.urls[indice]]} for listing_id, indice in datos.asignaciones]
+        if filas:
+            db.execute(insert(Image), filas)
+        db.commit()
+        bus.publicar("listing", sorted({listing_id for listing_id, _ in datos.asignaciones}))
+        return {"mensaje": "Imágenes asignadas exitosamente", "insertadas": len(filas), "urls": len(ids)}
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error al crear las imágenes: {str(e)}")
+
+# Endpoint del proxy de imágenes: original o miniatura (?ancho=160|320|640|1280) desde la caché en disco
+@router.get("/imagenes/{url_id}")
+def obtener_imagen_proxy(url_id: int, request: Request, ancho: Optional[int] = None, db: Session = Depends(get_db_lectura)):
+    if ancho is not None and ancho not in cache_disco_imagenes.anchos:
+        raise HTTPException(status_code=400, detail=f"Ancho no soportado, use uno de {list(cache_disco_imagenes.anchos)}")
+    url = db.query(ImageUrl.url).filter(ImageUrl.id == url_id).scalar()
+    if url is None:
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+
+    try:
+        ruta, tipo, etag = coalescedor_imagenes.ejecutar(
+            None, (url_id, ancho), lambda: cache_disco_imagenes.obtener(url, ancho)
+        )
+    except ErrorImagen as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+    # El contenido de un id no cambia nunca: el navegador y las CDN pueden guardarlo un año
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{etag}"'}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(ruta, media_type=tipo, headers=headers)
+
 # Endpoint para crear una comisión de un alojamiento
-@app.post("/listing/Commission")
+@router.post("/listing/Commission")
 def crear_comision(comision: ListingCommissionCreate, db: Session = Depends(get_db)):
     nueva_comision = ListingCommission(
         listing_id=comision.listing_id,
@@ -194,13 +653,13 @@ def crear_comision(comision: ListingCommissionCreate, db: Session = Depends(get_
         db.add(nueva_comision)
         db.commit()
         db.refresh(nueva_comision)
-        return {"mensaje": "Comisión creada exitosamente", "comision": nueva_comision}
+        return {"mensaje": "Comisión creada exitosamente", "comision": ListingCommissionResponse.model_validate(nueva_comision)}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al crear la comisión: {str(e)}")
 
 # Endpoint para crear un servicio de un alojamiento
-@app.post("/listing/services")
+@router.post("/listing/services")
 def crear_servicio(servicio: ListingServiceCreate, db: Session = Depends(get_db)):
     nuevo_servicio = ListingService(
         listing_id=servicio.listing_id,
@@ -210,16 +669,17 @@ def crear_servicio(servicio: ListingServiceCreate, db: Session = Depends(get_db)
     
     try:
         db.add(nuevo_servicio)
+        busqueda.indexar_listings(db, [servicio.listing_id])
         db.commit()
         db.refresh(nuevo_servicio)
-        return {"mensaje": "Servicio creado exitosamente", "servicio": nuevo_servicio}
+        return {"mensaje": "Servicio creado exitosamente", "servicio": ListingServiceResponse.model_validate(nuevo_servicio)}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al crear el servicio: {str(e)}")
 
 
 # Endpoint para crear un cliente
-@app.post("/cliente")
+@router.post("/cliente")
 def crear_cliente(cliente: ClienteCreate, db: Session = Depends(get_db)):
     nuevo_cliente = Cliente(
         nombre=cliente.nombre,
@@ -230,14 +690,14 @@ def crear_cliente(cliente: ClienteCreate, db: Session = Depends(get_db)):
         db.add(nuevo_cliente)
         db.commit()
         db.refresh(nuevo_cliente)
-        return {"mensaje": "Cliente creado exitosamente", "cliente": nuevo_cliente}
+        return {"mensaje": "Cliente creado exitosamente", "cliente": ClienteResponse.model_validate(nuevo_cliente)}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al crear el cliente: {str(e)}")
 
 
 # Endpoint para crear una reserva
-@app.post("/reserva")
+@router.post("/reserva")
 def crear_reserva(reserva: ReservaCreate, db: Session = Depends(get_db)):
     nueva_reserva = Reserva(
         listing_id=reserva.listing_id,
@@ -258,7 +718,7 @@ def crear_reserva(reserva: ReservaCreate, db: Session = Depends(get_db)):
 
         return {
             "mensaje": "Reserva creada exitosamente",
-            "reserva": nueva_reserva,
+            "reserva": ReservaResponse.model_validate(nueva_reserva),
             "cliente": {"nombre": cliente.nombre, "email": cliente.email},
             "localizador": reserva.localizador
         }
@@ -266,82 +726,129 @@ def crear_reserva(reserva: ReservaCreate, db: Session = Depends(get_db)):
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al crear la reserva: {str(e)}")
 
+def _comprobar_formato_binario(formato: str):
+    if formato not in exportacion.FORMATOS:
+        raise HTTPException(status_code=406, detail=f"Formato no soportado: {formato}")
+    if not exportacion.soporta_binario():
+        raise HTTPException(status_code=406, detail="Formatos binarios no disponibles (falta pyarrow)")
+
+def _respuesta_binaria(construir_tabla, formato: str) -> Response:
+    """Serializa a Arrow IPC o Parquet la tabla que construye `construir_tabla`"""
+    _comprobar_formato_binario(formato)
+    contenido = exportacion.serializar_tabla(construir_tabla(), formato)
+    return Response(content=contenido, media_type=exportacion.FORMATOS[formato])
+
 # Endpoint para obtener todos los alojamientos
-@app.get("/listings")
-def obtener_alojamientos(db: Session = Depends(get_db)):
+@router.get("/listings", response_model=List[AlojamientoResponse])
+def obtener_alojamientos(request: Request, formato: Optional[str] = None, db: Session = Depends(get_db_lectura)):
     try:
         alojamientos = db.query(Alojamiento).all()
         if not alojamientos:
             raise HTTPException(status_code=404, detail="No hay alojamientos disponibles")
+        formato = exportacion.negociar_formato(formato, request.headers.get("accept", ""))
+        if formato != "json":
+            return _respuesta_binaria(
+                lambda: exportacion.tabla_alojamientos(
+                    [AlojamientoResponse.model_validate(a).model_dump() for a in alojamientos]
+                ),
+                formato
+            )
         return alojamientos
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener alojamientos: {str(e)}")
 
 # Endpoint para obtener todos los listings activos
-@app.get("/listings/actives")
-def obtener_alojamientos(db: Session = Depends(get_db)):
+@router.get("/listings/actives", response_model=List[AlojamientoResponse])
+def obtener_alojamientos_activos(db: Session = Depends(get_db_lectura)):
     try:
         alojamientos = db.query(Alojamiento).filter(Alojamiento.disponible == True).all()
         if not alojamientos:
             raise HTTPException(status_code=404, detail="No hay alojamientos disponibles")
         return alojamientos
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener alojamientos: {str(e)}")
 
 # Endpoint para obtener todos los listings inactivos
-@app.get("/listings/inactives")
-def obtener_alojamientos(db: Session = Depends(get_db)):
+@router.get("/listings/inactives", response_model=List[AlojamientoResponse])
+def obtener_alojamientos_inactivos(db: Session = Depends(get_db_lectura)):
     try:
         alojamientos = db.query(Alojamiento).filter(Alojamiento.disponible == False).all()
         if not alojamientos:
             raise HTTPException(status_code=404, detail="No hay alojamientos disponibles")
         return alojamientos
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener alojamientos: {str(e)}")
 
 # Endpoint para obtener los listings solo el id
-@app.get("/listings/ids")
-def obtener_alojamientos(db: Session = Depends(get_db)):
+@router.get("/listings/ids", response_model=List[int])
+def obtener_ids_alojamientos(
+    despues_de: Optional[int] = None,  # Paginación por clave: ids mayores que este, de `limit` en `limit`
+    limit: Optional[int] = None,
+    db: Session = Depends(get_db_lectura)
+):
     try:
-        alojamientos = db.query(Alojamiento.listing).all()
+        query = db.query(Alojamiento.listing)
+        if despues_de is not None:
+            query = query.filter(Alojamiento.listing > despues_de)
+        if limit is not None:
+            query = query.order_by(Alojamiento.listing).limit(max(1, min(limit, 100000)))
+        alojamientos = query.all()
+        if despues_de is not None and not alojamientos:
+            return []
         if not alojamientos:
             raise HTTPException(status_code=404, detail="No hay alojamientos disponibles")
         
         return [a[0] for a in alojamientos]  # Extraer los valores de la tupla
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener alojamientos: {str(e)}")
 
 
 # Endpoint para obtener los detalles de un alojamiento
-@app.get("/listings/{hotCodigo}")
-def obtener_alojamiento(hotCodigo: int, db: Session = Depends(get_db)):
-    alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == hotCodigo).first()
-    if not alojamiento:
-        raise HTTPException(status_code=404, detail="Alojamiento no encontrado")
+@router.get("/listings/{hotCodigo}", response_model=AlojamientoResponse)
+def obtener_alojamiento(hotCodigo: int, db: Session = Depends(get_db_lectura)):
+    alojamiento = cache_alojamientos.obtener(hotCodigo)
+    if alojamiento is None:
+        snap = _instantanea(hotCodigo)
+        if snap is not None:
+            alojamiento = AlojamientoResponse.model_validate(snap.alojamiento(hotCodigo))
+        else:
+            db_alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == hotCodigo).first()
+            if not db_alojamiento:
+                raise HTTPException(status_code=404, detail="Alojamiento no encontrado")
+            alojamiento = AlojamientoResponse.model_validate(db_alojamiento)
+        cache_alojamientos.guardar(hotCodigo, alojamiento)
     return alojamiento
 
 # Endpoint para obtener las imágenes de un alojamiento
-@app.get("/listings/{hotCodigo}/images")
-def obtener_imagenes(hotCodigo: int, db: Session = Depends(get_db)):
+@router.get("/listings/{hotCodigo}/images", response_model=Union[List[ImageResponse], MensajeResponse])
+def obtener_imagenes(hotCodigo: int, db: Session = Depends(get_db_lectura)):
     imagenes = db.query(Image).filter(Image.listing_id == hotCodigo).all()
     return imagenes if imagenes else {"mensaje": "No hay imágenes disponibles"}
 
 # Endpoint para obtener la comisión de un alojamiento
-@app.get("/listings/{hotCodigo}/commission")
-def obtener_comision(hotCodigo: int, db: Session = Depends(get_db)):
+@router.get("/listings/{hotCodigo}/commission", response_model=ListingCommissionResponse)
+def obtener_comision(hotCodigo: int, db: Session = Depends(get_db_lectura)):
     comision = db.query(ListingCommission).filter(ListingCommission.listing_id == hotCodigo).first()
     if not comision:
         raise HTTPException(status_code=404, detail="Comisión no encontrada")
     return comision
 
 # Endpoint para obtener los servicios de un alojamiento
-@app.get("/listings/{hotCodigo}/services")
-def obtener_servicios(hotCodigo: int, db: Session = Depends(get_db)):
+@router.get("/listings/{hotCodigo}/services", response_model=Union[List[ListingServiceResponse], MensajeResponse])
+def obtener_servicios(hotCodigo: int, db: Session = Depends(get_db_lectura)):
     servicios = db.query(ListingService).filter(ListingService.listing_id == hotCodigo).all()
     return servicios if servicios else {"mensaje": "No hay servicios disponibles"}
 
 # Endpoint para obtener un cliente por su ID
-@app.get("/clientes/{cliente_id}")
+@router.get("/clientes/{cliente_id}", response_model=ClienteResponse)
 def obtener_cliente(cliente_id: int, db: Session = Depends(get_db)):
     cliente = db.query(Cliente).filter(Cliente.id == cliente_id).first()
     if not cliente:
@@ -349,10 +856,20 @@ def obtener_cliente(cliente_id: int, db: Session = Depends(get_db)):
     return cliente
 
 # Endpoint para obtener una reserva por su ID
-@app.get("/traceSearch/{localizador}")
-def obtener_reserva(localizador: int, db: Session = Depends(get_db)):
-    reserva = db.query(Reserva).filter(Reserva.localizador == localizador).first()
-    alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == reserva.listing_id).first()
+@router.get("/traceSearch/{localizador}", response_model=TraceSearchResponse)
+def obtener_reserva(localizador: int, db: Session = Depends(get_db_lectura)):
+    # Se busca también entre las reservas archivadas
+    reserva = db.query(vista_reservas).filter(vista_reservas.c.localizador == localizador).first()
+    if not reserva and REPLICA_DATABASE_URLS:
+        # Puede ser una reserva recién creada que aún no ha llegado a la réplica
+        db = SessionLocal()
+        try:
+            reserva = db.query(vista_reservas).filter(vista_reservas.c.localizador == localizador).first()
+            alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == reserva.listing_id).first() if reserva else None
+        finally:
+            db.close()
+    elif reserva:
+        alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == reserva.listing_id).first()
     if not reserva:
         raise HTTPException(status_code=404, detail="Reserva no encontrada")
     return {
@@ -360,27 +877,73 @@ def obtener_reserva(localizador: int, db: Session = Depends(get_db)):
         "alojamiento": alojamiento
     }
 
-# Endpoint para obtener todas las reservas de un cliente
-@app.get("/clientes/{email}/reservas")
-def obtener_reservas_cliente(email: str, db: Session = Depends(get_db)):
-    reservas = db.query(Reserva).filter(Reserva.nombre_cliente == email).all()
-    return reservas if reservas else {"mensaje": "No hay reservas para este cliente"}
+def _codificar_cursor(fecha_reserva: datetime.datetime, reserva_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{fecha_reserva.isoformat()}|{reserva_id}".encode()).decode()
+
+def _decodificar_cursor(cursor: str):
+    try:
+        fecha, reserva_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(fecha), int(reserva_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+
+# Endpoint para obtener el historial de reservas de un cliente (más recientes primero, paginado por cursor)
+@router.get("/clientes/{email}/reservas", response_model=HistorialReservasResponse)
+def obtener_reservas_cliente(
+    email: str,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    desde: Optional[datetime.datetime] = None,  # Filtros sobre la fecha de reserva
+    hasta: Optional[datetime.datetime] = None,
+    db: Session = Depends(get_db_lectura)
+):
+    limit = max(1, min(limit, 200))
+    # Incluye las reservas archivadas; SQLite empuja los filtros a cada tabla de la vista
+    reservas_todas = vista_reservas.c
+    query = db.query(vista_reservas).filter(reservas_todas.email_cliente.collate("NOCASE") == email)
+    if desde:
+        query = query.filter(reservas_todas.fecha_reserva >= desde)
+    if hasta:
+        query = query.filter(reservas_todas.fecha_reserva < hasta)
+    if cursor:
+        query = query.filter(tuple_(reservas_todas.fecha_reserva, reservas_todas.id) < tuple_(*_decodificar_cursor(cursor)))
+
+    # Se pide una fila de más para saber si hay página siguiente
+    reservas = query.order_by(reservas_todas.fecha_reserva.desc(), reservas_todas.id.desc()).limit(limit + 1).all()
+    siguiente_cursor = None
+    if len(reservas) > limit:
+        reservas = reservas[:limit]
+        siguiente_cursor = _codificar_cursor(reservas[-1].fecha_reserva, reservas[-1].id)
+    return {"reservas": reservas, "siguiente_cursor": siguiente_cursor}
 
 # Endpoint para obtener todas las reservas de un alojamiento
-@app.get("/listings/{hotCodigo}/reservas")
-def obtener_reservas_alojamiento(hotCodigo: int, db: Session = Depends(get_db)):
-    reservas = db.query(Reserva).filter(Reserva.listing_id == hotCodigo).all()
+@router.get("/listings/{hotCodigo}/reservas", response_model=Union[List[ReservaResponse], MensajeResponse])
+def obtener_reservas_alojamiento(hotCodigo: int, db: Session = Depends(get_db_lectura)):
+    reservas = db.query(vista_reservas).filter(vista_reservas.c.listing_id == hotCodigo).all()
     return reservas if reservas else {"mensaje": "No hay reservas para este alojamiento"}
 
 
 # Obtener alojamientos que no tienen reservas en un rago de fechas para la disponibilidad
-@app.get("/check-availability")
+@router.get("/check-availability", response_model=DisponibilidadResponse)
 def obtener_alojamiento_disponible(
     fecha_entrada: datetime.datetime, 
     fecha_salida: datetime.datetime, 
     listing_id: int,  # Solo un ID de alojamiento
     occupants: int,  # Número de personas
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_lectura)
+):
+    return coalescedor.ejecutar(
+        listing_id,
+        ("check-availability", fecha_entrada, fecha_salida, occupants),
+        lambda: _calcular_disponibilidad(db, fecha_entrada, fecha_salida, listing_id, occupants)
+    )
+
+def _calcular_disponibilidad(
+    db: Session,
+    fecha_entrada: datetime.datetime,
+    fecha_salida: datetime.datetime,
+    listing_id: int,
+    occupants: int
 ):
     # Consultar el alojamiento específico
     alojamiento_disponible = db.query(Alojamiento).filter(
@@ -395,122 +958,126 @@ def obtener_alojamiento_disponible(
     # Verificar si el alojamiento está reservado en las fechas solicitadas
     reserva_existente = db.query(Reserva).filter(
         Reserva.listing_id == alojamiento_disponible.listing,
-        (Reserva.fecha_entrada < fecha_salida), 
-        (Reserva.fecha_salida > fecha_entrada)
+        Reserva.dia_entrada < tarifas.a_dia(fecha_salida),
+        Reserva.dia_salida > tarifas.a_dia(fecha_entrada)
     ).first()
 
     # Obtener políticas de cancelación (ordenadas de mayor a menor)
-    politicas = db.query(PoliticaCancelacion).order_by(PoliticaCancelacion.dias_antes_cancelacion.desc()).all()
+    politicas = _politicas_cancelacion(db)
 
     #Obtener la url de la imagen del alojamiento
-    imagen = db.query(Image).filter(Image.listing_id == alojamiento_disponible.listing).first()
+    imagen = _imagen_principal(db, alojamiento_disponible.listing)
 
     if reserva_existente:
         raise HTTPException(status_code=404, detail="El alojamiento no está disponible en estas fechas")
 
-    # Obtener precios de temporada para el alojamiento específico
-    precios = db.query(seasonalPrices).filter(
-        seasonalPrices.listing == alojamiento_disponible.listing,
-        seasonalPrices.start_date <= fecha_salida,
-        seasonalPrices.end_date >= fecha_entrada
-    ).all()
-
-    if not precios:
-        raise HTTPException(status_code=404, detail="No hay precios disponibles para estas fechas")
-
-    # Calcular el precio total de la estancia
-    total_precio = 0
-    dias_totales = (fecha_salida - fecha_entrada).days
-
-    for dia in range(dias_totales):
-        fecha_actual = fecha_entrada + datetime.timedelta(days=dia)
-        for precio in precios:
-            if precio.start_date <= fecha_actual <= precio.end_date:
-                total_precio += precio.price
-                break  # Tomamos el primer precio válido para esa fecha        
+    # Calcular el precio total de la estancia con la tarifa compilada
+    total_precio, dias_totales = _precio_estancia(
+        db, alojamiento_disponible.listing, fecha_entrada, fecha_salida, occupants,
+        version=alojamiento_disponible.version
+    )
 
-    # Devolver el resultado
+    # Devolver el resultado (sin objetos ORM: se comparte entre peticiones)
     return {
-        "alojamiento": alojamiento_disponible,
+        "alojamiento": AlojamientoResponse.model_validate(alojamiento_disponible),
         "precio_total": total_precio,
         "precio_por_dia": total_precio / dias_totales,
         "ocupantes": occupants,
-        "imagen": imagen.link if imagen else None,
-        "politicas_cancelacion": [
-        {
-            "dias_antes": p.dias_antes_cancelacion,
-            "penalizacion": p.porcentaje_penalizacion
-        } for p in politicas
-        ]
+        "imagen": imagen,
+        "politicas_cancelacion": politicas
     }
 
-@app.get("/quote")
+@router.get("/quote", response_model=CotizacionResponse)
 def cotizar_alojamiento(
     fecha_entrada: datetime.datetime,
     fecha_salida: datetime.datetime,
     listing_id: int,
     num_personas: int,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_lectura)
 ):
-    alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == listing_id, Alojamiento.disponible == True).first()
+    return coalescedor.ejecutar(
+        listing_id,
+        ("quote", fecha_entrada, fecha_salida, num_personas),
+        lambda: _calcular_cotizacion(db, fecha_entrada, fecha_salida, listing_id, num_personas)
+    )
+
+def _calcular_cotizacion(
+    db: Session,
+    fecha_entrada: datetime.datetime,
+    fecha_salida: datetime.datetime,
+    listing_id: int,
+    num_personas: int
+):
+    # Con la instantánea (si cubre las fechas) no se consulta SQLite para alojamiento, reservas ni precios
+    snap = _instantanea(listing_id)
+    if snap is not None and not snap.cubre(fecha_entrada, fecha_salida):
+        snap = None
+    if snap is not None:
+        datos = snap.alojamiento(listing_id)
+        alojamiento = AlojamientoResponse.model_validate(datos) if datos["disponible"] else None
+        version = datos["version"]
+    else:
+        alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == listing_id, Alojamiento.disponible == True).first()
+        version = alojamiento.version if alojamiento else None
     if not alojamiento:
         raise HTTPException(status_code=404, detail="Alojamiento no encontrado o no disponible")
 
     if num_personas > alojamiento.occupants:
         raise HTTPException(status_code=400, detail=f"El alojamiento solo permite hasta {alojamiento.occupants} personas")
 
-    reserva_existente = db.query(Reserva).filter(
-        Reserva.listing_id == alojamiento.listing,
-        (Reserva.fecha_entrada < fecha_salida), 
-        (Reserva.fecha_salida > fecha_entrada)
-    ).first()
+    if snap is not None:
+        reserva_existente = snap.ocupada(listing_id, fecha_entrada, fecha_salida)
+    else:
+        reserva_existente = db.query(Reserva).filter(
+            Reserva.listing_id == alojamiento.listing,
+            Reserva.dia_entrada < tarifas.a_dia(fecha_salida),
+            Reserva.dia_salida > tarifas.a_dia(fecha_entrada)
+        ).first()
     
-    politicas = db.query(PoliticaCancelacion).order_by(PoliticaCancelacion.dias_antes_cancelacion.desc()).all()
+    politicas = _politicas_cancelacion(db)
 
     # Obtener la url de la imagen del alojamiento
-    imagen = db.query(Image).filter(Image.listing_id == alojamiento.listing).first()
+    imagen = _imagen_principal(db, alojamiento.listing)
 
 
     if reserva_existente:
         raise HTTPException(status_code=400, detail="El alojamiento no está disponible en estas fechas")
 
-    precios = db.query(seasonalPrices).filter(
-        seasonalPrices.listing == alojamiento.listing,
-        seasonalPrices.start_date <= fecha_salida,
-        seasonalPrices.end_date >= fecha_entrada
-    ).all()
-
-    if not precios:
-        raise HTTPException(status_code=404, detail="No hay precios disponibles para estas fechas")
-
-    total_precio = 0
-    dias_totales = (fecha_salida - fecha_entrada).days
+    total_precio, dias_totales = _precio_estancia(
+        db, alojamiento.listing, fecha_entrada, fecha_salida, num_personas,
+        version=version,
+        instantanea=snap
+    )
 
-    for dia in range(dias_totales):
-        fecha_actual = fecha_entrada + datetime.timedelta(days=dia)
-        for precio in precios:
-            if precio.start_date <= fecha_actual <= precio.end_date:
-                total_precio += precio.price
-                break  
+    # Token firmado con el precio y el sello de versión: /confirm lo reutiliza sin recalcular
+    quote_token = token_cotizacion.firmar(
+        {
+            "listing_id": alojamiento.listing,
+            "fecha_entrada": fecha_entrada.isoformat(),
+            "fecha_salida": fecha_salida.isoformat(),
+            "num_personas": num_personas,
+            "precio_total": total_precio,
+            "version": version or 0
+        },
+        QUOTE_TOKEN_SECRET,
+        QUOTE_TOKEN_TTL
+    )
 
     return {
-    "alojamiento": alojamiento,
+    "alojamiento": AlojamientoResponse.model_validate(alojamiento),
     "precio_total": total_precio,
     "precio_por_dia": total_precio / dias_totales,
     "num_personas": num_personas,
-    "imagen": imagen.link if imagen else None,
-    "politicas_cancelacion": [
-        {
-            "dias_antes": p.dias_antes_cancelacion,
-            "penalizacion": p.porcentaje_penalizacion
-        } for p in politicas
-    ]
+    "quote_token": quote_token,
+    "imagen": imagen,
+    "politicas_cancelacion": politicas
 }
 
-@app.post("/confirm")
+@router.post("/confirm")
 def confirmar_reserva(
     data: ReservaCreate,
     background_tasks: BackgroundTasks,
+    response: Response,
     db: Session = Depends(get_db)
 ):
     # Verificar alojamiento
@@ -522,35 +1089,32 @@ def confirmar_reserva(
     if not alojamiento:
         raise HTTPException(status_code=404, detail="Alojamiento no disponible")
 
-    # Verificar que no haya reservas en el rango
-    reserva_existente = db.query(Reserva).filter(
-        Reserva.listing_id == data.listing_id,
-        (Reserva.fecha_entrada < data.fecha_salida), 
-        (Reserva.fecha_salida > data.fecha_entrada)
-    ).first()
-
-    if reserva_existente:
-        raise HTTPException(status_code=400, detail="El alojamiento ya está reservado en ese rango de fechas")
-
-    # Obtener precios
-    precios = db.query(seasonalPrices).filter(
-        seasonalPrices.listing == data.listing_id,
-        seasonalPrices.start_date <= data.fecha_salida,
-        seasonalPrices.end_date >= data.fecha_entrada
-    ).all()
-
-    if not precios:
-        raise HTTPException(status_code=404, detail="No hay precios para este alojamiento en estas fechas")
-
-    dias_totales = (data.fecha_salida - data.fecha_entrada).days
-    total_precio = 0
+    if data.num_personas > alojamiento.occupants:
+        raise HTTPException(status_code=400, detail=f"El alojamiento solo permite hasta {alojamiento.occupants} personas")
 
-    for dia in range(dias_totales):
-        fecha_actual = data.fecha_entrada + datetime.timedelta(days=dia)
-        for precio in precios:
-            if precio.start_date <= fecha_actual <= precio.end_date:
-                total_precio += precio.price
-                break
+    # Si el token de /quote sigue vigente (misma versión del alojamiento), su precio es válido
+    # y no hay reservas nuevas en el rango: se salta la comprobación de solapes y el recálculo
+    cotizacion = _cotizacion_vigente(data, alojamiento)
+    if cotizacion is not None:
+        total_precio = cotizacion["precio_total"]
+        dias_totales = (data.fecha_salida - data.fecha_entrada).days
+    else:
+        # Verificar que no haya reservas en el rango
+        reserva_existente = db.query(Reserva).filter(
+            Reserva.listing_id == data.listing_id,
+            Reserva.dia_entrada < tarifas.a_dia(data.fecha_salida),
+            Reserva.dia_salida > tarifas.a_dia(data.fecha_entrada)
+        ).first()
+
+        if reserva_existente:
+            raise HTTPException(status_code=400, detail="El alojamiento ya está reservado en ese rango de fechas")
+
+        # Calcular precio con la tarifa compilada
+        total_precio, dias_totales = _precio_estancia(
+            db, data.listing_id, data.fecha_entrada, data.fecha_salida, data.num_personas,
+            mensaje_sin_precio="No hay precios para este alojamiento en estas fechas",
+            version=alojamiento.version
+        )
 
     localizador = generar_localizador_unico(db)            
     nueva_reserva = Reserva(
@@ -564,22 +1128,36 @@ def confirmar_reserva(
     )
 
     try:
+        # Control optimista: la versión tiene que seguir siendo la leída; si otra escritura
+        # se ha colado entre medias, la reserva no se confirma con datos obsoletos. El UPDATE
+        # no cambia nada, pero toma el bloqueo de escritura antes de insertar; la versión la
+        # sube el trigger de reservas (database.TRIGGERS_VERSION).
+        vigente = db.query(Alojamiento).filter(
+            Alojamiento.listing == data.listing_id,
+            func.coalesce(Alojamiento.version, 0) == (alojamiento.version or 0)
+        ).update(
+            {Alojamiento.version: Alojamiento.version},
+            synchronize_session=False
+        )
+        if not vigente:
+            db.rollback()
+            raise HTTPException(status_code=409, detail="El alojamiento ha cambiado, vuelva a cotizar")
         db.add(nueva_reserva)
         db.commit()
         db.refresh(nueva_reserva)
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al confirmar la reserva: {str(e)}")
 
+    bus.publicar("listing", [data.listing_id])
+    _marcar_escritura(response)
+
     # select alojamiento desde base de datos
     alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == data.listing_id).first()
     
     # Notificar a los webhooks suscritos
-    webhooks = db.query(ClientWebhook).filter(
-        ClientWebhook.is_active == True,
-        ClientWebhook.event_types.contains("delete_los")
-    ).all()
-
     payload = {
         "event_type": "delete_los",
         "listing_id": data.listing_id,
@@ -590,14 +1168,7 @@ def confirmar_reserva(
         },
         "timestamp": datetime.datetime.now().isoformat()
     }
-
-    for webhook in webhooks:
-        background_tasks.add_task(
-            _send_webhook_implementation,
-            url=webhook.webhook_url,
-            payload=payload,
-            token=webhook.secret_token
-        )
+    _notificar_webhooks(db, background_tasks, "delete_los", payload)
 
     return {
         "mensaje": "Reserva confirmada exitosamente",
@@ -608,7 +1179,8 @@ def confirmar_reserva(
             "localizador": localizador,
             "precio_total": total_precio,
             "precio_por_dia": total_precio / dias_totales,
-            "información alojamiento": alojamiento,
+            "cotizacion_reutilizada": cotizacion is not None,
+            "información alojamiento": AlojamientoResponse.model_validate(alojamiento),
             "información cliente": {
                 "nombre": data.nombre_cliente,  
                 "email": data.email_cliente
@@ -616,16 +1188,32 @@ def confirmar_reserva(
         }
     }
 
+def _cotizacion_vigente(data: ReservaCreate, alojamiento: Alojamiento) -> Optional[dict]:
+    """Datos del quote_token si es válido para esta reserva y el alojamiento no ha cambiado desde /quote"""
+    if not data.quote_token:
+        return None
+    cotizacion = token_cotizacion.verificar(data.quote_token, QUOTE_TOKEN_SECRET)
+    if cotizacion is None:
+        return None
+    coincide = (
+        cotizacion["listing_id"] == data.listing_id
+        and cotizacion["fecha_entrada"] == data.fecha_entrada.isoformat()
+        and cotizacion["fecha_salida"] == data.fecha_salida.isoformat()
+        and cotizacion["num_personas"] == data.num_personas
+        and cotizacion["version"] == (alojamiento.version or 0)
+    )
+    return cotizacion if coincide else None
+
 def generar_localizador_unico(db: Session):
     while True:
         localizador = randint(100000, 9999999)
-        existe = db.query(Reserva).filter(Reserva.localizador == localizador).first()
+        existe = db.query(vista_reservas.c.id).filter(vista_reservas.c.localizador == localizador).first()
         if not existe:
             return localizador
 
 
 # Endpoint para eliminar la informacion de imagenes de un alojamiento
-@app.delete("/images/{image_id}")
+@router.delete("/images/{image_id}")
 def eliminar_imagen(image_id: int, db: Session = Depends(get_db)):
     imagen = db.query(Image).filter(Image.id == image_id).first()
     if not imagen:
@@ -634,42 +1222,171 @@ def eliminar_imagen(image_id: int, db: Session = Depends(get_db)):
     try:
         db.delete(imagen)
         db.commit()
+        bus.publicar("listing", [imagen.listing_id])
         return {"mensaje": "Imagen eliminada exitosamente"}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al eliminar la imagen: {str(e)}")
     
 
-@app.post("/listing/prices")
-def crear_precio(precio: SeasonalPricesCreate, db: Session = Depends(get_db)):
+@router.post("/listing/prices")
+def crear_precio(precio: SeasonalPricesCreate, response: Response, db: Session = Depends(get_db)):
     nuevo_precio = seasonalPrices(
         listing=precio.listing,
         price=precio.price,
         start_date=precio.start_date,
-        end_date=precio.end_date
+        end_date=precio.end_date,
+        priority=precio.priority,
+        weekend_modifier=precio.weekend_modifier,
+        min_stay=precio.min_stay,
+        extra_occupant_price=precio.extra_occupant_price
     )
     try:
         db.add(nuevo_precio)
+        resumenes.actualizar_listings(db, [precio.listing])
         db.commit()
         db.refresh(nuevo_precio)
-        return {"mensaje": "Precio de temporada creado exitosamente", "precio": nuevo_precio}
+        bus.publicar("listing", [nuevo_precio.listing])
+        _marcar_escritura(response)
+        return {"mensaje": "Precio de temporada creado exitosamente", "precio": SeasonalPricesResponse.model_validate(nuevo_precio)}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al crear el precio: {str(e)}")
 
+# Endpoint para crear un descuento por duración de estancia
+@router.post("/listing/discounts")
+def crear_descuento(descuento: ListingLosDiscountCreate, response: Response, db: Session = Depends(get_db)):
+    if descuento.min_nights < 1 or not 0 <= descuento.discount < 100:
+        raise HTTPException(status_code=400, detail="Descuento no válido")
+
+    nuevo_descuento = ListingLosDiscount(
+        listing_id=descuento.listing_id,
+        min_nights=descuento.min_nights,
+        discount=descuento.discount
+    )
+    try:
+        db.add(nuevo_descuento)
+        db.commit()
+        db.refresh(nuevo_descuento)
+        bus.publicar("listing", [nuevo_descuento.listing_id])
+        _marcar_escritura(response)
+        return {"mensaje": "Descuento creado exitosamente", "descuento": ListingLosDiscountResponse.model_validate(nuevo_descuento)}
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error al crear el descuento: {str(e)}")
+
+def _aplicar_ajuste_precios(db: Session, ajuste: AjustePrecios) -> Tuple[int, set]:
+    """UPDATE único sobre seasonal_prices; devuelve (filas actualizadas, alojamientos afectados)"""
+    if sum(valor is not None for valor in (ajuste.porcentaje, ajuste.importe, ajuste.precio)) != 1:
+        raise HTTPException(status_code=400, detail="Indique exactamente uno de porcentaje, importe o precio")
+    if ajuste.hasta < ajuste.desde:
+        raise HTTPException(status_code=400, detail="La fecha de fin debe ser posterior a la de inicio")
+
+    if ajuste.porcentaje is not None:
+        nuevo_precio = func.round(seasonalPrices.price * (1 + ajuste.porcentaje / 100), 2)
+    elif ajuste.importe is not None:
+        nuevo_precio = func.max(func.round(seasonalPrices.price + ajuste.importe, 2), 0)
+    else:
+        nuevo_precio = ajuste.precio
+
+    condiciones = [seasonalPrices.dia_inicio <= tarifas.a_dia(ajuste.hasta), seasonalPrices.dia_fin >= tarifas.a_dia(ajuste.desde)]
+    if ajuste.listing_ids is not None:
+        condiciones.append(seasonalPrices.listing.in_(ajuste.listing_ids))
+    if ajuste.ciudad is not None or ajuste.pais is not None:
+        alojamientos = select(Alojamiento.listing)
+        if ajuste.ciudad is not None:
+            alojamientos = alojamientos.where(Alojamiento.ciudad == ajuste.ciudad)
+        if ajuste.pais is not None:
+            alojamientos = alojamientos.where(Alojamiento.pais == ajuste.pais)
+        condiciones.append(seasonalPrices.listing.in_(alojamientos))
+
+    afectadas = db.execute(
+        update(seasonalPrices).where(*condiciones).values(price=nuevo_precio).returning(seasonalPrices.listing)
+    ).scalars().all()
+    return len(afectadas), set(afectadas)
+
+def _fijar_precios(db: Session, precios: List[SeasonalPricesCreate]) -> Tuple[int, int, set]:
+    """Upsert por (listing, start_date, end_date): un SELECT, un executemany de UPDATE y un INSERT múltiple"""
+    # Con la misma clave repetida en la petición gana la última (si no, se insertaría dos veces)
+    precios = list({(p.listing, p.start_date, p.end_date): p for p in precios}.values())
+    existentes = {}
+    claves_lista = [(p.listing, p.start_date, p.end_date) for p in precios]
+    for i in range(0, len(claves_lista), 500):
+        for fila in db.query(seasonalPrices.id, seasonalPrices.listing, seasonalPrices.start_date, seasonalPrices.end_date).filter(
+            tuple_(seasonalPrices.listing, seasonalPrices.start_date, seasonalPrices.end_date).in_(claves_lista[i:i + 500])
+        ):
+            existentes.setdefault((fila.listing, fila.start_date, fila.end_date), fila.id)
+
+    actualizar, insertar = [], []
+    for p in precios:
+        campos = p.model_dump()
+        id_existente = existentes.get((p.listing, p.start_date, p.end_date))
+        if id_existente is None:
+            insertar.append(campos)
+        else:
+            actualizar.append({"id": id_existente, **campos})
+    if actualizar:
+        db.execute(update(seasonalPrices), actualizar)
+    if insertar:
+        db.execute(insert(seasonalPrices), insertar)
+    return len(actualizar), len(insertar), {p.listing for p in precios}
+
+# Endpoint para ajustar o fijar precios de temporada en bloque (una transacción, una invalidación)
+@router.post("/listing/prices/bulk")
+def actualizar_precios_bulk(datos: PreciosBulkRequest, response: Response, db: Session = Depends(get_db)):
+    if datos.ajuste is None and not datos.precios:
+        raise HTTPException(status_code=400, detail="No hay cambios de precios que aplicar")
+    try:
+        ajustadas, listing_ids = _aplicar_ajuste_precios(db, datos.ajuste) if datos.ajuste else (0, set())
+        actualizadas, insertadas, fijados = _fijar_precios(db, datos.precios) if datos.precios else (0, 0, set())
+        listing_ids |= fijados
+        if listing_ids:
+            resumenes.actualizar_listings(db, listing_ids)
+        db.commit()
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error al actualizar los precios: {str(e)}")
+
+    _publicar_listings(listing_ids)
+    _marcar_escritura(response)
+    return {
+        "mensaje": "Precios actualizados exitosamente",
+        "ajustadas": ajustadas,
+        "actualizadas": actualizadas,
+        "insertadas": insertadas,
+        "alojamientos": len(listing_ids)
+    }
+
 class AlojamientoUpdateRequest(BaseModel):
     alojamiento: AlojamientoCreate  
     listing_id: int 
 
+class AlojamientoPatch(AlojamientoCreate):
+    listing_id: int
+
+class AlojamientosBulkRequest(BaseModel):
+    # Cada elemento solo lleva los campos que cambian; si un listing se repite, gana el último
+    actualizaciones: List[AlojamientoPatch] = Field(..., max_length=5000)
+
 class CancelarReservaRequest(BaseModel):
     localizador: int
     email_cliente: str    
+    compacto: bool = False  # Records LOS en formato compacto (ver los_compacto.py)
 
+class CancelarReservasBulkRequest(BaseModel):
+    localizadores: List[int] = Field(..., max_length=5000)
+    email_cliente: str  # Como en /cancel: solo se cancelan las reservas de ese cliente
+    compacto: bool = False
 
-@app.put("/listings")
+
+@router.put("/listings")
 def actualizar_alojamiento(
     request_data: AlojamientoUpdateRequest,  # Solo recibimos el body
     background_tasks: BackgroundTasks,
+    response: Response,
     db: Session = Depends(get_db)
 ):
     # Extraemos el listing_id del body
@@ -694,42 +1411,218 @@ def actualizar_alojamiento(
                 changed_fields["listing_id"] = listing_id
 
     try:
+        if changed_fields:
+            resumenes.actualizar_listings(db, [listing_id])
+            busqueda.indexar_listings(db, [listing_id])
         db.commit()
         db.refresh(db_alojamiento)
+        bus.publicar("listing", [listing_id])
+        _marcar_escritura(response)
 
         # Notificar a los webhooks suscritos
-        webhooks = db.query(ClientWebhook).filter(
-            ClientWebhook.is_active == True,
-            ClientWebhook.event_types.contains("listing_updated")
-        ).all()
-        
         payload = {
             "event_type": "listing_updated",
             "listing_id": listing_id,
             "data": changed_fields,
             "timestamp": datetime.datetime.now().isoformat()
         }
-        
-        for webhook in webhooks:
-            background_tasks.add_task(
-                _send_webhook_implementation,
-                url=webhook.webhook_url,
-                payload=payload,
-                token=webhook.secret_token
-        )
+        _notificar_webhooks(db, background_tasks, "listing_updated", payload)
 
         return {
             "mensaje": "Alojamiento actualizado exitosamente",
-            "alojamiento": db_alojamiento
+            "alojamiento": AlojamientoResponse.model_validate(db_alojamiento)
         }
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al actualizar: {str(e)}")
     
-@app.get("/lenght_of_stay/{listing_id}")
-def generar_disponibilidad_anual(listing_id: int, db: Session = Depends(get_db)):
+# Campos que alimentan las facetas y el índice de texto: si no cambian, no se recalculan
+CAMPOS_RESUMEN = {"ciudad", "pais", "disponible", "occupants"}
+CAMPOS_BUSQUEDA = {"nombre", "direccion", "ciudad"}
+
+# Endpoint para actualizar muchos alojamientos a la vez (p. ej. cambiar la disponibilidad de cientos)
+@router.patch("/listings/bulk")
+def actualizar_alojamientos_bulk(
+    datos: AlojamientosBulkRequest,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    db: Session = Depends(get_db)
+):
+    pendientes = {}
+    for actualizacion in datos.actualizaciones:
+        campos = actualizacion.model_dump(exclude_unset=True, exclude={"listing_id"})
+        pendientes.setdefault(actualizacion.listing_id, {}).update(campos)
+
+    # Un solo SELECT (por tandas) con el estado actual para quedarse solo con los cambios reales
+    columnas = [getattr(Alojamiento, campo) for campo in AlojamientoCreate.model_fields]
+    actuales = {}
+    listing_ids = list(pendientes)
+    for i in range(0, len(listing_ids), 500):
+        for fila in db.query(Alojamiento.listing, *columnas).filter(Alojamiento.listing.in_(listing_ids[i:i + 500])):
+            actuales[fila.listing] = fila._mapping
+
+    cambios = {}
+    for listing_id, campos in pendientes.items():
+        actual = actuales.get(listing_id)
+        if actual is None:
+            continue
+        cambiados = {campo: valor for campo, valor in campos.items() if actual[campo] != valor}
+        if cambiados:
+            cambios[listing_id] = cambiados
+    no_encontrados = [listing_id for listing_id in pendientes if listing_id not in actuales]
+
+    if not cambios:
+        return {
+            "mensaje": "No hay cambios que aplicar",
+            "actualizados": 0,
+            "sin_cambios": len(actuales),
+            "no_encontrados": no_encontrados
+        }
+
+    try:
+        # executemany por clave primaria; SQLAlchemy agrupa las filas que cambian los mismos campos
+        db.execute(update(Alojamiento), [{"listing": listing_id, **cambiados} for listing_id, cambiados in cambios.items()])
+        resumenes.actualizar_listings(db, [l for l, c in cambios.items() if CAMPOS_RESUMEN & c.keys()])
+        busqueda.indexar_listings(db, [l for l, c in cambios.items() if CAMPOS_BUSQUEDA & c.keys()])
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error al actualizar: {str(e)}")
+
+    _publicar_listings(cambios)
+    _marcar_escritura(response)
+
+    # Una sola notificación por suscriptor con todos los cambios; tipo de evento propio
+    # (como update_los_batch) porque la forma no es la de listing_updated de PUT /listings
+    payload = {
+        "event_type": "listing_updated_batch",
+        "listing_ids": list(cambios),
+        "data": [{"listing_id": listing_id, **cambiados} for listing_id, cambiados in cambios.items()],
+        "timestamp": datetime.datetime.now().isoformat()
+    }
+    _notificar_webhooks(db, background_tasks, "listing_updated", payload)
+
+    return {
+        "mensaje": "Alojamientos actualizados exitosamente",
+        "actualizados": len(cambios),
+        "sin_cambios": len(actuales) - len(cambios),
+        "no_encontrados": no_encontrados
+    }
+
+def _tarifa_ventana(db: Session, listing_id: int, desde: datetime.date, hasta: datetime.date) -> Optional[tarifas.TarifaCompilada]:
+    """Tarifa compilada solo con las temporadas que pisan [desde, hasta), para regenerar unas pocas noches"""
+    temporadas = db.query(seasonalPrices).filter(
+        seasonalPrices.listing == listing_id,
+        seasonalPrices.dia_fin >= tarifas.a_dia(desde),
+        seasonalPrices.dia_inicio < tarifas.a_dia(hasta)
+    ).all()
+    descuentos = db.query(ListingLosDiscount).filter(ListingLosDiscount.listing_id == listing_id).all()
+    return tarifas.compilar_tarifa(temporadas, descuentos)
+
+def _filas_los(
+    db: Session,
+    listing_id: int,
+    ocupantes_max: int,
+    desde: datetime.date,
+    dias: int,
+    solo_ventana: bool = False,
+    version: Optional[int] = None,
+    compacta: bool = False
+):
+    """Filas LOS de [desde, desde + dias) evaluadas sobre la tarifa compilada; None si no hay precios.
+
+    Con solo_ventana se compilan únicamente las temporadas de la ventana en lugar de usar la tarifa completa.
+    Con compacta las filas agrupan ocupantes (ver TarifaCompilada.tabla_los_compacta).
+    """
+    # Solo interesan las reservas y precios que pisan la ventana (más la cola de la estancia más larga)
+    ventana = dias + tarifas.MAX_NOCHES_LOS
+    hasta = desde + datetime.timedelta(days=ventana)
+    tarifa = _tarifa_ventana(db, listing_id, desde, hasta) if solo_ventana else _tarifa_listing(db, listing_id, version)
+    if tarifa is None:
+        return None
+
+    # También las que salen el primer día: ese día no se lista como llegada
+    reservas = db.query(Reserva.dia_entrada, Reserva.dia_salida).filter(
+        Reserva.listing_id == listing_id,
+        Reserva.dia_salida >= tarifas.a_dia(desde),
+        Reserva.dia_entrada < tarifas.a_dia(hasta)
+    ).all()
+    ocupadas = tarifas.acumulado_ocupacion(reservas, desde, ventana)
+    vispera_ocupada = any(salida == tarifas.a_dia(desde) for _, salida in reservas)
+    tabla = tarifa.tabla_los_compacta if compacta else tarifa.tabla_los
+    return tabla(desde, dias, ocupantes_max, ocupadas, vispera_ocupada=vispera_ocupada)
+
+def _filas_los_instantanea(
+    snap: Instantanea,
+    listing_id: int,
+    ocupantes_max: int,
+    desde: datetime.date,
+    dias: int,
+    compacta: bool = False
+):
+    """Como _filas_los, con la tarifa y la ocupación leídas de la instantánea"""
+    tarifa = snap.tarifa(listing_id)
+    if tarifa is None:
+        return None
+    ocupadas = snap.ocupacion(listing_id, desde, dias + tarifas.MAX_NOCHES_LOS)
+    tabla = tarifa.tabla_los_compacta if compacta else tarifa.tabla_los
+    return tabla(desde, dias, ocupantes_max, ocupadas, vispera_ocupada=snap.vispera_ocupada(listing_id, desde))
+
+# Precio de las duraciones que no se pueden reservar (alguna noche ocupada o sin precio, o por debajo de la estancia mínima)
+LOS_NO_RESERVABLE = "null"
+
+def _formatear_precios_los(precios: List[Optional[float]]) -> str:
+    # "1:150.0,2:300.0,...,17:2550.0": siempre las 17 duraciones, como el formato original
+    return ",".join(
+        f"{dias}:{LOS_NO_RESERVABLE if precio is None else precio}" for dias, precio in enumerate(precios, start=1)
+    )
+
+def _records_los_compactos(filas, separador: str = ",", prefijo: str = "") -> List[str]:
+    # Filas de tabla_los_compacta -> records en formato compacto (ver los_compacto.py)
+    return los_compacto.codificar(
+        ((fecha, desde, hasta, _formatear_precios_los(precios)) for fecha, desde, hasta, precios in filas),
+        separador,
+        prefijo
+    )
+
+@router.get("/lenght_of_stay/{listing_id}", response_model=LOSResponse)
+def generar_disponibilidad_anual(
+    listing_id: int,
+    request: Request,
+    formato: Optional[str] = None,
+    compacto: bool = False,  # Records agrupados por rangos de ocupantes y fechas (solo JSON)
+    db: Session = Depends(get_db_lectura)
+):
+    formato = exportacion.negociar_formato(formato, request.headers.get("accept", ""))
+    if formato != "json":
+        _comprobar_formato_binario(formato)
+        compacto = False
+
+    hoy = datetime.datetime.now().date()
+    if formato == "json" and LOS_PRECALCULO and not compacto:
+        cuerpo_gzip = _los_precalculado(db, listing_id, hoy)
+        if cuerpo_gzip is not None:
+            return _respuesta_gzip(cuerpo_gzip, request)
+
+    resultado = coalescedor.ejecutar(
+        listing_id,
+        ("lenght_of_stay", hoy, formato, compacto),
+        lambda: _calcular_los(db, listing_id, hoy, formato, compacto)
+    )
+    if formato != "json":
+        return Response(content=resultado, media_type=exportacion.FORMATOS[formato])
+    return resultado
+
+def _calcular_los(db: Session, listing_id: int, hoy: datetime.date, formato: str, compacto: bool = False):
+    snap = _instantanea(listing_id)
+    if snap is not None and not snap.cubre(hoy, hoy + datetime.timedelta(days=365 + tarifas.MAX_NOCHES_LOS)):
+        snap = None
+
     # Obtener el alojamiento
-    alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == listing_id).first()
+    if snap is not None:
+        alojamiento = AlojamientoResponse.model_validate(snap.alojamiento(listing_id))
+    else:
+        alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == listing_id).first()
     
     # Comprobar si el alojamiento existe
     if not alojamiento:
@@ -739,61 +1632,27 @@ def generar_disponibilidad_anual(listing_id: int, db: Session = Depends(get_db))
     if not alojamiento.disponible:
         raise HTTPException(status_code=404, detail="Alojamiento no disponible")
     
-    # Obtener las reservas y convertir fechas a date()
-    reservas = db.query(Reserva).filter(Reserva.listing_id == listing_id).all()
-    fechas_reservadas = []
-    for reserva in reservas:
-        # Convert datetime to date for comparison
-        inicio = reserva.fecha_entrada.date() if hasattr(reserva.fecha_entrada, 'date') else reserva.fecha_entrada
-        fin = reserva.fecha_salida.date() if hasattr(reserva.fecha_salida, 'date') else reserva.fecha_salida
-        fechas_reservadas.append((inicio, fin))
-
-    # Obtener precios estacionales
-    precios = db.query(seasonalPrices).filter(
-        seasonalPrices.listing == alojamiento.listing
-    ).all()
-    
-    if not precios:
+    # Filas disponibles (fecha, ocupantes, precios de 1..17 noches) para el próximo año
+    if snap is not None:
+        filas = _filas_los_instantanea(snap, listing_id, alojamiento.occupants, hoy, 365, compacta=compacto)
+    else:
+        # Con la versión leída, la tarifa en caché se recompila si alguien escribió sin pasar por el bus (p. ej. un script)
+        filas = _filas_los(db, listing_id, alojamiento.occupants, hoy, 365, version=alojamiento.version, compacta=compacto)
+    if filas is None:
         raise HTTPException(status_code=404, detail="No hay precios disponibles para este alojamiento")
 
-    # Crear diccionario de precios por fecha (usando date)
-    precio_por_fecha = {}
-    for precio in precios:
-        current_date = precio.start_date.date() if hasattr(precio.start_date, 'date') else precio.start_date
-        end_date = precio.end_date.date() if hasattr(precio.end_date, 'date') else precio.end_date
-        while current_date <= end_date:
-            precio_por_fecha[current_date.strftime("%Y-%m-%d")] = precio.price
-            current_date += datetime.timedelta(days=1)
-
-    # Generar registros disponibles
-    records = []
-    fecha_actual = datetime.datetime.now().date()
-    fecha_final = fecha_actual + datetime.timedelta(days=365)
-    
-    while fecha_actual < fecha_final:
-        fecha_str = fecha_actual.strftime("%Y-%m-%d")
-        
-        # Comprobar si la fecha está reservada
-        esta_reservada = False
-        for inicio, fin in fechas_reservadas:
-            if inicio <= fecha_actual <= fin:
-                esta_reservada = True
-                break
+    if compacto:
+        return {"data": {"records": _records_los_compactos(filas)}}
 
-        if not esta_reservada and fecha_str in precio_por_fecha:
-            precio_base = precio_por_fecha[fecha_str]
-            
-            # Generamos combinaciones de ocupantes desde 1 hasta occupants
-            for ocupantes in range(1, alojamiento.occupants + 1):
-                precio_final = precio_base
-                
-                # Crear string de días-precio (1-17 días)
-                dias_precios = [f"{dias}:{precio_final * dias}" for dias in range(1, 18)]
-                
-                # Crear el registro completo
-                records.append(f"{fecha_str},{ocupantes}," + ",".join(dias_precios))
-        
-        fecha_actual += datetime.timedelta(days=1)
+    if formato != "json":
+        return exportacion.serializar_tabla(exportacion.tabla_los(filas), formato)
+    return _respuesta_los(filas)
+
+def _respuesta_los(filas) -> dict:
+    records = [
+        f"{fecha.isoformat()},{ocupantes}," + _formatear_precios_los(precios)
+        for fecha, ocupantes, precios in filas
+    ]
     
     return {
         "data": {
@@ -801,17 +1660,227 @@ def generar_disponibilidad_anual(listing_id: int, db: Session = Depends(get_db))
         }
     }
 
-class ClientWebhook(Base):
-    __tablename__ = "client_webhooks"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    client_id = Column(Integer, index=True)
-    webhook_url = Column(String, nullable=False)
-    is_active = Column(Boolean, default=True)
-    secret_token = Column(String)  # Para autenticación
-    event_types = Column(String)  # Tipos de eventos a los que está suscrito (JSON)
-    created_at = Column(DateTime, default=datetime.datetime.now)
-    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+# 📌 LOS precalculado
+# Un job recalcula en segundo plano el LOS JSON de los alojamientos disponibles y lo guarda
+# ya serializado; /lenght_of_stay lo sirve con una lectura por clave primaria si la ventana es
+# la de hoy y la versión del alojamiento no ha cambiado (si no, se calcula como siempre).
+LOS_PRECALCULO = os.getenv("LOS_PRECALCULO", "1") == "1"
+LOS_PRECALCULO_INTERVALO = float(os.getenv("LOS_PRECALCULO_INTERVALO", "600"))
+LOS_PRECALCULO_LOTE = int(os.getenv("LOS_PRECALCULO_LOTE", "100"))
+# Horas valle "desde-hasta": solo entonces se recalcula todo el catálogo (cambio de día, alojamientos nuevos)
+_horas_valle = os.getenv("LOS_PRECALCULO_HORAS_VALLE", "0-6").split("-")
+LOS_PRECALCULO_HORAS_VALLE = range(int(_horas_valle[0]), int(_horas_valle[1]))
+
+def _los_precalculado(db: Session, listing_id: int, hoy: datetime.date) -> Optional[bytes]:
+    fila = db.query(LosPrecalculado.cuerpo_gzip).join(
+        Alojamiento, Alojamiento.listing == LosPrecalculado.listing_id
+    ).filter(
+        LosPrecalculado.listing_id == listing_id,
+        LosPrecalculado.dia == tarifas.a_dia(hoy),
+        LosPrecalculado.version == func.coalesce(Alojamiento.version, 0),
+        Alojamiento.disponible == True
+    ).first()
+    return fila[0] if fila else None
+
+def _respuesta_gzip(cuerpo_gzip: bytes, request: Request) -> Response:
+    # El middleware de compresión deja pasar las respuestas que ya traen Content-Encoding
+    if "gzip" in request.headers.get("accept-encoding", "").lower():
+        return Response(
+            content=cuerpo_gzip,
+            media_type="application/json",
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+        )
+    return Response(content=gzip.decompress(cuerpo_gzip), media_type="application/json")
+
+def precalcular_los(completa: Optional[bool] = None) -> dict:
+    """Recalcula los LOS precalculados que lo necesitan.
+
+    Siempre: los alojamientos cuya versión cambió desde su último cálculo de hoy.
+    En horas valle (o con completa=True): también los calculados otro día y los que no tienen fila.
+    """
+    hoy = datetime.date.today()
+    dia = tarifas.a_dia(hoy)
+    if completa is None:
+        completa = datetime.datetime.now().hour in LOS_PRECALCULO_HORAS_VALLE
+    inicio = time.perf_counter()
+
+    db = SessionLocal()
+    try:
+        cambiada = LosPrecalculado.version != func.coalesce(Alojamiento.version, 0)
+        consulta = db.query(Alojamiento.listing, Alojamiento.occupants, Alojamiento.version).outerjoin(
+            LosPrecalculado, LosPrecalculado.listing_id == Alojamiento.listing
+        ).filter(Alojamiento.disponible == True)
+        if completa:
+            consulta = consulta.filter(
+                (LosPrecalculado.listing_id == None) | (LosPrecalculado.dia != dia) | cambiada
+            )
+        else:
+            consulta = consulta.filter(LosPrecalculado.dia == dia, cambiada)
+        pendientes = consulta.order_by(Alojamiento.listing).all()
+
+        ejecucion = EjecucionPrecalculoLos(completa=completa, pendientes=len(pendientes))
+        db.add(ejecucion)
+        if completa:
+            # Las filas de alojamientos que ya no están disponibles no se volverán a servir
+            no_disponibles = select(Alojamiento.listing).where(Alojamiento.disponible != True)
+            db.execute(delete(LosPrecalculado).where(LosPrecalculado.listing_id.in_(no_disponibles)))
+        db.commit()
+
+        try:
+            for i in range(0, len(pendientes), LOS_PRECALCULO_LOTE):
+                filas_tabla, sin_los = [], []
+                for listing_id, ocupantes, version in pendientes[i:i + LOS_PRECALCULO_LOTE]:
+                    inicio_listing = time.perf_counter()
+                    # La versión se lee antes de calcular: si alguien escribe mientras, la fila ya nace caducada
+                    filas = _filas_los(db, listing_id, ocupantes or 1, hoy, 365, version=version)
+                    if filas is None:
+                        sin_los.append(listing_id)
+                        continue
+                    cuerpo = json.dumps(_respuesta_los(filas), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                    filas_tabla.append({
+                        "listing_id": listing_id,
+                        "dia": dia,
+                        "version": version or 0,
+                        "registros": len(filas),
+                        "cuerpo_gzip": gzip.compress(cuerpo, compresslevel=9),
+                        "calculado_en": datetime.datetime.now(),
+                        "duracion_ms": round((time.perf_counter() - inicio_listing) * 1000, 2)
+                    })
+                if filas_tabla:
+                    sentencia = sqlite_insert(LosPrecalculado)
+                    db.execute(
+                        sentencia.on_conflict_do_update(
+                            index_elements=["listing_id"],
+                            set_={columna: sentencia.excluded[columna] for columna in filas_tabla[0] if columna != "listing_id"}
+                        ),
+                        filas_tabla
+                    )
+                if sin_los:
+                    db.execute(delete(LosPrecalculado).where(LosPrecalculado.listing_id.in_(sin_los)))
+                ejecucion.procesados += len(filas_tabla) + len(sin_los)
+                ejecucion.sin_los += len(sin_los)
+                ejecucion.duracion_ms = round((time.perf_counter() - inicio) * 1000, 2)
+                db.commit()
+            ejecucion.estado = "completada"
+        except Exception as e:
+            db.rollback()
+            ejecucion.estado = "error"
+            ejecucion.error = str(e)
+            raise
+        finally:
+            ejecucion.fin = datetime.datetime.now()
+            ejecucion.duracion_ms = round((time.perf_counter() - inicio) * 1000, 2)
+            db.commit()
+        return _ejecucion_los(ejecucion)
+    finally:
+        db.close()
+
+def _ejecucion_los(ejecucion: EjecucionPrecalculoLos) -> dict:
+    return {
+        "id": ejecucion.id,
+        "inicio": ejecucion.inicio,
+        "fin": ejecucion.fin,
+        "completa": ejecucion.completa,
+        "estado": ejecucion.estado,
+        "pendientes": ejecucion.pendientes,
+        "procesados": ejecucion.procesados,
+        "sin_los": ejecucion.sin_los,
+        "duracion_ms": ejecucion.duracion_ms,
+        "ms_por_alojamiento": round(ejecucion.duracion_ms / ejecucion.procesados, 2) if ejecucion.procesados and ejecucion.duracion_ms else None,
+        "error": ejecucion.error,
+    }
+
+# 📌 Mantenimiento de la base de datos
+# Cada MANTENIMIENTO_INTERVALO s un worker pasa PRAGMA optimize; en horas valle, además,
+# ANALYZE, vacuum incremental (como mucho MANTENIMIENTO_PAGINAS_VACUUM páginas por pasada)
+# y checkpoint TRUNCATE del WAL. Ver mantenimiento.py.
+MANTENIMIENTO = os.getenv("MANTENIMIENTO", "1") == "1"
+MANTENIMIENTO_INTERVALO = float(os.getenv("MANTENIMIENTO_INTERVALO", "3600"))
+_horas_valle_mantenimiento = os.getenv("MANTENIMIENTO_HORAS_VALLE", "3-6").split("-")
+MANTENIMIENTO_HORAS_VALLE = range(int(_horas_valle_mantenimiento[0]), int(_horas_valle_mantenimiento[1]))
+MANTENIMIENTO_PAGINAS_VACUUM = int(os.getenv("MANTENIMIENTO_PAGINAS_VACUUM", "10000"))
+# Una base de datos sin auto_vacuum incremental solo se convierte (VACUUM completo) si tiene más páginas libres que esto
+MANTENIMIENTO_MAX_LIBRE = float(os.getenv("MANTENIMIENTO_MAX_LIBRE", "0.25"))
+# Si un worker muere a mitad de una pasada, su turno caduca pasado este tiempo
+MANTENIMIENTO_DURACION_MAX = float(os.getenv("MANTENIMIENTO_DURACION_MAX", "3600"))
+
+_lock_mantenimiento = threading.Lock()
+
+def _reclamar_mantenimiento() -> bool:
+    """Una sola pasada a la vez en todos los workers, programada o lanzada a mano (VACUUM bloquea la base de datos)"""
+    if not _lock_mantenimiento.acquire(blocking=False):
+        return False
+    if not bus.reclamar_tarea("mantenimiento_en_curso", MANTENIMIENTO_DURACION_MAX):
+        _lock_mantenimiento.release()
+        return False
+    return True
+
+def _soltar_mantenimiento():
+    bus.liberar_tarea("mantenimiento_en_curso")
+    _lock_mantenimiento.release()
+
+def mantener_base_datos(completa: Optional[bool] = None, vacuum: bool = False, reclamado: bool = False) -> Optional[dict]:
+    """Una pasada de mantenimiento de la base de datos principal (completa por defecto en horas valle).
+
+    None si no es SQLite o si ya hay otra pasada en curso. Con reclamado=True el turno ya lo tomó quien llama.
+    """
+    if get_engine().dialect.name != "sqlite":
+        return None
+    if not reclamado and not _reclamar_mantenimiento():
+        logging.info("Mantenimiento de la base de datos omitido: ya hay una pasada en curso")
+        return None
+    if completa is None:
+        completa = datetime.datetime.now().hour in MANTENIMIENTO_HORAS_VALLE
+    inicio = time.perf_counter()
+
+    db = SessionLocal()
+    try:
+        ejecucion = EjecucionMantenimiento(completa=completa or vacuum)
+        db.add(ejecucion)
+        db.commit()
+
+        checkpoint = None
+        conexion = get_engine().raw_connection()
+        try:
+            resultado = mantenimiento.mantener(
+                conexion.driver_connection, completa, MANTENIMIENTO_PAGINAS_VACUUM, MANTENIMIENTO_MAX_LIBRE, vacuum
+            )
+            checkpoint = resultado["checkpoint"]
+            ejecucion.operaciones = ",".join(resultado["operaciones"])
+            ejecucion.paginas_antes = resultado["paginas_antes"]
+            ejecucion.paginas_despues = resultado["paginas_despues"]
+            ejecucion.libres_antes = resultado["libres_antes"]
+            ejecucion.libres_despues = resultado["libres_despues"]
+            ejecucion.estado = "completada"
+        except Exception as e:
+            ejecucion.estado = "error"
+            ejecucion.error = str(e)
+            raise
+        finally:
+            conexion.close()
+            ejecucion.fin = datetime.datetime.now()
+            ejecucion.duracion_ms = round((time.perf_counter() - inicio) * 1000, 2)
+            db.commit()
+        return {**_ejecucion_mantenimiento(ejecucion), "checkpoint": checkpoint}
+    finally:
+        db.close()
+        _soltar_mantenimiento()
+
+def _ejecucion_mantenimiento(ejecucion: EjecucionMantenimiento) -> dict:
+    return {
+        "id": ejecucion.id,
+        "inicio": ejecucion.inicio,
+        "fin": ejecucion.fin,
+        "completa": ejecucion.completa,
+        "estado": ejecucion.estado,
+        "operaciones": ejecucion.operaciones.split(",") if ejecucion.operaciones else [],
+        "paginas_antes": ejecucion.paginas_antes,
+        "paginas_despues": ejecucion.paginas_despues,
+        "libres_antes": ejecucion.libres_antes,
+        "libres_despues": ejecucion.libres_despues,
+        "duracion_ms": ejecucion.duracion_ms,
+        "error": ejecucion.error,
+    }
 
 class ClientWebhookCreate(BaseModel):
     client_id: int
@@ -819,6 +1888,14 @@ class ClientWebhookCreate(BaseModel):
     event_types: List[str]
     is_active: bool = True
 
+class ClientWebhookResponse(BaseModel):
+    id: int
+    webhook_url: str
+    is_active: bool
+    event_types: List[str]
+    created_at: Optional[datetime.datetime] = None
+    updated_at: Optional[datetime.datetime] = None
+
 class WebhookNotification(BaseModel):
     event_type: str
     listing_id: int
@@ -826,28 +1903,72 @@ class WebhookNotification(BaseModel):
     timestamp: datetime.datetime
 
 
-async def _send_webhook_implementation(url: str, payload: dict, token: str):
-    """Lógica real de envío sin dependencias de BackgroundTasks"""
+# 📌 Envío de webhooks
+# Cada evento se serializa una sola vez a bytes canónicos; la firma HMAC de cada suscriptor
+# se calcula sobre esos mismos bytes, que son exactamente los que se envían.
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", "30"))
+WEBHOOK_MAX_CONEXIONES = int(os.getenv("WEBHOOK_MAX_CONEXIONES", "50"))
+
+_cliente_webhooks: Optional[httpx.AsyncClient] = None
+_bucle_webhooks = None
+
+def _cliente_http_webhooks() -> httpx.AsyncClient:
+    """Cliente compartido (pool de conexiones y TLS reutilizados); uno por bucle de eventos"""
+    global _cliente_webhooks, _bucle_webhooks
+    bucle = asyncio.get_running_loop()
+    if _cliente_webhooks is None or _bucle_webhooks is not bucle:
+        _cliente_webhooks = httpx.AsyncClient(
+            timeout=WEBHOOK_TIMEOUT,
+            limits=httpx.Limits(max_connections=WEBHOOK_MAX_CONEXIONES)
+        )
+        _bucle_webhooks = bucle
+    return _cliente_webhooks
+
+async def _cerrar_cliente_webhooks():
+    global _cliente_webhooks, _bucle_webhooks
+    if _cliente_webhooks is not None:
+        await _cliente_webhooks.aclose()
+    _cliente_webhooks = _bucle_webhooks = None
+
+def _serializar_evento(payload: dict) -> bytes:
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def _firmar_evento(cuerpo: bytes, token: str) -> str:
+    return hmac.new(token.encode("utf-8"), cuerpo, hashlib.sha256).hexdigest()
+
+async def _enviar_webhook(cliente: httpx.AsyncClient, url: str, cuerpo: bytes, token: str, event_type: str):
     try:
-        signature = hmac.new(
-            token.encode('utf-8'),
-            json.dumps(payload).encode('utf-8'),
-            hashlib.sha256
-        ).hexdigest()
-        
         headers = {
             "Content-Type": "application/json",
-            "X-Webhook-Signature": signature,
-            "X-Event-Type": payload.get("event_type", "unknown")
+            "X-Webhook-Signature": _firmar_evento(cuerpo, token),
+            "X-Event-Type": event_type
         }
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=payload, headers=headers)
-            response.raise_for_status()
+        response = await cliente.post(url, content=cuerpo, headers=headers)
+        response.raise_for_status()
     except Exception as e:
-        logging.error(f"Webhook error: {str(e)}") 
+        logging.error(f"Webhook error ({url}): {str(e)}")
+
+async def _difundir_webhook(destinos: List[Tuple[str, str]], payload: dict):
+    """Envía el evento a todos los (url, token) a la vez con el cliente compartido"""
+    cuerpo = _serializar_evento(payload)
+    event_type = payload.get("event_type", "unknown")
+    cliente = _cliente_http_webhooks()
+    await asyncio.gather(*(_enviar_webhook(cliente, url, cuerpo, token, event_type) for url, token in destinos))
+
+async def _send_webhook_implementation(url: str, payload: dict, token: str):
+    """Lógica real de envío sin dependencias de BackgroundTasks"""
+    await _difundir_webhook([(url, token)], payload)
+
+def _notificar_webhooks(db: Session, background_tasks: BackgroundTasks, suscripcion: str, payload: dict):
+    """Programa un único envío en segundo plano a todos los webhooks activos suscritos a `suscripcion`"""
+    destinos = db.query(ClientWebhook.webhook_url, ClientWebhook.secret_token).filter(
+        ClientWebhook.is_active == True,
+        ClientWebhook.event_types.contains(suscripcion)
+    ).all()
+    if destinos:
+        background_tasks.add_task(_difundir_webhook, [tuple(destino) for destino in destinos], payload)
 
-@app.post("/webhooks/register")
+@router.post("/webhooks/register")
 async def register_webhook(
     webhook_data: ClientWebhookCreate,
     background_tasks: BackgroundTasks,
@@ -863,7 +1984,6 @@ async def register_webhook(
         raise HTTPException(status_code=400, detail="Webhook ya registrado para este cliente y URL")
     
     # Generar token secreto
-    import secrets
     secret_token = secrets.token_urlsafe(32)
     
     # Crear nuevo webhook
@@ -905,7 +2025,7 @@ async def register_webhook(
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al registrar webhook: {str(e)}")
 
-@app.get("/webhooks/{client_id}")
+@router.get("/webhooks/{client_id}", response_model=List[ClientWebhookResponse])
 async def get_client_webhooks(
     client_id: int,
     db: Session = Depends(get_db)
@@ -923,7 +2043,7 @@ async def get_client_webhooks(
         "updated_at": w.updated_at
     } for w in webhooks]
 
-@app.delete("/webhooks/{webhook_id}")
+@router.delete("/webhooks/{webhook_id}")
 async def delete_webhook(
     webhook_id: int,
     db: Session = Depends(get_db)
@@ -941,10 +2061,11 @@ async def delete_webhook(
         raise HTTPException(status_code=500, detail=f"Error al eliminar webhook: {str(e)}")    
     
 
-@app.post("/cancel")
+@router.post("/cancel")
 def cancelar_reserva(
     cancelar_reserva: CancelarReservaRequest,
     background_tasks: BackgroundTasks,
+    response: Response,
     db: Session = Depends(get_db)
 ):
     reserva = db.query(Reserva).filter(
@@ -952,15 +2073,14 @@ def cancelar_reserva(
         Reserva.email_cliente == cancelar_reserva.email_cliente
     ).first()
 
-    alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == reserva.listing_id).first()
-    if not alojamiento:
-        raise HTTPException(status_code=404, detail="Alojamiento no encontrado")
-
     if not reserva:
         #raise HTTPException(status_code=404, detail="Reserva no encontrada")
         # enviar mensaje de error al cliente
         return {"mensaje": "Reserva no encontrada"}
-        
+
+    alojamiento = db.query(Alojamiento).filter(Alojamiento.listing == reserva.listing_id).first()
+    if not alojamiento:
+        raise HTTPException(status_code=404, detail="Alojamiento no encontrado")
 
     try:
         # Guardamos fechas para después
@@ -970,6 +2090,8 @@ def cancelar_reserva(
 
         db.delete(reserva)
         db.commit()
+        bus.publicar("listing", [listing_id])
+        _marcar_escritura(response)
 
         # Generamos el nuevo LOS para fechas que quedaron libres
         records = generar_los_para_fechas_libres(
@@ -977,38 +2099,17 @@ def cancelar_reserva(
             listing_id=listing_id,
             fecha_inicio=fecha_inicio,
             fecha_fin=fecha_fin,
-            ocupantes_max=alojamiento.occupants
+            ocupantes_max=alojamiento.occupants,
+            compacto=cancelar_reserva.compacto
         )
 
-        webhooks = db.query(ClientWebhook).filter(
-            ClientWebhook.is_active == True,
-            ClientWebhook.event_types.contains("listing_updated")
-        ).all()
-
-        duracion = (reserva.fecha_salida - reserva.fecha_entrada).days
-        precio_base = 0
-        if duracion > 0:
-            precio_base = reserva.precio_reserva / duracion
-
         payload = {
             "event_type": "update_los",
             "listing_id": reserva.listing_id,
-            "data": {
-                "fecha_entrada": reserva.fecha_entrada.isoformat(),
-                "fecha_salida": reserva.fecha_salida.isoformat(),
-                "listing_id": reserva.listing_id,
-                "precio_base" : precio_base,
-            },
+            "data": _datos_cancelacion(reserva),
             "timestamp": datetime.datetime.now().isoformat()
         }
-
-        for webhook in webhooks:
-            background_tasks.add_task(
-                _send_webhook_implementation,
-                url=webhook.webhook_url,
-                payload=payload,
-                token=webhook.secret_token
-            )
+        _notificar_webhooks(db, background_tasks, "listing_updated", payload)
 
         return {"mensaje": "Reserva cancelada exitosamente",
                 "records": records}
@@ -1018,57 +2119,369 @@ def cancelar_reserva(
         raise HTTPException(status_code=500, detail=f"Error al cancelar la reserva: {str(e)}")   
 
 
-def generar_los_para_fechas_libres(db: Session, listing_id: int, fecha_inicio: datetime.date, fecha_fin: datetime.date, ocupantes_max: int):
-    # Obtener reservas restantes del alojamiento
-    reservas = db.query(Reserva).filter(Reserva.listing_id == listing_id).all()
-    fechas_ocupadas = []
-    for r in reservas:
-        fechas_ocupadas.append((
-            r.fecha_entrada.date(),
-            r.fecha_salida.date()
-        ))
+def _datos_cancelacion(reserva: Reserva) -> dict:
+    duracion = (reserva.fecha_salida - reserva.fecha_entrada).days
+    precio_base = 0
+    if duracion > 0:
+        precio_base = reserva.precio_reserva / duracion
+    return {
+        "fecha_entrada": reserva.fecha_entrada.isoformat(),
+        "fecha_salida": reserva.fecha_salida.isoformat(),
+        "listing_id": reserva.listing_id,
+        "precio_base" : precio_base,
+    }
 
-    # Obtener precios estacionales
-    precios = db.query(seasonalPrices).filter(
-        seasonalPrices.listing == listing_id
+def _fusionar_rangos(rangos: List[Tuple[datetime.date, datetime.date]]) -> List[Tuple[datetime.date, datetime.date]]:
+    """Une los rangos [inicio, fin) que se solapan o son contiguos"""
+    fusionados = []
+    for inicio, fin in sorted(rangos):
+        if fusionados and inicio <= fusionados[-1][1]:
+            fusionados[-1] = (fusionados[-1][0], max(fusionados[-1][1], fin))
+        else:
+            fusionados.append((inicio, fin))
+    return fusionados
+
+# Endpoint para cancelar muchas reservas en una sola transacción (p. ej. al retirar un alojamiento)
+@router.post("/cancel/bulk")
+def cancelar_reservas_bulk(
+    datos: CancelarReservasBulkRequest,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    db: Session = Depends(get_db)
+):
+    localizadores = set(datos.localizadores)
+    # Las reservas de otro cliente se tratan como no encontradas
+    reservas = db.query(Reserva).filter(
+        Reserva.localizador.in_(localizadores),
+        Reserva.email_cliente == datos.email_cliente
     ).all()
+    no_encontradas = sorted(localizadores - {reserva.localizador for reserva in reservas})
+    if not reservas:
+        return {"mensaje": "Ninguna reserva encontrada", "canceladas": 0, "no_encontradas": no_encontradas, "records": {}}
+
+    # Noches liberadas por alojamiento, fusionadas para regenerar cada tramo una sola vez
+    liberadas: Dict[int, List[Tuple[datetime.date, datetime.date]]] = {}
+    for reserva in reservas:
+        liberadas.setdefault(reserva.listing_id, []).append((reserva.fecha_entrada.date(), reserva.fecha_salida.date()))
+    listing_ids = sorted(liberadas)
+    cancelaciones = [_datos_cancelacion(reserva) for reserva in reservas]
+
+    try:
+        db.execute(delete(Reserva).where(Reserva.id.in_([reserva.id for reserva in reservas])))
+        db.commit()
+        _publicar_listings(listing_ids)
+        _marcar_escritura(response)
+
+        ocupantes = dict(db.query(Alojamiento.listing, Alojamiento.occupants).filter(Alojamiento.listing.in_(listing_ids)).all())
+        records = {
+            listing_id: [
+                record
+                for inicio, fin in _fusionar_rangos(liberadas[listing_id])
+                for record in generar_los_para_fechas_libres(
+                    db, listing_id, inicio, fin, ocupantes.get(listing_id) or 1, datos.compacto
+                )
+            ]
+            for listing_id in listing_ids
+        }
+
+        # Una sola notificación por suscriptor con todas las cancelaciones
+        payload = {
+            "event_type": "update_los_batch",
+            "listing_ids": listing_ids,
+            "data": {"cancelaciones": cancelaciones},
+            "timestamp": datetime.datetime.now().isoformat()
+        }
+        _notificar_webhooks(db, background_tasks, "listing_updated", payload)
+
+        return {
+            "mensaje": "Reservas canceladas exitosamente",
+            "canceladas": len(reservas),
+            "no_encontradas": no_encontradas,
+            "records": records
+        }
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error al cancelar las reservas: {str(e)}")
+
+
+def generar_los_para_fechas_libres(
+    db: Session,
+    listing_id: int,
+    fecha_inicio: datetime.date,
+    fecha_fin: datetime.date,
+    ocupantes_max: int,
+    compacto: bool = False
+):
+    # Recorremos solo las fechas liberadas por la reserva, con las temporadas y reservas de esa ventana
+    dias = (fecha_fin - fecha_inicio).days
+    if compacto:
+        filas = _filas_los(db, listing_id, ocupantes_max, fecha_inicio, dias, solo_ventana=True, compacta=True) or []
+        return _records_los_compactos(filas, "_", f"{listing_id}_")
+    filas = _filas_los(db, listing_id, ocupantes_max, fecha_inicio, dias, solo_ventana=True) or []
+    return [
+        f"{listing_id}_{fecha.isoformat()}_{ocupantes}_" + _formatear_precios_los(precios)
+        for fecha, ocupantes, precios in filas
+    ]
+
+
+# 📌 Facetas de búsqueda
+def _inicializar_resumenes():
+    db = SessionLocal()
+    try:
+        if resumenes.vacios(db):
+            total = resumenes.reconstruir(db)
+            db.commit()
+            logging.info(f"Resúmenes de facetas construidos para {total} alojamientos")
+    finally:
+        db.close()
+
+# Endpoint de facetas: recuentos por ciudad/ocupación y rango de precios por noche en una ventana de fechas
+@router.get("/search/facets", response_model=FacetasResponse)
+def obtener_facetas(
+    fecha_inicio: Optional[datetime.date] = None,
+    fecha_fin: Optional[datetime.date] = None,
+    ciudad: Optional[str] = None,
+    pais: Optional[str] = None,
+    db: Session = Depends(get_db_lectura)
+):
+    desde = fecha_inicio or datetime.date.today()
+    hasta = fecha_fin or desde + datetime.timedelta(days=365)
+    if hasta < desde:
+        raise HTTPException(status_code=400, detail="La fecha de fin debe ser posterior a la de inicio")
+    return resumenes.facetas(db, desde, hasta, ciudad=ciudad, pais=pais)
+
+# Endpoint de búsqueda de texto (nombre, dirección, ciudad y servicios) con ranking y prefijos para autocompletar
+@router.get("/search", response_model=List[BusquedaResultadoResponse])
+def buscar_alojamientos(
+    q: str,
+    limit: int = 20,
+    solo_disponibles: bool = False,
+    db: Session = Depends(get_db_lectura)
+):
+    if not busqueda.disponible(db):
+        raise HTTPException(status_code=501, detail="Búsqueda de texto no disponible (SQLite sin FTS5)")
+    resultados = busqueda.buscar(db, q, limite=max(1, min(limit, 100)), solo_disponibles=solo_disponibles)
+    alojamientos = {
+        a.listing: a for a in db.query(Alojamiento).filter(Alojamiento.listing.in_([r[0] for r in resultados]))
+    }
+    return [
+        {"alojamiento": alojamientos[listing], "puntuacion": puntuacion, "fragmento": fragmento}
+        for listing, puntuacion, fragmento in resultados
+        if listing in alojamientos
+    ]
+
+# Reconstruye el índice de búsqueda de texto (tras cargar datos con los scripts)
+@router_admin.post("/admin/busqueda/reconstruir")
+def reconstruir_busqueda(db: Session = Depends(get_db)):
+    try:
+        busqueda.reconstruir(db)
+        db.commit()
+        return {"mensaje": "Índice de búsqueda reconstruido"}
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error al reconstruir el índice: {str(e)}")
+
+# Reconstruye los resúmenes de facetas (tras cargar datos con los scripts)
+@router_admin.post("/admin/resumenes/reconstruir")
+def reconstruir_resumenes(db: Session = Depends(get_db)):
+    try:
+        total = resumenes.reconstruir(db)
+        db.commit()
+        return {"alojamientos": total}
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error al reconstruir los resúmenes: {str(e)}")
 
-    # Mapa de precios por fecha
-    precio_por_fecha = {}
-    for precio in precios:
-        current = precio.start_date.date()
-        while current <= precio.end_date.date():
-            precio_por_fecha[current.strftime("%Y-%m-%d")] = precio.price
-            current += datetime.timedelta(days=1)
-
-    # Recorremos las fechas liberadas por la reserva
-    records = []
-    current_date = fecha_inicio
-    while current_date < fecha_fin:
-        esta_ocupada = False
-        for inicio, fin in fechas_ocupadas:
-            if inicio <= current_date <= fin:
-                esta_ocupada = True
+
+# 📌 Archivo de reservas históricas
+ARCHIVO_DIAS_GRACIA = int(os.getenv("ARCHIVO_DIAS_GRACIA", "1"))
+ARCHIVO_LOTE = int(os.getenv("ARCHIVO_LOTE", "5000"))
+
+def archivar_reservas(dias_gracia: int = ARCHIVO_DIAS_GRACIA, lote: int = ARCHIVO_LOTE) -> int:
+    """Mueve a reservas_historicas las estancias que terminaron hace más de `dias_gracia` días.
+
+    Cada lote es una transacción (INSERT ... SELECT + DELETE) para no bloquear
+    las escrituras de reservas durante mucho tiempo.
+    """
+    corte = datetime.datetime.combine(
+        datetime.date.today() - datetime.timedelta(days=dias_gracia),
+        datetime.time.min
+    )
+    columnas = [Reserva.__table__.c[nombre] for nombre in COLUMNAS_RESERVA]
+    total = 0
+    while True:
+        with get_engine().begin() as conn:
+            ids = conn.execute(
+                select(Reserva.id).where(Reserva.dia_salida < tarifas.a_dia(corte)).limit(lote)
+            ).scalars().all()
+            if not ids:
                 break
+            conn.execute(
+                insert(ReservaHistorica).from_select(
+                    ["reserva_id", *COLUMNAS_RESERVA],
+                    select(Reserva.id, *columnas).where(Reserva.id.in_(ids))
+                )
+            )
+            conn.execute(delete(Reserva).where(Reserva.id.in_(ids)))
+        total += len(ids)
+
+    if total:
+        logging.info(f"Archivadas {total} reservas anteriores a {corte.date()}")
+    return total
+
+# Ejecuta el archivo de reservas bajo demanda
+@router_admin.post("/admin/archivar-reservas")
+def ejecutar_archivo_reservas():
+    return {"archivadas": archivar_reservas()}
+
+
+# Progreso y tiempos del job de LOS precalculado
+@router_admin.get("/admin/los/precalculo")
+def estado_precalculo_los(db: Session = Depends(get_db)):
+    dia = tarifas.a_dia(datetime.date.today())
+    vigentes = db.query(func.count()).select_from(LosPrecalculado).join(
+        Alojamiento, Alojamiento.listing == LosPrecalculado.listing_id
+    ).filter(
+        LosPrecalculado.dia == dia,
+        LosPrecalculado.version == func.coalesce(Alojamiento.version, 0)
+    ).scalar()
+    ejecuciones = db.query(EjecucionPrecalculoLos).order_by(EjecucionPrecalculoLos.id.desc()).limit(10).all()
+    return {
+        "activado": LOS_PRECALCULO,
+        "filas": db.query(func.count()).select_from(LosPrecalculado).scalar(),
+        "vigentes": vigentes,
+        "disponibles": db.query(func.count()).select_from(Alojamiento).filter(Alojamiento.disponible == True).scalar(),
+        "ejecuciones": [_ejecucion_los(ejecucion) for ejecucion in ejecuciones]
+    }
+
+# Lanza ya un recálculo completo del LOS precalculado (en segundo plano)
+@router_admin.post("/admin/los/precalculo")
+def lanzar_precalculo_los(background_tasks: BackgroundTasks):
+    background_tasks.add_task(precalcular_los, True)
+    return {"mensaje": "Precálculo de LOS lanzado"}
+
+# Reconstruye ya la instantánea del catálogo (sin esperar a la tarea periódica)
+@router_admin.post("/admin/instantanea/reconstruir")
+def reconstruir_instantanea():
+    return construir_instantanea()
+
+# Tamaño y fragmentación de la base de datos (total, WAL y por tabla e índice) y últimos mantenimientos
+@router_admin.get("/admin/mantenimiento")
+def estado_mantenimiento(db: Session = Depends(get_db)):
+    base_datos = None
+    if get_engine().dialect.name == "sqlite":
+        conexion = get_engine().raw_connection()
+        try:
+            base_datos = mantenimiento.estadisticas(conexion.driver_connection, get_engine().url.database)
+        finally:
+            conexion.close()
+    ejecuciones = db.query(EjecucionMantenimiento).order_by(EjecucionMantenimiento.id.desc()).limit(10).all()
+    return {
+        "activado": MANTENIMIENTO,
+        "horas_valle": f"{MANTENIMIENTO_HORAS_VALLE.start}-{MANTENIMIENTO_HORAS_VALLE.stop}",
+        "base_datos": base_datos,
+        "ejecuciones": [_ejecucion_mantenimiento(ejecucion) for ejecucion in ejecuciones]
+    }
 
-        fecha_str = current_date.strftime("%Y-%m-%d")
-
-        if not esta_ocupada and fecha_str in precio_por_fecha:
-            precio_base = precio_por_fecha[fecha_str]
-            for ocupantes in range(1, ocupantes_max + 1):
-                precios = {}
-                for dias in range(1, 18):
-                    precios[str(dias)] = precio_base * dias
-                
-                record = {
-                    "listing_id": str(listing_id),
-                    "fecha": fecha_str,
-                    "ocupantes": ocupantes,
-                    "precios": precios
-                }
-                recordString = f"{listing_id}_{fecha_str}_{ocupantes}_" + ",".join([f"{dias}:{precio}" for dias, precio in precios.items()])
-                records.append(recordString)
-        current_date += datetime.timedelta(days=1)
-
-    return records
+# Lanza ya un mantenimiento completo (en segundo plano); con vacuum=true convierte a auto_vacuum incremental si hace falta
+@router_admin.post("/admin/mantenimiento")
+def lanzar_mantenimiento(background_tasks: BackgroundTasks, vacuum: bool = False):
+    # El turno se toma aquí para responder 409 en vez de lanzar una pasada que no se ejecutaría
+    if get_engine().dialect.name == "sqlite" and not _reclamar_mantenimiento():
+        raise HTTPException(status_code=409, detail="Ya hay un mantenimiento de la base de datos en curso", headers={"Retry-After": "60"})
+    background_tasks.add_task(mantener_base_datos, True, vacuum, get_engine().dialect.name == "sqlite")
+    return {"mensaje": "Mantenimiento de la base de datos lanzado"}
 
+
+# Contadores del control de admisión de este worker
+@router_admin.get("/admin/admision")
+def estadisticas_admision(request: Request):
+    return {"pid": os.getpid(), **request.app.state.control_admision.estadisticas()}
+
+
+# Estadísticas de las cachés de este worker
+@router_admin.get("/admin/cache")
+def estadisticas_cache():
+    return {
+        "pid": os.getpid(),
+        "caches": {cache.nombre: cache.estadisticas() for cache in CACHES},
+        "coalescencia": coalescedor.estadisticas(),
+        "imagenes": cache_disco_imagenes.estadisticas(),
+        "idempotencia": almacen_idempotencia.estadisticas(),
+        "instantanea": lector_instantanea.estadisticas()
+    }
+
+
+# 📌 Instancia de FastAPI
+def _control_admision() -> ControlAdmision:
+    # Rate limit por cliente y límites de concurrencia por grupo de rutas
+    return ControlAdmision(
+        grupos=[
+            GrupoRutas("reservas", [("POST", "/confirm"), ("POST", "/cancel")], prioritario=True),
+            GrupoRutas(
+                "los",
+                [("GET", "/lenght_of_stay/")],
+                coste=5,
+                max_concurrencia=int(os.getenv("ADMISION_MAX_LOS", "4"))
+            ),
+            GrupoRutas(
+                "listados",
+                [("GET", "/listings"), ("GET", "/listings/actives"), ("GET", "/listings/inactives"), ("GET", "/listings/ids")],
+                coste=5,
+                max_concurrencia=int(os.getenv("ADMISION_MAX_LISTADOS", "4"))
+            ),
+            GrupoRutas(
+                "imagenes",
+                [("GET", "/imagenes/")],
+                max_concurrencia=int(os.getenv("ADMISION_MAX_IMAGENES", "8"))
+            ),
+            GrupoRutas(
+                "cotizacion",
+                [("GET", "/quote"), ("GET", "/check-availability")],
+                max_concurrencia=int(os.getenv("ADMISION_MAX_COTIZACION", "16"))
+            ),
+        ],
+        tasa=float(os.getenv("ADMISION_TASA", "20")),
+        rafaga=float(os.getenv("ADMISION_RAFAGA", "40")),
+        # Por debajo de los 40 hilos del threadpool, para dejar siempre hueco a /confirm y /cancel
+        max_concurrencia=int(os.getenv("ADMISION_MAX_CONCURRENCIA", "32")),
+        # Claves X-API-Key conocidas (separadas por comas): tienen su propio cubo; el resto de clientes va por IP
+        claves_api=[clave.strip() for clave in os.getenv("ADMISION_API_KEYS", "").split(",") if clave.strip()]
+    )
+
+def create_app() -> FastAPI:
+    """Construye la aplicación sin tocar la base de datos: el esquema se prepara al arrancar (lifespan)"""
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router)
+    app.include_router(router_admin)
+    # Por dentro de la compresión: se guarda y se repite la respuesta sin comprimir
+    app.add_middleware(IdempotenciaMiddleware, almacen=almacen_idempotencia, rutas=RUTAS_IDEMPOTENTES)
+    # Compresión gzip/zstd negociada por Accept-Encoding para las respuestas grandes (LOS, listados)
+    app.add_middleware(CompresionMiddleware, minimum_size=1024)
+    # El control de admisión se añade el último para que sea el middleware más externo y rechace antes de hacer trabajo
+    app.state.control_admision = _control_admision()
+    app.add_middleware(AdmisionMiddleware, control=app.state.control_admision)
+    return app
+
+def __getattr__(nombre):
+    # `uvicorn main:app` y `gunicorn main:app` siguen funcionando: la app se construye la primera vez que se pide
+    if nombre == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {nombre!r}")
+
+
+# 📌 Arranque
+# Un solo proceso:   uvicorn main:app   (o uvicorn main:create_app --factory)
+# Varios workers:    WEB_CONCURRENCY=4 python main.py
+#                    gunicorn main:app -k uvicorn.workers.UvicornWorker -w 4
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "1"))
+    )
@@ -0,0 +1,112 @@
+import logging
+import os
+import sqlite3
+from typing import Optional
+
+# 📌 Mantenimiento de SQLite
+# Las altas y bajas continuas (reservas, imágenes, LOS precalculado) dejan páginas libres y
+# estadísticas del planificador viejas. Aquí están las operaciones sobre una conexión DB-API
+# (sqlite3); main.py decide cuándo lanzarlas (horas valle) y guarda cada ejecución.
+
+AUTO_VACUUM_INCREMENTAL = 2
+MODOS_AUTO_VACUUM = {0: "none", 1: "full", 2: "incremental"}
+
+
+def _paginas(conexion) -> dict:
+    return {
+        "paginas": conexion.execute("PRAGMA page_count").fetchone()[0],
+        "libres": conexion.execute("PRAGMA freelist_count").fetchone()[0],
+    }
+
+
+def mantener(conexion, completa: bool, paginas_vacuum: int, max_libre: float, vacuum: bool = False) -> dict:
+    """Una pasada de mantenimiento.
+
+    Siempre PRAGMA optimize (solo analiza lo que lo necesita). Con completa: ANALYZE,
+    incremental_vacuum de hasta `paginas_vacuum` páginas y checkpoint TRUNCATE del WAL.
+    Si la base de datos no tiene auto_vacuum incremental se convierte con un VACUUM completo,
+    pero solo cuando lo piden (`vacuum`) o las páginas libres superan `max_libre`.
+    """
+    antes = _paginas(conexion)
+    operaciones = []
+
+    if completa:
+        conexion.execute("ANALYZE")
+        operaciones.append("analyze")
+    conexion.execute("PRAGMA optimize")
+    operaciones.append("optimize")
+
+    checkpoint = None
+    if completa or vacuum:
+        modo = conexion.execute("PRAGMA auto_vacuum").fetchone()[0]
+        fraccion_libre = antes["libres"] / antes["paginas"] if antes["paginas"] else 0.0
+        if modo != AUTO_VACUUM_INCREMENTAL and (vacuum or fraccion_libre > max_libre):
+            conexion.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conexion.execute("VACUUM")
+            operaciones.append("vacuum")
+        elif modo == AUTO_VACUUM_INCREMENTAL and antes["libres"]:
+            # Con execute() sqlite3 solo avanza un paso (una página); executescript lo ejecuta entero
+            conexion.executescript(f"PRAGMA incremental_vacuum({int(paginas_vacuum)})")
+            operaciones.append("incremental_vacuum")
+        ocupado, paginas_wal, copiadas = conexion.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        checkpoint = {"ocupado": bool(ocupado), "paginas_wal": paginas_wal, "copiadas": copiadas}
+        operaciones.append("wal_checkpoint")
+
+    despues = _paginas(conexion)
+    return {
+        "operaciones": operaciones,
+        "paginas_antes": antes["paginas"],
+        "paginas_despues": despues["paginas"],
+        "libres_antes": antes["libres"],
+        "libres_despues": despues["libres"],
+        "checkpoint": checkpoint,
+    }
+
+
+def estadisticas(conexion, ruta: Optional[str] = None) -> dict:
+    """Tamaños del fichero, del WAL y de cada tabla e índice, con su fragmentación.
+
+    Por objeto: páginas, bytes, bytes sin usar dentro de sus páginas y "saltos" (páginas
+    que no siguen a la anterior al recorrer el árbol; muchos saltos = lecturas dispersas).
+    Sin dbstat compilado en SQLite solo se devuelven los totales.
+    """
+    tamano_pagina = conexion.execute("PRAGMA page_size").fetchone()[0]
+    paginas = _paginas(conexion)
+    resultado = {
+        "tamano_pagina": tamano_pagina,
+        **paginas,
+        "bytes": paginas["paginas"] * tamano_pagina,
+        "fraccion_libre": round(paginas["libres"] / paginas["paginas"], 4) if paginas["paginas"] else 0.0,
+        "auto_vacuum": MODOS_AUTO_VACUUM.get(conexion.execute("PRAGMA auto_vacuum").fetchone()[0]),
+        "journal_mode": conexion.execute("PRAGMA journal_mode").fetchone()[0],
+        "bytes_wal": os.path.getsize(f"{ruta}-wal") if ruta and os.path.exists(f"{ruta}-wal") else 0,
+        "objetos": None,
+    }
+
+    tipos = {nombre: (tipo, tabla) for tipo, nombre, tabla in conexion.execute("SELECT type, name, tbl_name FROM sqlite_master")}
+    try:
+        filas = conexion.execute("SELECT name, pageno, pgsize, unused FROM dbstat").fetchall()
+    except sqlite3.OperationalError as e:
+        logging.warning(f"dbstat no disponible, solo se informan los totales: {str(e)}")
+        return resultado
+
+    objetos = {}
+    anterior = {}
+    for nombre, pagina, tamano, sin_usar in filas:
+        objeto = objetos.setdefault(nombre, {"paginas": 0, "bytes": 0, "sin_usar": 0, "saltos": 0})
+        objeto["paginas"] += 1
+        objeto["bytes"] += tamano
+        objeto["sin_usar"] += sin_usar
+        if nombre in anterior and pagina != anterior[nombre] + 1:
+            objeto["saltos"] += 1
+        anterior[nombre] = pagina
+
+    for nombre, objeto in objetos.items():
+        tipo, tabla = tipos.get(nombre, ("interno", nombre))
+        objeto["tipo"] = tipo
+        objeto["tabla"] = tabla
+        objeto["fraccion_sin_usar"] = round(objeto["sin_usar"] / objeto["bytes"], 4) if objeto["bytes"] else 0.0
+        objeto["fraccion_saltos"] = round(objeto["saltos"] / (objeto["paginas"] - 1), 4) if objeto["paginas"] > 1 else 0.0
+    resultado["objetos"] = dict(sorted(objetos.items(), key=lambda item: -item[1]["bytes"]))
+    return resultado
+
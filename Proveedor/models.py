@@ -0,0 +1,266 @@
+import datetime
+import hashlib
+from typing import Dict, List, Optional
+
+from sqlalchemy import select, union_all, Column, Computed, Index, Integer, MetaData, String, Boolean, ForeignKey, Float, DateTime, LargeBinary, Sequence, Table
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, Session
+
+# Solo definiciones: importar este módulo no abre ninguna base de datos (ver database.py)
+Base = declarative_base()
+
+listing_seq = Sequence('listing_seq', start=9000, increment=1)
+
+SQL_DIA = "CAST(julianday(date({})) - 2440587.5 AS INTEGER)"
+
+def columna_dia(columna: str) -> Column:
+    """Número de día (días desde 1970-01-01, ver tarifas.a_dia) de una columna DateTime.
+
+    Es una columna generada VIRTUAL: la mantiene SQLite en cualquier escritura (ORM,
+    executemany, scripts) y se puede añadir con ALTER TABLE a una base de datos existente.
+    Los solapes y el LOS comparan enteros y sus índices guardan enteros en lugar de texto.
+    """
+    return Column(Integer, Computed(SQL_DIA.format(columna), persisted=False))
+
+# 📌 Modelos de Base de Datos
+class Alojamiento(Base):
+    __tablename__ = "alojamientos"
+    listing = Column(Integer, listing_seq, primary_key=True, index=True)  
+    nombre = Column(String, index=True)
+    direccion = Column(String)
+    ciudad = Column(String)
+    pais = Column(String)
+    imagen_id = Column(Integer, ForeignKey("images.id"), nullable=True)
+    disponible = Column(Boolean, default=True)
+    occupants = Column(Integer, default=1)
+    version = Column(Integer, default=0)  # Sello de versión de precios/reservas/datos (tokens de cotización)
+    seasonal_prices = relationship("seasonalPrices", backref="alojamiento")
+
+class PoliticaCancelacion(Base):
+    __tablename__ = "politicas_cancelacion"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    dias_antes_cancelacion = Column(Integer, nullable=False)  # Por ejemplo: 7, 3, 1
+    porcentaje_penalizacion = Column(Float, nullable=False)   # Porcentaje: 0.25, 0.5, 1.0    
+
+class seasonalPrices(Base):
+    __tablename__ = "seasonal_prices"
+    id = Column(Integer, primary_key=True, autoincrement=True) 
+    listing = Column(Integer, ForeignKey("alojamientos.listing"))
+    price = Column(Float)
+    start_date = Column(DateTime)    
+    end_date = Column(DateTime)
+    dia_inicio = columna_dia("start_date")
+    dia_fin = columna_dia("end_date")
+    priority = Column(Integer, default=0)               # A mayor prioridad, gana en los solapes
+    weekend_modifier = Column(Float, default=1.0)       # Multiplicador para noches de viernes y sábado
+    min_stay = Column(Integer, default=1)               # Estancia mínima para llegadas en esta temporada
+    extra_occupant_price = Column(Float, default=0.0)   # Recargo por noche por cada ocupante a partir del segundo
+
+# Temporadas de un alojamiento que terminan a partir de una fecha (regeneraciones parciales del LOS)
+Index("ix_seasonal_prices_listing_dia_fin", seasonalPrices.listing, seasonalPrices.dia_fin)
+
+class ListingLosDiscount(Base):
+    __tablename__ = "listing_los_discounts"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    listing_id = Column(Integer, ForeignKey("alojamientos.listing"), index=True)
+    min_nights = Column(Integer, nullable=False)   # A partir de cuántas noches aplica
+    discount = Column(Float, nullable=False)       # Porcentaje de descuento: 5, 10...
+
+class ImageUrl(Base):
+    # Cada URL se guarda una sola vez, direccionada por su hash; las imágenes de los listings la referencian por id
+    __tablename__ = "image_urls"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    hash = Column(String(64), unique=True, nullable=False)   # sha256 de la URL
+    url = Column(String, nullable=False)
+
+class Image(Base):
+    __tablename__ = "images"
+    id = Column(Integer, primary_key=True, autoincrement=True) 
+    listing_id = Column(Integer, ForeignKey("alojamientos.listing"), index=True)
+    url_id = Column(Integer, ForeignKey("image_urls.id"))
+    url_ref = relationship("ImageUrl", lazy="joined")
+
+    @property
+    def link(self) -> Optional[str]:
+        return self.url_ref.url if self.url_ref else None
+
+class ListingCommission(Base):
+    __tablename__ = "listing_commission"
+    id = Column(Integer, primary_key=True, autoincrement=True) 
+    listing_id = Column(Integer, ForeignKey("alojamientos.listing"))
+    commission = Column(Float)
+
+class ListingService(Base):
+    __tablename__ = "listing_services"
+    id = Column(Integer, primary_key=True, autoincrement=True)  
+    listing_id = Column(Integer, ForeignKey("alojamientos.listing"))
+    name = Column(String)
+    description = Column(String)
+
+class Cliente(Base):
+    __tablename__ = "clientes"
+    id = Column(Integer, primary_key=True, autoincrement=True)  
+    nombre = Column(String, index=True)
+    email = Column(String, unique=True, index=True)
+
+class Reserva(Base):
+    __tablename__ = "reservas"
+    id = Column(Integer, primary_key=True, autoincrement=True) 
+    listing_id = Column(Integer, ForeignKey("alojamientos.listing"))
+    fecha_reserva = Column(DateTime, default=datetime.datetime.now)
+    fecha_entrada = Column(DateTime)
+    fecha_salida = Column(DateTime)
+    dia_entrada = columna_dia("fecha_entrada")
+    dia_salida = columna_dia("fecha_salida")
+    localizador = Column(Integer, unique=True, index=True)  # Localizador único para la reserva
+    nombre_cliente = Column(String)
+    email_cliente = Column(String)
+    precio_reserva = Column(Float)
+
+# Historial de reservas por cliente: email sin distinguir mayúsculas + orden por fecha de reserva (keyset)
+Index("ix_reservas_email_fecha", Reserva.email_cliente.collate("NOCASE"), Reserva.fecha_reserva, Reserva.id)
+# Solapes y LOS: reservas de un alojamiento que terminan después de un día (cubre también la entrada)
+Index("ix_reservas_listing_dias", Reserva.listing_id, Reserva.dia_salida, Reserva.dia_entrada)
+
+# Reservas cuya estancia ya terminó: las mueve aquí el job de archivo para que
+# la tabla "caliente" (disponibilidad, LOS, cancelaciones) solo tenga presente y futuro
+class ReservaHistorica(Base):
+    __tablename__ = "reservas_historicas"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    reserva_id = Column(Integer)  # id original en reservas
+    listing_id = Column(Integer, ForeignKey("alojamientos.listing"))
+    fecha_reserva = Column(DateTime)
+    fecha_entrada = Column(DateTime)
+    fecha_salida = Column(DateTime)
+    localizador = Column(Integer, unique=True, index=True)
+    nombre_cliente = Column(String)
+    email_cliente = Column(String)
+    precio_reserva = Column(Float)
+    archivada_en = Column(DateTime, default=datetime.datetime.now)
+
+Index("ix_reservas_historicas_email_fecha", ReservaHistorica.email_cliente.collate("NOCASE"), ReservaHistorica.fecha_reserva, ReservaHistorica.reserva_id)
+Index("ix_reservas_historicas_listing", ReservaHistorica.listing_id)
+
+COLUMNAS_RESERVA = ["listing_id", "fecha_reserva", "fecha_entrada", "fecha_salida", "localizador", "nombre_cliente", "email_cliente", "precio_reserva"]
+
+class ClientWebhook(Base):
+    __tablename__ = "client_webhooks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    client_id = Column(Integer, index=True)
+    webhook_url = Column(String, nullable=False)
+    is_active = Column(Boolean, default=True)
+    secret_token = Column(String)  # Para autenticación
+    event_types = Column(String)  # Tipos de eventos a los que está suscrito (JSON)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+# 📌 Tablas resumen para las facetas de búsqueda (las mantiene resumenes.py en cada escritura)
+# Grupo = (ciudad, pais, banda de ocupación); los textos vacíos sustituyen a NULL para que la clave sea única.
+class ResumenListing(Base):
+    # Grupo actual de cada alojamiento, para saber de qué grupo sale cuando cambia
+    __tablename__ = "resumen_listings"
+    listing_id = Column(Integer, primary_key=True)
+    ciudad = Column(String, nullable=False)
+    pais = Column(String, nullable=False)
+    banda = Column(String, nullable=False)
+    disponible = Column(Boolean, nullable=False)
+
+Index("ix_resumen_listings_grupo", ResumenListing.ciudad, ResumenListing.pais, ResumenListing.banda)
+
+class ResumenPrecioListing(Base):
+    # Precio por noche mínimo y máximo de cada alojamiento en cada mes ("2025-07")
+    __tablename__ = "resumen_precios_listing"
+    listing_id = Column(Integer, primary_key=True)
+    mes = Column(String(7), primary_key=True)
+    precio_min = Column(Float, nullable=False)
+    precio_max = Column(Float, nullable=False)
+
+class ResumenGrupo(Base):
+    __tablename__ = "resumen_grupos"
+    ciudad = Column(String, primary_key=True)
+    pais = Column(String, primary_key=True)
+    banda = Column(String, primary_key=True)
+    alojamientos = Column(Integer, nullable=False)
+    disponibles = Column(Integer, nullable=False)
+
+class ResumenPrecioGrupo(Base):
+    # Solo alojamientos disponibles
+    __tablename__ = "resumen_precios_grupo"
+    ciudad = Column(String, primary_key=True)
+    pais = Column(String, primary_key=True)
+    banda = Column(String, primary_key=True)
+    mes = Column(String(7), primary_key=True)
+    precio_min = Column(Float, nullable=False)
+    precio_max = Column(Float, nullable=False)
+    alojamientos = Column(Integer, nullable=False)
+
+# LOS precalculado por el job programado: la respuesta JSON ya serializada (gzip) para la
+# ventana que empieza en `dia`, válida mientras la versión del alojamiento no cambie
+class LosPrecalculado(Base):
+    __tablename__ = "los_precalculados"
+    listing_id = Column(Integer, ForeignKey("alojamientos.listing"), primary_key=True)
+    dia = Column(Integer, nullable=False)       # Número de día del primer día de la ventana
+    version = Column(Integer, nullable=False)   # Alojamiento.version con la que se calculó
+    registros = Column(Integer, nullable=False)
+    cuerpo_gzip = Column(LargeBinary, nullable=False)
+    calculado_en = Column(DateTime, default=datetime.datetime.now)
+    duracion_ms = Column(Float)
+
+class EjecucionPrecalculoLos(Base):
+    __tablename__ = "los_precalculo_ejecuciones"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    inicio = Column(DateTime, default=datetime.datetime.now)
+    fin = Column(DateTime)
+    completa = Column(Boolean, default=False)   # Horas valle: también ventanas de otro día y alojamientos sin calcular
+    estado = Column(String, default="en_curso")  # en_curso, completada, error
+    pendientes = Column(Integer, default=0)
+    procesados = Column(Integer, default=0)
+    sin_los = Column(Integer, default=0)        # No disponibles o sin precios: se borra su fila
+    duracion_ms = Column(Float)
+    error = Column(String)
+
+class EjecucionMantenimiento(Base):
+    __tablename__ = "mantenimiento_ejecuciones"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    inicio = Column(DateTime, default=datetime.datetime.now)
+    fin = Column(DateTime)
+    completa = Column(Boolean, default=False)   # Horas valle: ANALYZE, vacuum incremental y checkpoint del WAL
+    estado = Column(String, default="en_curso")  # en_curso, completada, error
+    operaciones = Column(String)                 # Separadas por comas, en el orden en que se hicieron
+    paginas_antes = Column(Integer)
+    paginas_despues = Column(Integer)
+    libres_antes = Column(Integer)
+    libres_despues = Column(Integer)
+    duracion_ms = Column(Float)
+    error = Column(String)
+
+# Vista de solo lectura con todas las reservas (calientes + históricas) para las consultas de histórico.
+# Va en su propio MetaData para que create_all no intente crearla como tabla.
+vista_reservas = Table(
+    "reservas_todas",
+    MetaData(),
+    Column("id", Integer),
+    *[Column(nombre, Reserva.__table__.c[nombre].type) for nombre in COLUMNAS_RESERVA]
+)
+
+SQL_VISTA_RESERVAS = union_all(
+    select(Reserva.id, *[Reserva.__table__.c[nombre] for nombre in COLUMNAS_RESERVA]),
+    select(ReservaHistorica.reserva_id.label("id"), *[ReservaHistorica.__table__.c[nombre] for nombre in COLUMNAS_RESERVA])
+)
+
+
+def hash_url(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+def ids_urls(db: Session, urls: List[str]) -> Dict[str, int]:
+    """Id en image_urls de cada URL, insertando las que todavía no existen"""
+    hashes = {url: hash_url(url) for url in urls}
+    if hashes:
+        db.execute(
+            sqlite_insert(ImageUrl).on_conflict_do_nothing(index_elements=["hash"]),
+            [{"hash": h, "url": url} for url, h in hashes.items()]
+        )
+    ids = dict(db.query(ImageUrl.hash, ImageUrl.id).filter(ImageUrl.hash.in_(set(hashes.values()))).all())
+    return {url: ids[h] for url, h in hashes.items()}
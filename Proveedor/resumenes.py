@@ -0,0 +1,223 @@
+import datetime
+import math
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from sqlalchemy import delete, func, insert
+from sqlalchemy.orm import Session
+
+import tarifas
+from models import Alojamiento, ResumenGrupo, ResumenListing, ResumenPrecioGrupo, ResumenPrecioListing, seasonalPrices
+
+# (máximo de ocupantes, nombre) de cada banda de ocupación; None = sin límite
+BANDAS_OCUPANTES = ((2, "1-2"), (4, "3-4"), (6, "5-6"), (None, "7+"))
+
+Grupo = Tuple[str, str, str]
+
+
+def banda_ocupantes(ocupantes: Optional[int]) -> str:
+    ocupantes = ocupantes or 1
+    for maximo, nombre in BANDAS_OCUPANTES:
+        if maximo is None or ocupantes <= maximo:
+            return nombre
+
+
+def mes(fecha) -> str:
+    return f"{fecha.year:04d}-{fecha.month:02d}"
+
+
+def _grupo(alojamiento: Alojamiento) -> Grupo:
+    return (alojamiento.ciudad or "", alojamiento.pais or "", banda_ocupantes(alojamiento.occupants))
+
+
+def _precios_por_mes(tarifa: tarifas.TarifaCompilada) -> Dict[str, Tuple[float, float]]:
+    """Precio por noche mínimo y máximo (1 ocupante, sin descuentos) de cada mes con precio"""
+    meses = {}
+    for i, precio in enumerate(tarifa.precios):
+        if math.isnan(precio):
+            continue
+        clave = mes(tarifas.de_dia(tarifa.inicio + i))
+        actual = meses.get(clave)
+        meses[clave] = (precio, precio) if actual is None else (min(actual[0], precio), max(actual[1], precio))
+    return meses
+
+
+def actualizar_listings(db: Session, listing_ids: Iterable[int]):
+    """Recalcula el resumen de estos alojamientos y de los grupos en los que están o estaban.
+
+    Se llama dentro de la transacción de la escritura, antes del commit. El coste
+    es proporcional a los alojamientos tocados y al tamaño de sus grupos, no al catálogo.
+    """
+    listing_ids = set(listing_ids)
+    if not listing_ids:
+        return
+    db.flush()
+
+    meses_por_grupo: Dict[Grupo, Set[str]] = defaultdict(set)
+
+    # Grupos y meses que deja cada alojamiento
+    anteriores = {
+        fila.listing_id: (fila.ciudad, fila.pais, fila.banda)
+        for fila in db.query(ResumenListing).filter(ResumenListing.listing_id.in_(listing_ids))
+    }
+    for grupo in anteriores.values():
+        meses_por_grupo.setdefault(grupo, set())
+    for listing_id, clave_mes in db.query(ResumenPrecioListing.listing_id, ResumenPrecioListing.mes).filter(
+        ResumenPrecioListing.listing_id.in_(listing_ids)
+    ):
+        meses_por_grupo[anteriores[listing_id]].add(clave_mes)
+    db.execute(delete(ResumenListing).where(ResumenListing.listing_id.in_(listing_ids)))
+    db.execute(delete(ResumenPrecioListing).where(ResumenPrecioListing.listing_id.in_(listing_ids)))
+
+    # Grupos y meses en los que entra ahora
+    temporadas = defaultdict(list)
+    for temporada in db.query(seasonalPrices).filter(seasonalPrices.listing.in_(listing_ids)):
+        temporadas[temporada.listing].append(temporada)
+
+    filas_listing, filas_precios = [], []
+    for alojamiento in db.query(Alojamiento).filter(Alojamiento.listing.in_(listing_ids)):
+        grupo = _grupo(alojamiento)
+        ciudad, pais, banda = grupo
+        filas_listing.append({
+            "listing_id": alojamiento.listing,
+            "ciudad": ciudad,
+            "pais": pais,
+            "banda": banda,
+            "disponible": bool(alojamiento.disponible),
+        })
+        meses_por_grupo.setdefault(grupo, set())
+        tarifa = tarifas.compilar_tarifa(temporadas[alojamiento.listing])
+        if tarifa is None:
+            continue
+        for clave_mes, (minimo, maximo) in _precios_por_mes(tarifa).items():
+            filas_precios.append({"listing_id": alojamiento.listing, "mes": clave_mes, "precio_min": minimo, "precio_max": maximo})
+            meses_por_grupo[grupo].add(clave_mes)
+
+    if filas_listing:
+        db.execute(insert(ResumenListing), filas_listing)
+    if filas_precios:
+        db.execute(insert(ResumenPrecioListing), filas_precios)
+
+    for grupo, meses in meses_por_grupo.items():
+        _recalcular_grupo(db, grupo, meses)
+
+
+def _recalcular_grupo(db: Session, grupo: Grupo, meses: Set[str]):
+    ciudad, pais, banda = grupo
+    filtro_listing = (ResumenListing.ciudad == ciudad, ResumenListing.pais == pais, ResumenListing.banda == banda)
+    filtro_grupo = lambda modelo: (modelo.ciudad == ciudad, modelo.pais == pais, modelo.banda == banda)
+
+    total, disponibles = db.query(func.count(), func.coalesce(func.sum(ResumenListing.disponible), 0)).filter(*filtro_listing).one()
+    db.execute(delete(ResumenGrupo).where(*filtro_grupo(ResumenGrupo)))
+    if total:
+        db.execute(insert(ResumenGrupo), [{
+            "ciudad": ciudad, "pais": pais, "banda": banda, "alojamientos": total, "disponibles": disponibles
+        }])
+
+    if not meses:
+        return
+    db.execute(delete(ResumenPrecioGrupo).where(*filtro_grupo(ResumenPrecioGrupo), ResumenPrecioGrupo.mes.in_(meses)))
+    filas = db.query(
+        ResumenPrecioListing.mes,
+        func.min(ResumenPrecioListing.precio_min),
+        func.max(ResumenPrecioListing.precio_max),
+        func.count()
+    ).join(
+        ResumenListing, ResumenListing.listing_id == ResumenPrecioListing.listing_id
+    ).filter(
+        *filtro_listing, ResumenListing.disponible == True, ResumenPrecioListing.mes.in_(meses)
+    ).group_by(ResumenPrecioListing.mes).all()
+    if filas:
+        db.execute(insert(ResumenPrecioGrupo), [
+            {
+                "ciudad": ciudad, "pais": pais, "banda": banda, "mes": clave_mes,
+                "precio_min": minimo, "precio_max": maximo, "alojamientos": alojamientos
+            }
+            for clave_mes, minimo, maximo, alojamientos in filas
+        ])
+
+
+def reconstruir(db: Session, lote: int = 500) -> int:
+    """Rehace todos los resúmenes desde cero (datos cargados con scripts, primera puesta en marcha)"""
+    for modelo in (ResumenListing, ResumenPrecioListing, ResumenGrupo, ResumenPrecioGrupo):
+        db.execute(delete(modelo))
+    listing_ids = [fila[0] for fila in db.query(Alojamiento.listing).order_by(Alojamiento.listing)]
+    for i in range(0, len(listing_ids), lote):
+        actualizar_listings(db, listing_ids[i:i + lote])
+    return len(listing_ids)
+
+
+def vacios(db: Session) -> bool:
+    """True si hay alojamientos pero los resúmenes todavía no se han construido"""
+    return db.query(ResumenListing.listing_id).first() is None and db.query(Alojamiento.listing).first() is not None
+
+
+def facetas(
+    db: Session,
+    desde: datetime.date,
+    hasta: datetime.date,
+    ciudad: Optional[str] = None,
+    pais: Optional[str] = None
+) -> dict:
+    """Recuentos por ciudad y banda de ocupación y rango de precios por noche en [desde, hasta].
+
+    Solo lee las tablas resumen: O(grupos × meses). Los precios tienen resolución
+    mensual, así que la ventana se amplía a meses completos.
+    """
+    consulta_grupos = db.query(ResumenGrupo)
+    consulta_precios = db.query(
+        ResumenPrecioGrupo.ciudad,
+        ResumenPrecioGrupo.pais,
+        ResumenPrecioGrupo.banda,
+        func.min(ResumenPrecioGrupo.precio_min),
+        func.max(ResumenPrecioGrupo.precio_max)
+    ).filter(
+        ResumenPrecioGrupo.mes >= mes(desde),
+        ResumenPrecioGrupo.mes <= mes(hasta)
+    )
+    if ciudad is not None:
+        consulta_grupos = consulta_grupos.filter(ResumenGrupo.ciudad == ciudad)
+        consulta_precios = consulta_precios.filter(ResumenPrecioGrupo.ciudad == ciudad)
+    if pais is not None:
+        consulta_grupos = consulta_grupos.filter(ResumenGrupo.pais == pais)
+        consulta_precios = consulta_precios.filter(ResumenPrecioGrupo.pais == pais)
+    precios = {
+        (fila[0], fila[1], fila[2]): (fila[3], fila[4])
+        for fila in consulta_precios.group_by(ResumenPrecioGrupo.ciudad, ResumenPrecioGrupo.pais, ResumenPrecioGrupo.banda)
+    }
+
+    def acumular(destino: dict, grupo: ResumenGrupo, rango):
+        destino["alojamientos"] += grupo.alojamientos
+        destino["disponibles"] += grupo.disponibles
+        if rango is not None:
+            destino["precio_min"] = rango[0] if destino["precio_min"] is None else min(destino["precio_min"], rango[0])
+            destino["precio_max"] = rango[1] if destino["precio_max"] is None else max(destino["precio_max"], rango[1])
+
+    vacio = lambda **clave: {**clave, "alojamientos": 0, "disponibles": 0, "precio_min": None, "precio_max": None}
+    total = vacio()
+    ciudades, bandas, grupos = {}, {}, []
+    for grupo in consulta_grupos.all():
+        rango = precios.get((grupo.ciudad, grupo.pais, grupo.banda))
+        clave_ciudad = (grupo.ciudad or None, grupo.pais or None)
+        acumular(ciudades.setdefault(clave_ciudad, vacio(ciudad=clave_ciudad[0], pais=clave_ciudad[1])), grupo, rango)
+        acumular(bandas.setdefault(grupo.banda, vacio(banda=grupo.banda)), grupo, rango)
+        acumular(total, grupo, rango)
+        grupos.append({
+            "ciudad": grupo.ciudad or None,
+            "pais": grupo.pais or None,
+            "banda": grupo.banda,
+            "alojamientos": grupo.alojamientos,
+            "disponibles": grupo.disponibles,
+            "precio_min": rango[0] if rango else None,
+            "precio_max": rango[1] if rango else None,
+        })
+
+    orden_bandas = [nombre for _, nombre in BANDAS_OCUPANTES]
+    return {
+        "desde": desde,
+        "hasta": hasta,
+        **total,
+        "ciudades": sorted(ciudades.values(), key=lambda c: -c["alojamientos"]),
+        "ocupacion": sorted(bandas.values(), key=lambda b: orden_bandas.index(b["banda"])),
+        "grupos": grupos,
+    }
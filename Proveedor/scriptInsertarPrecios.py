@@ -1,13 +1,9 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import Session
 import random
 from datetime import datetime
-from main import SessionLocal, seasonalPrices, Alojamiento
-
-# Establecer conexión a la base de datos
-DATABASE_URL = "sqlite:///./proveedor.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+from database import SessionLocal, preparar_esquema
+from models import seasonalPrices, Alojamiento
+import resumenes
 
 def generateSeasonalPrices(db: Session):
     target_years = [2025, 2026]
@@ -45,10 +41,12 @@ def generateSeasonalPrices(db: Session):
                 )
                 db.add(price)
 
+    resumenes.actualizar_listings(db, new_listings)
     db.commit()
     print(f"✅ Precios estacionales insertados para {len(new_listings)} alojamientos.")
 
 if __name__ == "__main__":
+    preparar_esquema()
     db = SessionLocal()
     generateSeasonalPrices(db)
     db.close()
@@ -0,0 +1,255 @@
+import datetime
+import math
+from array import array
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+# Noches de viernes y sábado
+DIAS_FIN_DE_SEMANA = (4, 5)
+
+# Duraciones de estancia que se publican en el LOS (1..17 noches)
+MAX_NOCHES_LOS = 17
+
+
+# Número de día: días desde 1970-01-01 (un jueves). Es lo que guardan las columnas
+# dia_* de reservas y seasonal_prices, y el índice interno de las tarifas compiladas.
+EPOCA = datetime.date(1970, 1, 1).toordinal()
+
+
+def _a_fecha(valor) -> datetime.date:
+    return valor.date() if isinstance(valor, datetime.datetime) else valor
+
+
+def a_dia(valor) -> int:
+    """Número de día de una fecha o datetime (los enteros se devuelven tal cual)"""
+    if isinstance(valor, int):
+        return valor
+    return _a_fecha(valor).toordinal() - EPOCA
+
+
+def de_dia(dia: int) -> datetime.date:
+    return datetime.date.fromordinal(dia + EPOCA)
+
+
+def dia_semana(dia: int) -> int:
+    """Como date.weekday() (lunes = 0) pero sobre el número de día"""
+    return (dia + 3) % 7
+
+
+def _acumular(valores: Sequence[float]) -> array:
+    """Sumas prefijas: acumulado[j] - acumulado[i] es la suma de valores[i:j]"""
+    acumulado = array("d", [0.0]) * (len(valores) + 1)
+    total = 0.0
+    for i, valor in enumerate(valores):
+        total += valor
+        acumulado[i + 1] = total
+    return acumulado
+
+
+class TarifaCompilada:
+    """Tabla de precios de un alojamiento ya resuelta noche a noche.
+
+    Las temporadas se pintan una sola vez sobre un array por día (prioridad,
+    modificador de fin de semana, estancia mínima y recargo por ocupante) y se
+    guardan sus sumas prefijas, de modo que el precio de cualquier estancia es
+    una resta y el calendario LOS completo no recorre noches en Python.
+    """
+
+    def __init__(self, inicio: int, precios: array, recargos: array, estancia_minima: array, descuentos: List[Tuple[int, float]]):
+        self.inicio = inicio
+        self.precios = precios
+        self.recargos = recargos
+        self.estancia_minima = estancia_minima
+        # Ordenados de mayor a menor umbral: se aplica el primero que cumpla
+        self.descuentos = sorted(descuentos, reverse=True)
+        self._acumulado = _acumular([0.0 if math.isnan(p) else p for p in precios])
+        self._acumulado_recargos = _acumular(recargos)
+        self._acumulado_sin_precio = _acumular([1.0 if math.isnan(p) else 0.0 for p in precios])
+
+    @classmethod
+    def precompilada(cls, inicio: int, precios, estancia_minima, descuentos, acumulado, acumulado_recargos, acumulado_sin_precio):
+        """Tarifa sobre arrays ya calculados (p. ej. vistas de la instantánea mmap), sin copiarlos"""
+        tarifa = cls.__new__(cls)
+        tarifa.inicio = inicio
+        tarifa.precios = precios
+        tarifa.recargos = None
+        tarifa.estancia_minima = estancia_minima
+        tarifa.descuentos = sorted(descuentos, reverse=True)
+        tarifa._acumulado = acumulado
+        tarifa._acumulado_recargos = acumulado_recargos
+        tarifa._acumulado_sin_precio = acumulado_sin_precio
+        return tarifa
+
+    @property
+    def dias(self) -> int:
+        return len(self.precios)
+
+    def _indice(self, fecha) -> int:
+        return a_dia(fecha) - self.inicio
+
+    def descuento(self, noches: int) -> float:
+        for min_noches, porcentaje in self.descuentos:
+            if noches >= min_noches:
+                return porcentaje
+        return 0.0
+
+    def estancia_minima_en(self, fecha) -> int:
+        i = self._indice(fecha)
+        return self.estancia_minima[i] if 0 <= i < self.dias else 1
+
+    def _total(self, i: int, noches: int, ocupantes: int) -> Optional[float]:
+        j = i + noches
+        if noches <= 0 or i < 0 or j > self.dias:
+            return None
+        if self._acumulado_sin_precio[j] - self._acumulado_sin_precio[i]:
+            return None
+        total = self._acumulado[j] - self._acumulado[i]
+        if ocupantes > 1:
+            total += (ocupantes - 1) * (self._acumulado_recargos[j] - self._acumulado_recargos[i])
+        return round(total * (1 - self.descuento(noches) / 100), 2)
+
+    def precio_estancia(self, entrada, noches: int, ocupantes: int = 1) -> Optional[float]:
+        """Precio total de la estancia, o None si alguna noche no tiene precio"""
+        return self._total(self._indice(entrada), noches, ocupantes)
+
+    def _llegadas(self, desde: datetime.date, dias: int, ocupadas: Optional[array], max_noches: int, vispera_ocupada: bool):
+        """(d, índice, duraciones) por cada día de llegada posible; las duraciones no reservables valen 0"""
+        base = self._indice(desde)
+        for d in range(dias):
+            i = base + d
+            if not (0 <= i < self.dias) or math.isnan(self.precios[i]):
+                continue
+            if ocupadas is not None:
+                # Como siempre, no se puede llegar ni en una noche reservada ni el día de salida de otra reserva
+                if ocupadas[d + 1] - ocupadas[d]:
+                    continue
+                if (ocupadas[d] - ocupadas[d - 1]) if d else vispera_ocupada:
+                    continue
+            minimo = self.estancia_minima[i]
+            por_noches = []
+            for noches in range(1, max_noches + 1):
+                libre = ocupadas is None or d + noches >= len(ocupadas) or not (ocupadas[d + noches] - ocupadas[d])
+                por_noches.append(noches if noches >= minimo and libre else 0)
+            yield d, i, por_noches
+
+    def tabla_los(
+        self,
+        desde: datetime.date,
+        dias: int,
+        ocupantes_max: int,
+        ocupadas: Optional[array] = None,
+        max_noches: int = MAX_NOCHES_LOS,
+        vispera_ocupada: bool = False
+    ) -> List[Tuple[datetime.date, int, List[Optional[float]]]]:
+        """Filas (fecha, ocupantes, precios de 1..max_noches) para cada día de llegada posible.
+
+        `ocupadas` son las sumas prefijas de noches reservadas alineadas con `desde`
+        (ver acumulado_ocupacion) y `vispera_ocupada` dice si la noche anterior a `desde`
+        está reservada (entonces `desde` es un día de salida y no se lista). Cada fila trae
+        siempre las max_noches duraciones; las que no se pueden reservar (alguna noche
+        reservada o sin precio, o por debajo de la estancia mínima) valen None.
+        """
+        filas = []
+        for d, i, por_noches in self._llegadas(desde, dias, ocupadas, max_noches, vispera_ocupada):
+            for ocupantes in range(1, ocupantes_max + 1):
+                precios = [self._total(i, noches, ocupantes) if noches else None for noches in por_noches]
+                filas.append((desde + datetime.timedelta(days=d), ocupantes, precios))
+        return filas
+
+    def tabla_los_compacta(
+        self,
+        desde: datetime.date,
+        dias: int,
+        ocupantes_max: int,
+        ocupadas: Optional[array] = None,
+        max_noches: int = MAX_NOCHES_LOS,
+        vispera_ocupada: bool = False
+    ) -> List[Tuple[datetime.date, int, int, List[Optional[float]]]]:
+        """Como tabla_los, pero con filas (fecha, ocupantes desde, ocupantes hasta, precios) que agrupan
+        los ocupantes contiguos con el mismo precio.
+
+        Si ninguna duración del día lleva recargo por ocupante se calcula una sola fila 1..ocupantes_max.
+        """
+        filas = []
+        for d, i, por_noches in self._llegadas(desde, dias, ocupadas, max_noches, vispera_ocupada):
+            fecha = desde + datetime.timedelta(days=d)
+            sin_recargo = not any(
+                self._acumulado_recargos[i + noches] - self._acumulado_recargos[i]
+                for noches in por_noches
+                if noches and i + noches <= self.dias
+            )
+            if sin_recargo:
+                filas.append((fecha, 1, ocupantes_max, [self._total(i, noches, 1) if noches else None for noches in por_noches]))
+                continue
+            anterior = None
+            for ocupantes in range(1, ocupantes_max + 1):
+                precios = [self._total(i, noches, ocupantes) if noches else None for noches in por_noches]
+                if anterior is not None and anterior[3] == precios:
+                    anterior = (fecha, anterior[1], ocupantes, precios)
+                    filas[-1] = anterior
+                else:
+                    anterior = (fecha, ocupantes, ocupantes, precios)
+                    filas.append(anterior)
+        return filas
+
+
+def _dias_temporada(temporada) -> Tuple[int, int]:
+    """(primer, último) número de día de la temporada; las filas aún sin guardar no tienen dia_*"""
+    desde, hasta = getattr(temporada, "dia_inicio", None), getattr(temporada, "dia_fin", None)
+    if desde is None or hasta is None:
+        return a_dia(temporada.start_date), a_dia(temporada.end_date)
+    return desde, hasta
+
+
+def compilar_tarifa(temporadas: Iterable, descuentos: Iterable = ()) -> Optional[TarifaCompilada]:
+    """Compila las filas de seasonalPrices (y sus descuentos por duración) de un alojamiento.
+
+    A igual prioridad gana la temporada con menor id, igual que el antiguo
+    "primer precio válido" de la consulta.
+    """
+    temporadas = list(temporadas)
+    if not temporadas:
+        return None
+
+    dias = {id(t): _dias_temporada(t) for t in temporadas}
+    inicio = min(desde for desde, _ in dias.values())
+    fin = max(hasta for _, hasta in dias.values())
+    n = fin - inicio + 1
+
+    precios = array("d", [math.nan]) * n
+    recargos = array("d", [0.0]) * n
+    estancia_minima = array("H", [1]) * n
+
+    # Se pinta de menor a mayor prioridad para que la más prioritaria quede encima
+    for temporada in sorted(temporadas, key=lambda t: (t.priority or 0, -(t.id or 0))):
+        desde, hasta = dias[id(temporada)]
+        modificador = temporada.weekend_modifier if temporada.weekend_modifier is not None else 1.0
+        minimo = temporada.min_stay or 1
+        recargo = temporada.extra_occupant_price or 0.0
+        for dia in range(desde, hasta + 1):
+            precio = temporada.price
+            if dia_semana(dia) in DIAS_FIN_DE_SEMANA:
+                precio *= modificador
+            precios[dia - inicio] = precio
+            recargos[dia - inicio] = recargo
+            estancia_minima[dia - inicio] = minimo
+
+    return TarifaCompilada(
+        inicio,
+        precios,
+        recargos,
+        estancia_minima,
+        [(d.min_nights, d.discount) for d in descuentos]
+    )
+
+
+def acumulado_ocupacion(reservas: Iterable[Tuple[int, int]], desde: datetime.date, dias: int) -> array:
+    """Sumas prefijas de noches ocupadas en [desde, desde + dias), con reservas como [entrada, salida)
+    en números de día (también se aceptan fechas)"""
+    ocupadas = [0.0] * dias
+    base = a_dia(desde)
+    for entrada, salida in reservas:
+        i = max(a_dia(entrada) - base, 0)
+        j = min(a_dia(salida) - base, dias)
+        for d in range(i, j):
+            ocupadas[d] = 1.0
+    return _acumular(ocupadas)
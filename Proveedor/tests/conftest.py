@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+# La app se ejecuta desde Proveedor/ con imports planos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Antes de importar cualquier módulo de la app: la configuración se lee al importar
+os.environ.setdefault("ADMIN_TOKEN", "secreto")
+# El servidor de imágenes de las pruebas escucha en local
+os.environ.setdefault("IMAGENES_HOSTS_PERMITIDOS", "127.0.0.1")
+
+
+@pytest.fixture(scope="session")
+def app_main(tmp_path_factory):
+    """main importado con sus bases de datos y cachés en un directorio temporal"""
+    os.chdir(tmp_path_factory.mktemp("proveedor"))
+    import main
+    return main
+
+
+@pytest.fixture(scope="session")
+def cliente(app_main):
+    from fastapi.testclient import TestClient
+
+    with TestClient(app_main.app) as cliente:
+        cliente.headers["X-Admin-Token"] = os.environ["ADMIN_TOKEN"]
+        yield cliente
+
+
+@pytest.fixture
+def alojamiento(cliente):
+    """Id de un alojamiento disponible nuevo, con precio para todo el periodo de las pruebas"""
+    respuesta = cliente.post("/listings", json={"nombre": "Casa Sol", "ciudad": "Palma", "pais": "España", "disponible": True, "occupants": 2})
+    assert respuesta.status_code == 200, respuesta.text
+    listing_id = respuesta.json()["alojamiento"]["listing"]
+    respuesta = cliente.post("/listing/prices", json={
+        "listing": listing_id, "price": 100, "start_date": "2025-01-01T00:00:00", "end_date": "2030-12-31T00:00:00"
+    })
+    assert respuesta.status_code == 200, respuesta.text
+    return listing_id
@@ -0,0 +1,66 @@
+import http.server
+import threading
+
+import pytest
+
+from imagenes import CacheImagenes, ErrorImagen, comprobar_url
+
+# No hace falta un JPEG válido: sin miniaturas el proxy solo comprueba el content-type
+IMAGEN = b"\xff\xd8\xff\xe0" + b"imagen de prueba" * 64
+
+
+class _Imagenes(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/mueve.jpg":
+            self.send_response(302)
+            self.send_header("Location", "/foto.jpg")
+            self.end_headers()
+            return
+        self.send_response(200 if self.path == "/foto.jpg" else 404)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(IMAGEN)))
+        self.end_headers()
+        self.wfile.write(IMAGEN)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def servidor():
+    """Servidor de imágenes local que hace las veces del remoto"""
+    servidor = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Imagenes)
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    yield f"http://127.0.0.1:{servidor.server_address[1]}"
+    servidor.shutdown()
+    servidor.server_close()
+
+
+def _url_id(app_main, url):
+    db = app_main.SessionLocal()
+    try:
+        return db.query(app_main.ImageUrl.id).filter(app_main.ImageUrl.url == url).scalar()
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize("ruta", ["/foto.jpg", "/mueve.jpg"])
+def test_proxy_sirve_la_imagen_del_servidor_local(app_main, cliente, alojamiento, servidor, ruta):
+    url = f"{servidor}{ruta}"
+    respuesta = cliente.post("/images", json={"listing_id": alojamiento, "link": url})
+    assert respuesta.status_code == 200, respuesta.text
+
+    respuesta = cliente.get(f"/imagenes/{_url_id(app_main, url)}")
+    assert respuesta.status_code == 200, respuesta.text
+    assert respuesta.headers["content-type"] == "image/jpeg"
+    assert respuesta.content == IMAGEN
+
+
+def test_sin_permiso_no_se_descargan_hosts_locales(tmp_path, servidor):
+    cache = CacheImagenes(str(tmp_path), hosts_permitidos=())
+    with pytest.raises(ErrorImagen):
+        cache.obtener(f"{servidor}/foto.jpg")
+    for url in ("http://localhost/a.jpg", "http://10.0.0.1/a.jpg", "http://[::1]/a.jpg", "file:///etc/passwd"):
+        with pytest.raises(ErrorImagen):
+            comprobar_url(url, frozenset())
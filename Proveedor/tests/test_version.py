@@ -0,0 +1,57 @@
+import datetime
+
+
+def _version(app_main, listing_id):
+    db = app_main.SessionLocal()
+    try:
+        return db.query(app_main.Alojamiento.version).filter(app_main.Alojamiento.listing == listing_id).scalar() or 0
+    finally:
+        db.close()
+
+
+def _fecha(dias):
+    return (datetime.date.today() + datetime.timedelta(days=dias)).isoformat()
+
+
+def test_archivar_reservas_no_cambia_la_version(app_main, alojamiento):
+    db = app_main.SessionLocal()
+    try:
+        hace = lambda dias: datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=dias), datetime.time.min)
+        db.add(app_main.Reserva(
+            listing_id=alojamiento, fecha_entrada=hace(20), fecha_salida=hace(15), localizador=987654,
+            nombre_cliente="Ana", email_cliente="ana@example.com", precio_reserva=500
+        ))
+        db.commit()
+    finally:
+        db.close()
+    version = _version(app_main, alojamiento)
+
+    assert app_main.archivar_reservas(dias_gracia=1) >= 1
+
+    assert _version(app_main, alojamiento) == version
+    db = app_main.SessionLocal()
+    try:
+        assert db.query(app_main.ReservaHistorica).filter(app_main.ReservaHistorica.localizador == 987654).count() == 1
+    finally:
+        db.close()
+
+
+def test_cada_escritura_sube_la_version_una_vez(app_main, cliente, alojamiento):
+    version = _version(app_main, alojamiento)
+    respuesta = cliente.post("/listing/prices", json={
+        "listing": alojamiento, "price": 120, "start_date": _fecha(30) + "T00:00:00", "end_date": _fecha(40) + "T00:00:00", "priority": 1
+    })
+    assert respuesta.status_code == 200, respuesta.text
+    assert _version(app_main, alojamiento) == version + 1
+
+    respuesta = cliente.post("/confirm", json={
+        "listing_id": alojamiento, "fecha_entrada": _fecha(10), "fecha_salida": _fecha(12),
+        "nombre_cliente": "Ana", "email_cliente": "ana@example.com", "precio_reserva": 0
+    })
+    assert respuesta.status_code == 200, respuesta.text
+    assert _version(app_main, alojamiento) == version + 2
+
+    localizador = respuesta.json()["reserva"]["localizador"]
+    respuesta = cliente.post("/cancel", json={"localizador": localizador, "email_cliente": "ana@example.com"})
+    assert respuesta.status_code == 200, respuesta.text
+    assert _version(app_main, alojamiento) == version + 3
@@ -0,0 +1,37 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+from typing import Optional
+
+
+def _b64(datos: bytes) -> str:
+    return base64.urlsafe_b64encode(datos).rstrip(b"=").decode()
+
+
+def _desde_b64(texto: str) -> bytes:
+    return base64.urlsafe_b64decode(texto + "=" * (-len(texto) % 4))
+
+
+def firmar(datos: dict, secreto: bytes, ttl: float) -> str:
+    """Token "<payload>.<firma>" con los datos de la cotización y su caducidad"""
+    datos = {**datos, "exp": int(time.time() + ttl)}
+    payload = _b64(json.dumps(datos, separators=(",", ":"), sort_keys=True).encode())
+    firma = _b64(hmac.new(secreto, payload.encode(), hashlib.sha256).digest())
+    return f"{payload}.{firma}"
+
+
+def verificar(token: str, secreto: bytes) -> Optional[dict]:
+    """Devuelve los datos del token si la firma es correcta y no ha caducado; None en otro caso"""
+    try:
+        payload, firma = token.split(".")
+        esperada = _b64(hmac.new(secreto, payload.encode(), hashlib.sha256).digest())
+        if not hmac.compare_digest(firma, esperada):
+            return None
+        datos = json.loads(_desde_b64(payload))
+    except (ValueError, TypeError):
+        return None
+    if datos.get("exp", 0) < time.time():
+        return None
+    return datos